@@ -0,0 +1,187 @@
+"""
+Пересборка проекций журнала activity_events.
+
+daily_statistics (и помесячная сводка) поддерживаются при записи
+событий (bd_operations.PROJECT_EVENTS). Этот модуль пересчитывает
+их из журнала заново: после исправления ошибки в проекции, ручной
+правки событий или для проверки, что проекция не разошлась с ним.
+
+Пересчитываются дни после применения миграции activity_events:
+более ранние дни записаны до журнала, их строки остаются как есть.
+Пересчет идет пачками по REPLAY_BATCH_USERS пользователей, каждая -
+отдельная короткая транзакция с потоковой группировкой по индексу
+(user_id, date), так что память не зависит от размера журнала и
+бот может писать во время пересчета.
+
+    python activity_log.py check
+    python activity_log.py replay [--user 123]
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import datetime
+
+import bd_operations as db
+import migrations
+
+REPLAY_BATCH_USERS = int(os.getenv('REPLAY_BATCH_USERS', '500'))
+
+COLUMNS = tuple(db.EVENT_COLUMNS.values())
+
+# Дни пользователей (after, last] после даты перехода, собранные из журнала
+_PROJECTION = f'''
+    SELECT user_id, date, {db.EVENT_SUMS}
+    FROM activity_events
+    WHERE user_id > :after AND user_id <= :last AND date > :cutover
+    GROUP BY user_id, date
+'''
+
+REPLAY_DAILY_STATISTICS = f'''
+    INSERT INTO daily_statistics (user_id, date, {", ".join(COLUMNS)})
+    {_PROJECTION}
+    ON CONFLICT(user_id, date) DO UPDATE SET
+        {", ".join(f"{column} = excluded.{column}" for column in COLUMNS)}
+    WHERE {" OR ".join(f"{column} IS NOT excluded.{column}" for column in COLUMNS)}
+'''
+
+# Строки после даты перехода, для которых в журнале нет событий
+_ORPHANED_DAYS = '''
+    FROM daily_statistics
+    WHERE user_id > :after AND user_id <= :last AND date > :cutover
+          AND NOT EXISTS (
+              SELECT 1 FROM activity_events e
+              WHERE e.user_id = daily_statistics.user_id AND e.date = daily_statistics.date
+          )
+'''
+
+COUNT_MISMATCHED = f'''
+    SELECT
+        (SELECT COUNT(*) FROM ({_PROJECTION}) p
+         LEFT JOIN daily_statistics d USING (user_id, date)
+         WHERE d.user_id IS NULL OR {" OR ".join(f"d.{column} IS NOT p.{column}" for column in COLUMNS)}),
+        (SELECT COUNT(*) {_ORPHANED_DAYS})
+'''
+
+REFRESH_MONTHLY_STATISTICS_RANGE = '''
+    INSERT OR REPLACE INTO monthly_statistics
+    (user_id, month, days, water_as_is, calories_burned, calories_consumed, water_norm, calories_norm)
+    SELECT user_id, substr(date, 1, 7), COUNT(*), SUM(water_as_is), SUM(calories_burned),
+           SUM(calories_consumed), SUM(water_norm), SUM(calories_norm)
+    FROM daily_statistics
+    WHERE user_id > :after AND user_id <= :last AND date >= :month
+    GROUP BY user_id, substr(date, 1, 7)
+'''
+
+
+def cutover_date(connection):
+    """
+    День применения миграции журнала: дни после него целиком
+    построены из событий. None, если миграция не применена.
+    """
+    applied_at = migrations.applied_at(connection, migrations.ACTIVITY_EVENTS_VERSION)
+    if applied_at is None:
+        return None
+    return str(datetime.date.fromtimestamp(applied_at))
+
+
+def _user_batches(connection, batch_users, user_id=None):
+    # пачки пользователей (after, last]: по индексам журнала и проекции,
+    # конец пачки - ближайший из двух, чтобы не пропустить никого
+    if user_id is not None:
+        yield user_id - 1, user_id
+        return
+    after = -2 ** 63
+    while True:
+        ends = []
+        for table in ('activity_events', 'daily_statistics'):
+            row = connection.execute(
+                f'''SELECT MAX(user_id) FROM (
+                       SELECT DISTINCT user_id FROM {table} WHERE user_id > ? ORDER BY user_id LIMIT ?
+                   )''',
+                (after, batch_users)
+            ).fetchone()
+            if row[0] is not None:
+                ends.append(row[0])
+        if not ends:
+            return
+        yield after, min(ends)
+        after = min(ends)
+
+
+def check(connection, batch_users=REPLAY_BATCH_USERS, user_id=None):
+    """
+    Сравнить daily_statistics с журналом без записи: (число дней,
+    которые расходятся или отсутствуют, число лишних строк).
+    """
+    cutover = cutover_date(connection)
+    if cutover is None:
+        raise RuntimeError('Журнал activity_events еще не создан (migrations.py)')
+    mismatched = orphaned = 0
+    for after, last in _user_batches(connection, batch_users, user_id):
+        counts = connection.execute(
+            COUNT_MISMATCHED, {'after': after, 'last': last, 'cutover': cutover}
+        ).fetchone()
+        mismatched += counts[0]
+        orphaned += counts[1]
+    return mismatched, orphaned
+
+
+def replay(connection, batch_users=REPLAY_BATCH_USERS, user_id=None):
+    """
+    Пересчитать daily_statistics и monthly_statistics из журнала.
+    Возвращает число исправленных строк.
+    """
+    cutover = cutover_date(connection)
+    if cutover is None:
+        raise RuntimeError('Журнал activity_events еще не создан (migrations.py)')
+    db.flush()
+    fixed = 0
+    for after, last in _user_batches(connection, batch_users, user_id):
+        params = {'after': after, 'last': last, 'cutover': cutover, 'month': cutover[:7] + '-01'}
+        connection.execute('BEGIN IMMEDIATE')
+        with connection:
+            batch_fixed = connection.execute(f'DELETE {_ORPHANED_DAYS}', params).rowcount
+            batch_fixed += connection.execute(REPLAY_DAILY_STATISTICS, params).rowcount
+            if batch_fixed:
+                connection.execute(
+                    'DELETE FROM monthly_statistics WHERE user_id > :after AND user_id <= :last AND month >= :month',
+                    {**params, 'month': cutover[:7]}
+                )
+                connection.execute(REFRESH_MONTHLY_STATISTICS_RANGE, params)
+        fixed += batch_fixed
+        if batch_fixed and db.history_store is not None:
+            # файлы истории пересобираются только у тех, у кого они уже есть
+            for (replayed_user, ) in connection.execute(
+                    'SELECT DISTINCT user_id FROM daily_statistics WHERE user_id > ? AND user_id <= ?', (after, last)
+            ).fetchall():
+                if os.path.exists(db.history_store.path(replayed_user)):
+                    db.history_store.rebuild(connection, replayed_user)
+    return fixed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Пересборка daily_statistics из activity_events')
+    parser.add_argument('command', choices=('check', 'replay'))
+    parser.add_argument('--user', type=int, help='только этот пользователь')
+    parser.add_argument('--batch-users', type=int, default=REPLAY_BATCH_USERS)
+    args = parser.parse_args()
+
+    connection = db.get_connection()
+    db.init_db()
+    start = time.perf_counter()
+    if args.command == 'check':
+        mismatched, orphaned = check(connection, args.batch_users, args.user)
+        print(f'расходится дней: {mismatched}, лишних строк: {orphaned} '
+              f'({time.perf_counter() - start:.1f} с)')
+        return 1 if mismatched or orphaned else 0
+
+    fixed = replay(connection, args.batch_users, args.user)
+    print(f'исправлено строк: {fixed} ({time.perf_counter() - start:.1f} с)')
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    sys.exit(main())
@@ -1,45 +1,119 @@
+import os
 import sqlite3
 import math
+import time
+import asyncio
 import datetime
-import pandas as pd
+import logging
+import functools
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+import migrations
+import history
+from cache import TTLCache, MISSING
+
+DB_PATH = os.getenv('DB_PATH', 'users.db')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '4'))
+# Окно долговечности: сколько секунд приращения могут жить только в памяти
+# (0 - писать каждое приращение сразу)
+DB_FLUSH_INTERVAL = float(os.getenv('DB_FLUSH_INTERVAL', '2'))
+DB_FLUSH_MAX_KEYS = int(os.getenv('DB_FLUSH_MAX_KEYS', '500'))
+PROFILE_CACHE_SIZE = int(os.getenv('PROFILE_CACHE_SIZE', '10000'))
+PROFILE_CACHE_TTL = float(os.getenv('PROFILE_CACHE_TTL', '600'))
+# Пересчет надбавок к воде пишет пачками по WATER_ADJUSTMENT_BATCH
+# пользователей с паузой между транзакциями, чтобы бот успевал писать
+WATER_ADJUSTMENT_BATCH = int(os.getenv('WATER_ADJUSTMENT_BATCH', '1000'))
+WATER_ADJUSTMENT_PAUSE = float(os.getenv('WATER_ADJUSTMENT_PAUSE', '0.01'))
+
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -16000',
+    'PRAGMA mmap_size = 134217728',
+    'PRAGMA busy_timeout = 5000',
+)
+
+# Колонки, которые get_*_data возвращают для графиков (после 'dates')
+SERIES_COLUMNS = ('water', 'water_norm', 'calories_consumed', 'calories_burned', 'calories_norm')
+
+# Бинарная история для графиков (см. history.py), если задан HISTORY_DIR
+history_store = history.HistoryStore(history.HISTORY_DIR) if history.HISTORY_DIR else None
+
+# Кэш строк profiles по user_id; сбрасывается в save_profiles_data
+profiles_cache = TTLCache(maxsize=PROFILE_CACHE_SIZE, ttl=PROFILE_CACHE_TTL)
+
+# Пул соединений: у каждого потока executor'а своё долгоживущее соединение
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+_generation = 0
+_executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix='db')
+
+
+def get_connection():
+    if getattr(_local, 'generation', None) != _generation:
+        connection = sqlite3.connect(DB_PATH, cached_statements=256, check_same_thread=False)
+        for pragma in PRAGMAS:
+            connection.execute(pragma)
+        with _connections_lock:
+            _connections.append(connection)
+        _local.connection = connection
+        _local.generation = _generation
+    return _local.connection
+
+
+def close_connections():
+    global _generation
+    with _connections_lock:
+        _generation += 1
+        while _connections:
+            _connections.pop().close()
+
+
+async def run(func, *args, **kwargs):
+    """
+    Выполнить функцию работы с БД в пуле потоков,
+    не блокируя event loop бота.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(_timed, func, args, kwargs))
+
+
+def _timed(func, args, kwargs):
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        metrics.DB_LATENCY.observe(time.perf_counter() - start, func.__qualname__)
+
+
+# Инициализация БД. Вызывается явно при старте (bot.on_startup, CLI,
+# бенчмарки), а не при импорте модуля. Схема - в migrations.py;
+# онлайн-миграции больших таблиц по умолчанию откладываются
+# до migrate_online()
+def init_db(online=False):
+    connection = get_connection()
+    migrations.migrate(connection, online=online)
+
+
+# Прерывает онлайн-миграции при выключении бота
+migration_stop = threading.Event()
+
+
+def migrate_online():
+    # в фоне после старта бота: пачками, см. migrations.py
+    try:
+        migrations.migrate(get_connection(), stop=migration_stop)
+    except sqlite3.Error:
+        logging.exception('Ошибка онлайн-миграции')
 
-# Инициализация БД
-def init_db():
-    connection = sqlite3.connect('users.db')
-    cursor = connection.cursor()
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS profiles (
-            user_id INTEGER PRIMARY KEY,
-            weight REAL,
-            height REAL,
-            age INTEGER,
-            activity INTEGER,
-            city VARCHAR(50),
-            water_norm INTEGER,
-            calories_norm INTEGER
-        )
-    ''')
-
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS daily_statistics (
-            user_id INTEGER,
-            date DATE,
-            water_as_is INTEGER,
-            calories_burned INTEGER,
-            calories_consumed INTEGER,
-            water_norm INTEGER,
-            calories_norm INTEGER,
-            PRIMARY KEY (user_id, date)
-        )
-    ''')
-
-    connection.commit()
-    connection.close()
 
 # Сохранить данных пользователя в БД
 def save_profiles_data(user_id, data):
-    connection = sqlite3.connect('users.db')
+    connection = get_connection()
     cursor = connection.cursor()
     
     cursor.execute('''
@@ -51,11 +125,19 @@ def save_profiles_data(user_id, data):
     )
     
     connection.commit()
-    connection.close()
+    profiles_cache.invalidate(user_id)
 
-# Показать данные пользователя
+# Показать данные пользователя (через кэш профилей)
 def get_profiles_data(user_id):
-    connection = sqlite3.connect('users.db')
+    data = profiles_cache.get(user_id)
+    if data is MISSING:
+        data = _select_profile(user_id)
+        profiles_cache.set(user_id, data)
+    return dict(data) if data else None
+
+
+def _select_profile(user_id):
+    connection = get_connection()
     cursor = connection.cursor()
     
     cursor.execute('''
@@ -65,257 +147,635 @@ def get_profiles_data(user_id):
         (user_id,)
     )
     data = cursor.fetchone()
-    
-    connection.commit()
-    connection.close()
 
     if data:
-        columns = ['weight', 'height', 'age', 'activity', 'city']
+        columns = ['weight', 'height', 'age', 'activity', 'city', 'water_norm', 'calories_norm']
         return dict(zip(columns, data))
     else:
         return None
 
-def init_daily_statistics_by_user(user_id, date):
-    connection = sqlite3.connect('users.db')
-    cursor = connection.cursor()
-
-    cursor.execute('''
-        SELECT water_norm, calories_norm FROM profiles
-        WHERE user_id = ?
-        ''',
-        (user_id, )
+# Виды событий activity_events и колонки daily_statistics, в которые
+# они складываются. water_norm - норма воды дня: базовая, надбавки за
+# жару и за тренировки; calories_norm - норма калорий дня
+EVENT_COLUMNS = {
+    'water': 'water_as_is',
+    'workout': 'calories_burned',
+    'food': 'calories_consumed',
+    'water_norm': 'water_norm',
+    'calories_norm': 'calories_norm',
+}
+EVENT_SUMS = ', '.join(
+    f"IFNULL(SUM(CASE WHEN kind = '{kind}' THEN amount END), 0) AS {column}" for kind, column in EVENT_COLUMNS.items()
+)
+
+INSERT_EVENTS = '''
+    INSERT OR IGNORE INTO activity_events (user_id, created_at, date, kind, amount, update_id, reverts)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+
+# Норма дня фиксируется событиями при первой записи за день:
+# из profiles с надбавкой за жару на этот день
+INSERT_NORM_EVENTS = '''
+    INSERT INTO activity_events (user_id, created_at, date, kind, amount)
+    SELECT user_id, :created_at, :date, 'water_norm', IFNULL(water_norm, 0) + COALESCE((
+               SELECT adjustment FROM water_adjustments a
+               WHERE a.user_id = profiles.user_id AND a.date = :date
+           ), 0)
+    FROM profiles
+    WHERE user_id = :user_id
+          AND NOT EXISTS (SELECT 1 FROM daily_statistics WHERE user_id = :user_id AND date = :date)
+    UNION ALL
+    SELECT user_id, :created_at, :date, 'calories_norm', IFNULL(calories_norm, 0)
+    FROM profiles
+    WHERE user_id = :user_id
+          AND NOT EXISTS (SELECT 1 FROM daily_statistics WHERE user_id = :user_id AND date = :date)
+'''
+
+# Проекция событий, записанных в этой транзакции (id больше
+# последнего до нее), в daily_statistics. Пропущенные INSERT OR IGNORE
+# повторы в выборку не попадают. NOT INDEXED - чтобы планировщик не
+# выбрал обход всего индекса (user_id, date) ради GROUP BY вместо
+# диапазона по id
+PROJECT_EVENTS = f'''
+    INSERT INTO daily_statistics
+    (user_id, date, {', '.join(EVENT_COLUMNS.values())})
+    SELECT user_id, date, {EVENT_SUMS}
+    FROM activity_events NOT INDEXED
+    WHERE id > ?
+    GROUP BY user_id, date
+    ON CONFLICT(user_id, date) DO UPDATE SET
+        {', '.join(f'{column} = {column} + excluded.{column}' for column in EVENT_COLUMNS.values())}
+'''
+
+
+# Пересчет помесячной сводки по дневным строкам одного месяца
+# (не больше 31 строки по первичному ключу)
+REFRESH_MONTHLY_STATISTICS = '''
+    INSERT OR REPLACE INTO monthly_statistics
+    (user_id, month, days, water_as_is, calories_burned, calories_consumed, water_norm, calories_norm)
+    SELECT user_id, substr(date, 1, 7), COUNT(*), SUM(water_as_is), SUM(calories_burned),
+           SUM(calories_consumed), SUM(water_norm), SUM(calories_norm)
+    FROM daily_statistics
+    WHERE user_id = ? AND date >= ? AND date <= ?
+    GROUP BY user_id
+'''
+
+REFRESH_MONTHLY_STATISTICS_ALL = '''
+    INSERT OR REPLACE INTO monthly_statistics
+    (user_id, month, days, water_as_is, calories_burned, calories_consumed, water_norm, calories_norm)
+    SELECT user_id, substr(date, 1, 7), COUNT(*), SUM(water_as_is), SUM(calories_burned),
+           SUM(calories_consumed), SUM(water_norm), SUM(calories_norm)
+    FROM daily_statistics
+    GROUP BY user_id, substr(date, 1, 7)
+'''
+
+
+def _refresh_monthly_statistics(connection, keys):
+    months = {(user_id, date[:7]) for user_id, date in keys}
+    connection.executemany(
+        REFRESH_MONTHLY_STATISTICS,
+        [(user_id, month + '-01', month + '-31') for user_id, month in months]
     )
-    data = cursor.fetchone()
-    water_norm = data[0]
-    calories_norm = data[1]
 
 
-    cursor.execute('''
-            insert into daily_statistics
-            (user_id, date, water_as_is, calories_burned, calories_consumed, water_norm, calories_norm) 
-            VALUES (?, ?, 0, 0, 0, ?, ?)
+def _update_history(connection, keys):
+    # после коммита: SQLite - источник истины, сбой файла истории
+    # не должен ронять запись (check --repair его починит)
+    if history_store is None:
+        return
+    try:
+        history_store.update(connection, keys)
+    except OSError:
+        logging.exception('Ошибка записи файла истории')
+
+
+def _write_events(connection, events):
+    """
+    Записать события и спроецировать их в daily_statistics внутри
+    уже открытой транзакции. Возвращает (записано событий, ключи
+    (user_id, date) затронутых дней).
+    """
+    # MAX(id) читается уже под блокировкой записи (BEGIN IMMEDIATE)
+    last_id = connection.execute('SELECT IFNULL(MAX(id), 0) FROM activity_events').fetchone()[0]
+    keys = {(event[0], event[2]) for event in events}
+    changes = connection.total_changes
+    connection.executemany(INSERT_EVENTS, events)
+    written = connection.total_changes - changes
+    if written:
+        created_at = int(time.time())
+        connection.executemany(
+            INSERT_NORM_EVENTS,
+            [{'created_at': created_at, 'date': date, 'user_id': user_id} for user_id, date in keys]
+        )
+        connection.execute(PROJECT_EVENTS, (last_id, ))
+        _refresh_monthly_statistics(connection, keys)
+    return written, keys
+
+
+# Буфер отложенной записи: события
+# (user_id, created_at, date, kind, amount, update_id, reverts)
+_pending = []
+# (update_id, user_id) апдейтов в буфере - повтор отбрасывается сразу
+_pending_updates = set()
+_buffer_lock = threading.RLock()
+_last_flush = time.monotonic()
+write_stats = {'increments': 0, 'flushes': 0, 'rows': 0, 'duplicates': 0}
+
+
+def log_events(user_id, date, amounts, update_id=None):
+    """
+    Записать в журнал действия одного сообщения: amounts - пары
+    (вид из EVENT_COLUMNS, количество), update_id - апдейт Telegram.
+    Повторно доставленный апдейт не записывается; возвращает False,
+    если это повтор (в буфере, а при немедленной записи - и в БД).
+    """
+    if get_profiles_data(user_id) is None:
+        raise LookupError(f'Профиль пользователя {user_id} не найден')
+    created_at = int(time.time())
+    events = [(user_id, created_at, str(date), kind, amount, update_id, None) for kind, amount in amounts]
+
+    if DB_FLUSH_INTERVAL <= 0:
+        connection = get_connection()
+        connection.execute('BEGIN IMMEDIATE')
+        with connection:
+            written, keys = _write_events(connection, events)
+        _update_history(connection, keys)
+        write_stats['duplicates'] += len(events) - written
+        return written > 0
+
+    with _buffer_lock:
+        if update_id is not None:
+            if (update_id, user_id) in _pending_updates:
+                write_stats['duplicates'] += len(events)
+                return False
+            _pending_updates.add((update_id, user_id))
+        write_stats['increments'] += len(events)
+        _pending.extend(events)
+
+        if len(_pending) >= DB_FLUSH_MAX_KEYS or time.monotonic() - _last_flush >= DB_FLUSH_INTERVAL:
+            flush()
+    return True
+
+
+def flush():
+    """
+    Записать накопленные события одной транзакцией.
+    Возвращает количество записанных событий.
+    """
+    global _pending, _last_flush
+
+    with _buffer_lock:
+        _last_flush = time.monotonic()
+        if not _pending:
+            return 0
+
+        batch = _pending
+        _pending = []
+        try:
+            connection = get_connection()
+            connection.execute('BEGIN IMMEDIATE')
+            with connection:
+                written, keys = _write_events(connection, batch)
+        except Exception:
+            # транзакция откатилась - возвращаем события в буфер
+            _pending = batch + _pending
+            raise
+        _pending_updates.clear()
+        _update_history(connection, keys)
+
+        write_stats['flushes'] += 1
+        write_stats['rows'] += written
+        write_stats['duplicates'] += len(batch) - written
+        return written
+
+
+async def flush_periodically():
+    if DB_FLUSH_INTERVAL <= 0:
+        return
+    while True:
+        await asyncio.sleep(DB_FLUSH_INTERVAL)
+        await run(flush)
+
+
+def iter_profile_columns(chunk_size):
+    """
+    Профили пачками по первичному ключу: (user_ids, столбцы weight,
+    height, age, activity, water_norm, calories_norm) в массивах NumPy.
+    Между пачками чтение не держит открытую транзакцию.
+    """
+    import numpy as np
+
+    connection = get_connection()
+    last_id = None
+    while True:
+        rows = connection.execute('''
+            SELECT user_id, CAST(weight AS REAL), CAST(height AS REAL), CAST(age AS REAL),
+                   CAST(activity AS REAL), IFNULL(water_norm, 0), IFNULL(calories_norm, 0)
+            FROM profiles
+            WHERE user_id > ?
+            ORDER BY user_id
+            LIMIT ?
             ''',
-            (user_id, date, water_norm, calories_norm)
-    )
-
-    connection.commit()
-    connection.close()
-
-def log_water(user_id, date, water_delta):
-    connection = sqlite3.connect('users.db')
-    cursor = connection.cursor()
-
-    cursor.execute('''
-        SELECT * FROM daily_statistics
-        WHERE user_id = ? and date = ?
-        ''',
-        (user_id, date, )
-    )
-    data = cursor.fetchone()
-
-    if data is None:
-        init_daily_statistics_by_user(user_id, date)
-    
-    cursor.execute('''
-        SELECT water_as_is FROM daily_statistics
-        WHERE user_id = ? and date = ?
-        ''',
-        (user_id, date, )
-    )
-    water_as_is = cursor.fetchone()[0]
-
-    cursor.execute('''
-        UPDATE daily_statistics
-        SET water_as_is = ? + ?
-        WHERE user_id = ? and date = ?
-        ''',
-        (water_as_is, water_delta, user_id, date, )
-    )
-
-    connection.commit()
-    connection.close()
-
-
-def log_food(user_id, date, food_delta):
-    connection = sqlite3.connect('users.db')
-    cursor = connection.cursor()
-    
-    cursor.execute('''
-        SELECT * FROM daily_statistics
-        WHERE user_id = ? and date = ?
-        ''',
-        (user_id, date, )
-    )
-    data = cursor.fetchone()
-
-    if data is None:
-        init_daily_statistics_by_user(user_id, date)
-    
-    cursor.execute('''
-        SELECT calories_consumed FROM daily_statistics
-        WHERE user_id = ? and date = ?
-        ''',
-        (user_id, date, )
-    )
-    calories_consumed = cursor.fetchone()[0]
-
-    cursor.execute('''
-        UPDATE daily_statistics
-        SET calories_consumed = ? + ?
-        WHERE user_id = ? and date = ?
-        ''',
-        (calories_consumed, food_delta, user_id, date, )
-    )
-
-    connection.commit()
-    connection.close()
+            (-2 ** 63 if last_id is None else last_id, chunk_size)
+        ).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        # NULL превращается в nan; id пользователей Telegram укладываются
+        # в 52 бита и точно представимы в float64
+        table = np.array(rows, dtype=np.float64)
+        yield table[:, 0].astype(np.int64), table[:, 1:].T
+
+
+def update_profile_norms(rows):
+    # rows: (water_norm, calories_norm, user_id)
+    connection = get_connection()
+    with connection:
+        connection.executemany(
+            'UPDATE profiles SET water_norm = ?, calories_norm = ? WHERE user_id = ?', rows
+        )
 
 
-def log_workout(user_id, date, kkal_delta, add_water):
-    connection = sqlite3.connect('users.db')
-    cursor = connection.cursor()
-    
-    cursor.execute('''
-        SELECT * FROM daily_statistics
-        WHERE user_id = ? and date = ?
-        ''',
-        (user_id, date, )
+def get_profile_cities():
+    """
+    Города из профилей с числом пользователей (по индексу idx_profiles_city).
+    """
+    cursor = get_connection().execute(
+        'SELECT city, COUNT(*) FROM profiles WHERE city IS NOT NULL GROUP BY city'
     )
-    data = cursor.fetchone()
+    return dict(cursor.fetchall())
+
+
+def apply_water_adjustments(date, temperatures, adjustment_calc, chunk_size=10000,
+                            batch_size=WATER_ADJUSTMENT_BATCH, pause=WATER_ADJUSTMENT_PAUSE):
+    """
+    Пересчитать надбавки к норме воды за день date.
+
+    temperatures - температура по городу профиля (города без погоды
+    пропускаются), adjustment_calc(weight, activity, temperature) -
+    надбавка для пользователя. Профили читаются без блокировки записи
+    (по chunk_size строк), изменения пишутся короткими транзакциями по
+    batch_size пользователей с паузой pause между ними. Уже существующие строки daily_statistics за этот
+    день сдвигаются на разницу с надбавкой, прочитанной в той же
+    транзакции, поэтому повторный или прерванный запуск ничего не
+    ломает. Возвращает число пользователей, у которых надбавка изменилась.
+    """
+    date = str(date)
+    connection = get_connection()
+
+    # чтение без транзакции: бот в это время пишет как обычно
+    old = dict(connection.execute(
+        'SELECT user_id, adjustment FROM water_adjustments WHERE date = ?', (date, )
+    ))
+    adjustments = {}
+    cursor = connection.execute('SELECT user_id, weight, activity, city FROM profiles')
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        for user_id, weight, activity, city in rows:
+            temperature = temperatures.get(city)
+            if temperature is None:
+                continue
+            try:
+                adjustment = adjustment_calc(float(weight), int(activity), temperature)
+            except (TypeError, ValueError):
+                continue
+            if adjustment != old.get(user_id, 0):
+                adjustments[user_id] = adjustment
+
+    # надбавки прошлых дней удаляются пачками
+    while True:
+        with connection:
+            deleted = connection.execute(
+                '''DELETE FROM water_adjustments WHERE rowid IN (
+                       SELECT rowid FROM water_adjustments WHERE date <> ? LIMIT ?
+                   )''',
+                (date, batch_size)
+            ).rowcount
+        if deleted < batch_size:
+            break
+        time.sleep(pause)
+
+    changed = 0
+    user_ids = list(adjustments)
+    for offset in range(0, len(user_ids), batch_size):
+        if offset:
+            time.sleep(pause)
+        chunk = user_ids[offset:offset + batch_size]
+        connection.execute('BEGIN IMMEDIATE')
+        with connection:
+            current = dict(connection.execute(
+                f'''SELECT user_id, adjustment FROM water_adjustments
+                    WHERE user_id IN ({", ".join("?" * len(chunk))}) AND date = ?''',
+                (*chunk, date)
+            ))
+            deltas = [
+                (user_id, adjustments[user_id], adjustments[user_id] - current.get(user_id, 0))
+                for user_id in chunk if adjustments[user_id] != current.get(user_id, 0)
+            ]
+            connection.executemany(
+                'INSERT OR REPLACE INTO water_adjustments (user_id, date, adjustment) VALUES (?, ?, ?)',
+                [(user_id, date, adjustment) for user_id, adjustment, _ in deltas if adjustment]
+            )
+            connection.executemany(
+                'DELETE FROM water_adjustments WHERE user_id = ?',
+                [(user_id, ) for user_id, adjustment, _ in deltas if not adjustment]
+            )
+            # сдвиг нормы уже начатых дней - событием в журнал и сразу в проекцию
+            created_at = int(time.time())
+            connection.executemany(
+                '''INSERT INTO activity_events (user_id, created_at, date, kind, amount)
+                   SELECT user_id, ?, date, 'water_norm', ? FROM daily_statistics WHERE user_id = ? AND date = ?''',
+                [(created_at, delta, user_id, date) for user_id, _, delta in deltas]
+            )
+            connection.executemany(
+                'UPDATE daily_statistics SET water_norm = water_norm + ? WHERE user_id = ? AND date = ?',
+                [(delta, user_id, date) for user_id, _, delta in deltas]
+            )
+            _refresh_monthly_statistics(connection, [(user_id, date) for user_id, _, _ in deltas])
+        _update_history(connection, [(user_id, date) for user_id, _, _ in deltas])
+        changed += len(deltas)
+    return changed
+
+
+def set_reminder(user_id, next_at, interval):
+    connection = get_connection()
+    with connection:
+        connection.execute(
+            'INSERT OR REPLACE INTO reminders (user_id, next_at, interval) VALUES (?, ?, ?)',
+            (user_id, next_at, interval)
+        )
 
-    if data is None:
-        init_daily_statistics_by_user(user_id, date)
 
-    # обновление затраченных калорий
-    cursor.execute('''
-        SELECT calories_burned FROM daily_statistics
-        WHERE user_id = ? and date = ?
-        ''',
-        (user_id, date, )
-    )
-    calories_burned = cursor.fetchone()[0]
+def delete_reminder(user_id):
+    connection = get_connection()
+    with connection:
+        connection.execute('DELETE FROM reminders WHERE user_id = ?', (user_id, ))
 
-    cursor.execute('''
-        UPDATE daily_statistics
-        SET calories_burned = ? + ?
-        WHERE user_id = ? and date = ?
-        ''',
-        (calories_burned, kkal_delta, user_id, date, )
-    )
 
-    # обновление нормы воды за день
-    cursor.execute('''
-        SELECT water_norm FROM daily_statistics
-        WHERE user_id = ? and date = ?
-        ''',
-        (user_id, date, )
+def get_due_reminders(until):
+    # диапазон по индексу idx_reminders_next_at
+    cursor = get_connection().execute(
+        'SELECT next_at, user_id FROM reminders WHERE next_at <= ? ORDER BY next_at',
+        (until, )
     )
-    water_norm = cursor.fetchone()[0]
-
-    cursor.execute('''
-        UPDATE daily_statistics
-        SET water_norm = ? + ?
-        WHERE user_id = ? and date = ?
+    return cursor.fetchall()
+
+
+def get_reminder_progress(user_ids, date):
+    """
+    Расписание и прогресс за день для пачки пользователей (по первичным
+    ключам). Несброшенные приращения сначала записываются в БД.
+    """
+    flush()
+    placeholders = ','.join('?' * len(user_ids))
+    cursor = get_connection().execute(f'''
+        SELECT r.user_id, r.next_at, r.interval,
+               COALESCE(d.water_as_is, 0), COALESCE(d.water_norm, p.water_norm),
+               COALESCE(d.calories_consumed, 0), COALESCE(d.calories_norm, p.calories_norm)
+        FROM reminders r
+        JOIN profiles p ON p.user_id = r.user_id
+        LEFT JOIN daily_statistics d ON d.user_id = r.user_id AND d.date = ?
+        WHERE r.user_id IN ({placeholders})
         ''',
-        (water_norm, add_water, user_id, date, )
+        (str(date), *user_ids)
     )
-
-    connection.commit()
-    connection.close()
+    return {row[0]: row[1:] for row in cursor}
+
+
+def reschedule_reminders(rows):
+    # rows: (next_at, user_id)
+    connection = get_connection()
+    with connection:
+        connection.executemany('UPDATE reminders SET next_at = ? WHERE user_id = ?', rows)
+
+
+def log_water(user_id, date, water_delta, update_id=None):
+    return log_events(user_id, date, [('water', water_delta)], update_id)
+
+
+def log_food(user_id, date, food_delta, update_id=None):
+    return log_events(user_id, date, [('food', food_delta)], update_id)
+
+
+def log_workout(user_id, date, kkal_delta, add_water, update_id=None):
+    # затраченные калории и дополнительная норма воды за день
+    return log_events(user_id, date, [('workout', kkal_delta), ('water_norm', add_water)], update_id)
+
+
+# Последнее неотмененное действие пользователя за день
+LAST_ENTRY = '''
+    SELECT id, update_id FROM activity_events e
+    WHERE user_id = ? AND date = ? AND kind IN ('water', 'food', 'workout') AND reverts IS NULL
+          AND NOT EXISTS (SELECT 1 FROM activity_events r WHERE r.reverts = e.id)
+    ORDER BY id DESC
+    LIMIT 1
+'''
+
+
+def undo_last_entry(user_id, date, update_id=None):
+    """
+    Отменить последнее действие пользователя за день (все события его
+    апдейта) встречными событиями - журнал только дописывается.
+    Возвращает отмененные пары (вид, количество) или [], если
+    отменять нечего. Повтор того же update_id отвечает тем же.
+    """
+    flush()
+    connection = get_connection()
+    connection.execute('BEGIN IMMEDIATE')
+    with connection:
+        if update_id is not None:
+            undone = connection.execute(
+                'SELECT kind, -amount FROM activity_events WHERE update_id = ? AND user_id = ? ORDER BY id',
+                (update_id, user_id)
+            ).fetchall()
+            if undone:
+                return undone
+
+        entry = connection.execute(LAST_ENTRY, (user_id, str(date))).fetchone()
+        if entry is None:
+            return []
+        event_id, entry_update_id = entry
+        if entry_update_id is None:
+            undone = connection.execute(
+                'SELECT id, date, kind, amount FROM activity_events WHERE id = ?', (event_id, )
+            ).fetchall()
+        else:
+            undone = connection.execute(
+                'SELECT id, date, kind, amount FROM activity_events WHERE update_id = ? AND user_id = ? ORDER BY id',
+                (entry_update_id, user_id)
+            ).fetchall()
+
+        created_at = int(time.time())
+        _, keys = _write_events(connection, [
+            (user_id, created_at, event_date, kind, -amount, update_id, undone_id)
+            for undone_id, event_date, kind, amount in undone
+        ])
+    _update_history(connection, keys)
+    return [(kind, amount) for _, _, kind, amount in undone]
 
 
 def get_daily_statistics(user_id, date):
-    connection = sqlite3.connect('users.db')
+    connection = get_connection()
     cursor = connection.cursor()
 
-    cursor.execute('''
-        SELECT 
-            water_as_is,
-            calories_burned,
-            calories_consumed,
-            water_norm,
-            calories_norm
-        FROM daily_statistics
-        WHERE user_id = ? and date = ?
-        ''',
-        (user_id, date, )
-    )
-    data = cursor.fetchone()
-
-    connection.commit()
-    connection.close()
+    # чтение под блокировкой буфера, чтобы не пропустить и не задвоить
+    # приращения, которые в этот момент сбрасываются в БД
+    with _buffer_lock:
+        cursor.execute('''
+            SELECT 
+                water_as_is,
+                calories_burned,
+                calories_consumed,
+                water_norm,
+                calories_norm
+            FROM daily_statistics
+            WHERE user_id = ? and date = ?
+            ''',
+            (user_id, date, )
+        )
+        data = cursor.fetchone()
+        deltas = None
+        for event in _pending:
+            if event[0] == user_id and event[2] == str(date):
+                deltas = deltas or dict.fromkeys(EVENT_COLUMNS.values(), 0)
+                deltas[EVENT_COLUMNS[event[3]]] += event[4]
+
+        if data is None and deltas is not None:
+            profile = get_profiles_data(user_id)
+            adjustment = cursor.execute(
+                'SELECT adjustment FROM water_adjustments WHERE user_id = ? AND date = ?',
+                (user_id, str(date))
+            ).fetchone()
+            water_norm = profile['water_norm'] + (adjustment[0] if adjustment else 0)
+            data = (0, 0, 0, water_norm, profile['calories_norm'])
 
     if data:
         columns = ['water_as_is', 'calories_burned', 'calories_consumed', 'water_norm', 'calories_norm']
-        return dict(zip(columns, data))
+        data = dict(zip(columns, data))
+        if deltas is not None:
+            for column, delta in deltas.items():
+                data[column] += delta
+        return data
     else:
         return None
   
 
+def _fetch_series(query, params, parse_date):
+    """
+    Строки периода в колоночном виде: даты разбираются один раз,
+    значения складываются в компактные array('d').
+    """
+    rows = get_connection().execute(query, params).fetchall()
+    if not rows:
+        return None
+
+    columns = list(zip(*rows))
+    series = {'dates': [parse_date(value) for value in columns[0]]}
+    for name, values in zip(SERIES_COLUMNS, columns[1:]):
+        series[name] = array('d', values)
+    return series
+
+
+def _parse_month(value):
+    return datetime.date.fromisoformat(value + '-01')
+
+
 def get_week_data(user_id):
-    connection = sqlite3.connect('users.db')
+    flush()
+    today = datetime.date.today()
+    if history_store is not None:
+        return history_store.window(get_connection(), user_id, today - datetime.timedelta(days=7), today)
     
     query = '''
-        SELECT *
+        SELECT date, water_as_is, water_norm, calories_consumed, calories_burned, calories_norm
         FROM daily_statistics
         WHERE user_id = ? and 
-              date >= date('now', '-7 days') and date <= date('now')
+              date >= ? and date <= ?
         ORDER BY date
     '''
     
-    df = pd.read_sql_query(query, connection, params=(user_id,))
-    connection.close()
-    
-    if not df.empty and 'date' in df.columns:
-        df['date'] = pd.to_datetime(df['date'])
-    
-    return df
+    return _fetch_series(query, (user_id, str(today - datetime.timedelta(days=7)), str(today)), datetime.date.fromisoformat)
 
 
 def get_month_data(user_id):
-    connection = sqlite3.connect('users.db')
+    flush()
+    month = datetime.date.today().strftime('%Y-%m')
+    if history_store is not None:
+        first = datetime.date.fromisoformat(month + '-01')
+        last = (first + datetime.timedelta(days=31)).replace(day=1) - datetime.timedelta(days=1)
+        return history_store.window(get_connection(), user_id, first, last)
     
+    # диапазон по date вместо strftime(date), чтобы работал первичный ключ
     query = '''
-        SELECT *
+        SELECT date, water_as_is, water_norm, calories_consumed, calories_burned, calories_norm
         FROM daily_statistics
         WHERE user_id = ? and 
-              strftime('%Y-%m', date) = strftime('%Y-%m', 'now')
+              date >= ? and date <= ?
         ORDER BY date
     '''
     
-    df = pd.read_sql_query(query, connection, params=(user_id,))
-    connection.close()
-    
-    if not df.empty and 'date' in df.columns:
-        df['date'] = pd.to_datetime(df['date'])
-    
-    return df
+    return _fetch_series(query, (user_id, month + '-01', month + '-31'), datetime.date.fromisoformat)
+
+
+# Средние за месяц из помесячной сводки, а пока ее заполняет
+# онлайн-миграция - прямо из дневных строк пользователя
+MONTHLY_AVERAGES = '''
+    SELECT
+        month,
+        water_as_is * 1.0 / days,
+        water_norm * 1.0 / days,
+        calories_consumed * 1.0 / days,
+        calories_burned * 1.0 / days,
+        calories_norm * 1.0 / days
+    FROM monthly_statistics
+    WHERE user_id = ?
+        AND month >= ?
+    ORDER BY month
+'''
+
+MONTHLY_AVERAGES_FROM_DAYS = '''
+    SELECT
+        substr(date, 1, 7) AS month,
+        SUM(water_as_is) * 1.0 / COUNT(*),
+        SUM(water_norm) * 1.0 / COUNT(*),
+        SUM(calories_consumed) * 1.0 / COUNT(*),
+        SUM(calories_burned) * 1.0 / COUNT(*),
+        SUM(calories_norm) * 1.0 / COUNT(*)
+    FROM daily_statistics
+    WHERE user_id = ?
+        AND date >= ?
+    GROUP BY month
+    ORDER BY month
+'''
+
+# Сводка заполнена (миграция MONTHLY_STATISTICS_VERSION применена)
+_monthly_ready = False
+
+
+def _monthly_averages(user_id, start_month):
+    global _monthly_ready
+    connection = get_connection()
+    if not _monthly_ready:
+        _monthly_ready = migrations.is_applied(connection, migrations.MONTHLY_STATISTICS_VERSION)
+    query = MONTHLY_AVERAGES if _monthly_ready else MONTHLY_AVERAGES_FROM_DAYS
+    return _fetch_series(query, (user_id, start_month), _parse_month)
 
 
 def get_year_data(user_id):
-    connection = sqlite3.connect('users.db')
+    flush()
+    today = datetime.date.today()
+    start_month = today.replace(year=today.year - 1, day=1).strftime('%Y-%m')
+    if history_store is not None:
+        return history_store.monthly(get_connection(), user_id, _parse_month(start_month))
     
-    query = '''
-        SELECT 
-            strftime('%Y-%m', date) as month,
-            AVG(water_as_is) as avg_water,
-            AVG(calories_consumed) as avg_calories_consumed,
-            AVG(calories_burned) as avg_calories_burned,
-            AVG(water_norm) as avg_water_norm,
-            AVG(calories_norm) as avg_calories_norm
-        FROM daily_statistics
-        WHERE user_id = ? 
-            AND date >= date('now', '-1 year')
-        GROUP BY strftime('%Y-%m', date)
-        ORDER BY month
-    '''
-    
-    df = pd.read_sql_query(query, connection, params=(user_id,))
-    connection.close()
-    
-    if not df.empty:
-        df['month'] = pd.to_datetime(df['month'] + '-01')
-    
-    return df
+    return _monthly_averages(user_id, start_month)
+
+
+def get_all_time_data(user_id):
+    flush()
+    if history_store is not None:
+        return history_store.monthly(get_connection(), user_id)
 
-init_db()
\ No newline at end of file
+    return _monthly_averages(user_id, '')
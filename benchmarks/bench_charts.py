@@ -0,0 +1,62 @@
+"""
+Пропускная способность отрисовки графиков (charts/sec)
+в зависимости от числа процессов пула.
+
+    python -m benchmarks.bench_charts --charts 64 --max-workers 4
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+
+import charts
+
+
+def make_series(days):
+    return {
+        'dates': [f'{day + 1:02d}.01' for day in range(days)],
+        'water': [1500 + 50 * day for day in range(days)],
+        'water_norm': [2600] * days,
+        'calories_consumed': [1800 + 20 * day for day in range(days)],
+        'calories_burned': [300 + 10 * day for day in range(days)],
+        'calories_norm': [2500] * days,
+    }
+
+
+async def measure(workers, count, series):
+    renderer = charts.ChartRenderer(workers=workers, queue_size=count)
+    # прогрев: поднимаем процессы до замера
+    await asyncio.gather(*(renderer.render(series) for _ in range(workers)))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(renderer.render(series) for _ in range(count)))
+    elapsed = time.perf_counter() - start
+    renderer.close()
+    return count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--charts', type=int, default=64)
+    parser.add_argument('--days', type=int, default=31)
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    series = make_series(args.days)
+
+    start = time.perf_counter()
+    for _ in range(8):
+        charts.render_stats(series)
+    print(f'in-process:  {8 / (time.perf_counter() - start):6.1f} charts/sec')
+
+    workers = 1
+    while workers <= args.max_workers:
+        rate = asyncio.run(measure(workers, args.charts, series))
+        print(f'{workers:2d} workers: {rate:6.1f} charts/sec')
+        workers *= 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,225 @@
+"""
+Журнал activity_events на синтетической истории.
+
+1. Запись log_water через буфер, часть апдейтов доставлена повторно
+   (в пределах буфера и после сброса) - в daily_statistics каждое
+   действие учтено один раз.
+2. replay с пустой проекцией: время, событий в секунду и пиковая
+   память процесса (VmHWM) против наивной пересборки (все события в
+   память и группировка в Python). Каждый вариант - в отдельном
+   процессе; результаты должны совпасть.
+3. activity_log.check находит испорченные строки, replay их чинит.
+
+    python -m benchmarks.bench_events --users 2000 --days 365
+"""
+import os
+import sys
+import json
+import time
+import random
+import sqlite3
+import argparse
+import datetime
+import tempfile
+import subprocess
+
+from benchmarks import dataset
+
+
+def peak_rss_mb():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def generate_events(connection, users, days, seed=2, batch_size=50000):
+    """
+    События как от бота: нормы дня, вода, еда и иногда тренировка,
+    у каждого действия свой update_id.
+    """
+    rng = random.Random(seed)
+    today = datetime.date.today()
+    profiles = connection.execute('SELECT user_id, water_norm, calories_norm FROM profiles').fetchall()
+    update_id = 0
+    batch = []
+    count = 0
+    for user_id, water_norm, calories_norm in profiles:
+        for offset in range(days, 0, -1):
+            if rng.random() < 0.2:
+                continue
+            day = today - datetime.timedelta(days=offset)
+            date = str(day)
+            created_at = int(time.mktime(day.timetuple())) + 8 * 3600
+            batch.append((user_id, created_at, date, 'water_norm', water_norm, None))
+            batch.append((user_id, created_at, date, 'calories_norm', calories_norm, None))
+            actions = [('water', rng.choice((200, 250, 300, 500))) for _ in range(rng.randint(1, 5))]
+            actions += [('food', rng.randint(100, 700)) for _ in range(rng.randint(1, 4))]
+            for kind, amount in actions:
+                update_id += 1
+                batch.append((user_id, created_at, date, kind, amount, update_id))
+            if rng.random() < 0.3:
+                update_id += 1
+                batch.append((user_id, created_at, date, 'workout', rng.randint(100, 600), update_id))
+                batch.append((user_id, created_at, date, 'water_norm', 200, update_id))
+            if len(batch) >= batch_size:
+                connection.executemany(
+                    'INSERT INTO activity_events (user_id, created_at, date, kind, amount, update_id) '
+                    'VALUES (?, ?, ?, ?, ?, ?)', batch
+                )
+                count += len(batch)
+                batch = []
+    connection.executemany(
+        'INSERT INTO activity_events (user_id, created_at, date, kind, amount, update_id) VALUES (?, ?, ?, ?, ?, ?)',
+        batch
+    )
+    connection.commit()
+    return count + len(batch)
+
+
+def naive_replay(db):
+    # все события в память, суммы в словаре, затем одна вставка
+    connection = db.get_connection()
+    sums = {}
+    for user_id, date, kind, amount in connection.execute(
+            'SELECT user_id, date, kind, amount FROM activity_events').fetchall():
+        row = sums.setdefault((user_id, date), dict.fromkeys(db.EVENT_COLUMNS.values(), 0))
+        row[db.EVENT_COLUMNS[kind]] += amount
+    with connection:
+        connection.execute('DELETE FROM daily_statistics')
+        connection.executemany(
+            'INSERT INTO daily_statistics VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(user_id, date, *row.values()) for (user_id, date), row in sums.items()]
+        )
+        connection.execute('DELETE FROM monthly_statistics')
+        connection.execute(db.REFRESH_MONTHLY_STATISTICS_ALL)
+    return len(sums)
+
+
+def child(mode):
+    import bd_operations as db
+    import activity_log
+
+    connection = db.get_connection()
+    start = time.perf_counter()
+    if mode == 'naive':
+        rows = naive_replay(db)
+    else:
+        rows = activity_log.replay(connection)
+    elapsed = time.perf_counter() - start
+    digest = connection.execute(
+        'SELECT COUNT(*), SUM(water_as_is), SUM(calories_burned), SUM(calories_consumed), '
+        'SUM(water_norm), SUM(calories_norm) FROM daily_statistics'
+    ).fetchone()
+    months = connection.execute('SELECT COUNT(*), SUM(days), SUM(water_as_is) FROM monthly_statistics').fetchone()
+    print(json.dumps({'rows': rows, 'elapsed': elapsed, 'peak_rss_mb': peak_rss_mb(),
+                      'digest': digest, 'months': months}))
+
+
+def reset_projection(path):
+    connection = sqlite3.connect(path)
+    with connection:
+        connection.execute('DELETE FROM daily_statistics')
+        connection.execute('DELETE FROM monthly_statistics')
+    connection.execute('VACUUM')
+    connection.close()
+
+
+def check_redelivery(db, users):
+    # повторная доставка: в том же окне буфера и после сброса
+    date = datetime.date.today()
+    rng = random.Random(4)
+    expected = {}
+    update_id = 10 ** 9
+    start = time.perf_counter()
+    calls = 0
+    for step in range(20000):
+        update_id += 1
+        user_id = rng.randrange(1, users + 1)
+        water = rng.choice((200, 250, 500))
+        for _ in range(2 if step % 10 == 0 else 1):
+            db.log_water(user_id, date, water, update_id)
+            calls += 1
+        expected[user_id] = expected.get(user_id, 0) + water
+        if step % 3000 == 0:
+            db.flush()
+            # апдейт, доставленный еще раз уже после сброса
+            db.log_water(user_id, date, water, update_id)
+            calls += 1
+    db.flush()
+    elapsed = time.perf_counter() - start
+    actual = dict(db.get_connection().execute(
+        'SELECT user_id, water_as_is FROM daily_statistics WHERE date = ?', (str(date), )
+    ).fetchall())
+    assert actual == expected
+    print(f'write: {calls} log_water calls ({calls - 20000} redelivered) in {elapsed:.2f} s, '
+          f'{calls / elapsed:.0f}/s; stats {db.write_stats}; each update counted once')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child)
+        return 0
+
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, 'users.db')
+    # только профили; история - в журнале
+    dataset.generate(path, args.users, 0)
+    import bd_operations as db
+    import activity_log
+    import migrations
+
+    db.close_connections()
+    db.DB_PATH = path
+    connection = db.get_connection()
+    # журнал "существует" раньше всей истории, так что replay пересчитывает все дни
+    first_day = datetime.date.today() - datetime.timedelta(days=args.days + 1)
+    with connection:
+        connection.execute('UPDATE schema_version SET applied_at = ? WHERE version = ?',
+                           (int(time.mktime(first_day.timetuple())), migrations.ACTIVITY_EVENTS_VERSION))
+    start = time.perf_counter()
+    events = generate_events(connection, args.users, args.days)
+    print(f'dataset: {args.users} users x {args.days} days, {events} events in {time.perf_counter() - start:.1f} s, '
+          f'{os.path.getsize(path) / 2 ** 20:.0f} MB')
+    db.close_connections()
+
+    env = dict(os.environ, DB_PATH=path, METRICS_PORT='0')
+    results = {}
+    for mode in ('naive', 'replay'):
+        reset_projection(path)
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.bench_events', '--child', mode],
+            env=env, check=True, capture_output=True, text=True
+        ).stdout
+        result = results[mode] = json.loads(output.splitlines()[-1])
+        print(f'{mode:7s} {result["digest"][0]} days in {result["elapsed"]:6.2f} s, '
+              f'{events / result["elapsed"]:9.0f} events/s, peak RSS {result["peak_rss_mb"]:6.1f} MB')
+    assert results['naive']['digest'] == results['replay']['digest']
+    assert results['naive']['months'] == results['replay']['months']
+    print('naive and replay projections match')
+
+    connection = db.get_connection()
+    start = time.perf_counter()
+    assert activity_log.check(connection) == (0, 0)
+    print(f'check of a consistent projection: {time.perf_counter() - start:.2f} s')
+    with connection:
+        connection.execute('UPDATE daily_statistics SET water_as_is = water_as_is + 1 WHERE rowid % 1000 = 0')
+        connection.execute("INSERT INTO daily_statistics VALUES (1, '2100-01-01', 1, 1, 1, 1, 1)")
+    damaged = activity_log.check(connection)
+    fixed = activity_log.replay(connection)
+    print(f'damaged projection: check {damaged}, replay fixed {fixed} rows, check after {activity_log.check(connection)}')
+    assert damaged[1] == 1 and fixed == sum(damaged) and activity_log.check(connection) == (0, 0)
+
+    check_redelivery(db, args.users)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,171 @@
+"""
+Выгрузка истории на синтетической базе: время, MB/s и пиковая память
+процесса (VmHWM) для наивного варианта (fetchall + CSV в памяти)
+и потоковой выгрузки с разными размерами пачек. Каждый прогон - в
+отдельном процессе, чтобы пики памяти не смешивались. Parquet
+проверяется, только если установлен pyarrow.
+
+Отдельно - отправка через ExportFile на локальный сервер, который
+читает multipart по частям: полученный файл должен совпасть с
+выгрузкой export.file_chunks.
+
+    python -m benchmarks.bench_export --users 20000 --days 365
+"""
+import io
+import os
+import csv
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import subprocess
+
+from benchmarks import dataset
+
+
+def peak_rss_mb():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def export_fetchall(db, export, path):
+    rows = db.get_connection().execute(
+        f'SELECT {", ".join(export.COLUMNS)} FROM daily_statistics ORDER BY user_id, date'
+    ).fetchall()
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(export.COLUMNS)
+    writer.writerows(rows)
+    data = buffer.getvalue().encode()
+    with open(path, 'wb') as output:
+        output.write(data)
+    return len(data)
+
+
+def export_stream(export, path, format, chunk_rows):
+    size = 0
+    with open(path, 'wb') as output:
+        for chunk in export.file_chunks(None, format, chunk_rows):
+            output.write(chunk)
+            size += len(chunk)
+    return size
+
+
+def child(args):
+    import bd_operations as db
+    import export
+
+    mode, _, chunk_rows = args.child.partition(':')
+    path = os.path.join(args.workdir, f'export-{mode}-{chunk_rows}')
+    start = time.perf_counter()
+    if mode == 'fetchall':
+        size = export_fetchall(db, export, path)
+    else:
+        size = export_stream(export, path, mode, int(chunk_rows))
+    elapsed = time.perf_counter() - start
+    os.remove(path)
+    print(json.dumps({'size': size, 'elapsed': elapsed, 'peak_rss_mb': peak_rss_mb()}))
+
+
+async def upload(user_id, chunk_rows):
+    from aiohttp import web
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    from benchmarks.fake_telegram import fake_result
+    import export
+
+    received = {}
+
+    async def handle(request):
+        method = request.match_info['method'].lower()
+        if method == 'senddocument':
+            # файл читается по частям, как это делает настоящий сервер
+            digest = hashlib.sha256()
+            size = 0
+            reader = await request.multipart()
+            async for field in reader:
+                # сам файл приходит отдельной частью, document = attach://<имя части>
+                if field.filename is None:
+                    await field.read()
+                    continue
+                while True:
+                    chunk = await field.read_chunk(1 << 16)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    size += len(chunk)
+            received.update(size=size, sha256=digest.hexdigest())
+        return web.json_response({'ok': True, 'result': fake_result(method, user_id)})
+
+    app = web.Application()
+    app.router.add_post('/bot{token}/{method}', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    url = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}'
+
+    bot = Bot('1:bench', session=AiohttpSession(api=TelegramAPIServer.from_base(url)))
+    start = time.perf_counter()
+    await bot.send_document(user_id, export.ExportFile(user_id, 'csv', chunk_rows))
+    elapsed = time.perf_counter() - start
+    await bot.session.close()
+    await runner.cleanup()
+
+    expected = b''.join(export.file_chunks(user_id, 'csv', chunk_rows))
+    assert received['size'] == len(expected), (received, len(expected))
+    assert received['sha256'] == hashlib.sha256(expected).hexdigest()
+    print(f'upload via ExportFile: user {user_id}, {len(expected)} bytes in {elapsed * 1000:.1f} ms, '
+          f'{export.count_rows(user_id)} rows, matches file_chunks')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--chunk-sizes', default='1000,5000,50000')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args)
+        return 0
+
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, 'users.db')
+    start = time.perf_counter()
+    dataset.generate(path, args.users, args.days)
+    print(f'dataset: {args.users} users x {args.days} days in {time.perf_counter() - start:.1f} s')
+
+    runs = ['fetchall'] + [f'csv:{size}' for size in args.chunk_sizes.split(',')]
+    try:
+        import pyarrow  # noqa: F401
+        runs.append(f'parquet:{args.chunk_sizes.split(",")[-1]}')
+    except ImportError:
+        print('pyarrow is not installed, parquet skipped')
+
+    env = dict(os.environ, DB_PATH=path, METRICS_PORT='0')
+    for run in runs:
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.bench_export', '--child', run, '--workdir', workdir],
+            env=env, check=True, capture_output=True, text=True
+        ).stdout
+        result = json.loads(output.splitlines()[-1])
+        mb = result['size'] / 2 ** 20
+        print(f'{run:16s} {mb:7.1f} MB in {result["elapsed"]:6.2f} s, {mb / result["elapsed"]:6.1f} MB/s, '
+              f'peak RSS {result["peak_rss_mb"]:6.1f} MB')
+
+    asyncio.run(upload(1, 100))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
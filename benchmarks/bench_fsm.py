@@ -0,0 +1,71 @@
+"""
+Переходы состояний FSM в секунду: MemoryStorage против SQLiteStorage
+(с пакетной записью и без нее). Прогоняется анкета Profile
+weight -> height -> age -> activity -> city для N пользователей,
+после чего проверяется, что состояние переживает "рестарт".
+
+    python -m benchmarks.bench_fsm --users 2000
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+STEPS = ['weight', 'height', 'age', 'activity', 'city']
+
+
+async def profile_flow(storage, users):
+    async def one(user_id):
+        key = StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+        await storage.set_state(key, 'Profile:weight')
+        for step, next_step in zip(STEPS, STEPS[1:] + [None]):
+            await storage.update_data(key, {step: '70'})
+            await storage.set_state(key, f'Profile:{next_step}' if next_step else 'Profile:city')
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(user_id) for user_id in range(users)))
+    await storage.close()
+    transitions = users * (1 + 2 * len(STEPS))
+    return transitions / (time.perf_counter() - start)
+
+
+async def run(args):
+    import bd_operations as db
+    from fsm_storage import SQLiteStorage
+
+    db.init_db()
+
+    storages = {
+        'memory': MemoryStorage(),
+        'sqlite, write-through': SQLiteStorage(flush_interval=0),
+        'sqlite, batched': SQLiteStorage(),
+    }
+    for name, storage in storages.items():
+        print(f'{name:22s} {await profile_flow(storage, args.users):10.0f} transitions/sec')
+
+    # новое хранилище поверх той же базы видит незавершенную анкету
+    restarted = SQLiteStorage()
+    key = StorageKey(bot_id=1, chat_id=0, user_id=0)
+    state, data = await restarted.get_state(key), await restarted.get_data(key)
+    assert state == 'Profile:city' and data['weight'] == '70', (state, data)
+    print('state survives restart: ok')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=2000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    os.environ['DB_PATH'] = os.path.join(workdir, 'bench.db')
+    asyncio.run(run(args))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,130 @@
+"""
+Файлы истории (history.py) против SQLite для графиков.
+
+1. rebuild всех пользователей: время и размер файлов.
+2. get_week/month/year/all_time_data и дневной ряд за всю историю
+   для случайных пользователей: задержка из SQLite и из файлов,
+   результаты должны совпадать.
+3. Цена записи: flush буфера с обновлением файлов и без; запись
+   мимо файлов находит history.check, после записи с файлами
+   расхождений нет.
+4. Порча файла и лишний файл находятся и чинятся через repair.
+
+    python -m benchmarks.bench_history --users 2000 --days 1095
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import datetime
+import tempfile
+
+from benchmarks import dataset
+
+READERS = ('get_week_data', 'get_month_data', 'get_year_data', 'get_all_time_data')
+
+
+def directory_size(path):
+    return sum(entry.stat().st_size for shard in os.scandir(path) for entry in os.scandir(shard.path))
+
+
+def per_call(func, user_ids):
+    start = time.perf_counter()
+    for user_id in user_ids:
+        func(user_id)
+    return (time.perf_counter() - start) / len(user_ids)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--days', type=int, default=1095)
+    parser.add_argument('--reads', type=int, default=500)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, 'users.db')
+    start = time.perf_counter()
+    dataset.generate(path, args.users, args.days)
+    print(f'dataset: {args.users} users x {args.days} days in {time.perf_counter() - start:.1f} s')
+
+    import bd_operations as db
+    import history
+
+    connection = db.get_connection()
+    store = history.HistoryStore(os.path.join(workdir, 'history'))
+    start = time.perf_counter()
+    days = sum(store.rebuild(connection, user_id) for user_id in range(1, args.users + 1))
+    elapsed = time.perf_counter() - start
+    size = directory_size(store.directory)
+    print(f'rebuild: {days} days in {elapsed:.2f} s, {size / 2 ** 20:.1f} MB '
+          f'({size / args.users / 1024:.1f} KB per user), users.db {os.path.getsize(path) / 2 ** 20:.1f} MB')
+
+    rng = random.Random(5)
+    user_ids = [rng.randrange(1, args.users + 1) for _ in range(args.reads)]
+    for name in READERS:
+        read = getattr(db, name)
+        db.history_store = None
+        expected = [read(user_id) for user_id in user_ids[:50]]
+        sqlite_time = per_call(read, user_ids)
+        db.history_store = store
+        actual = [read(user_id) for user_id in user_ids[:50]]
+        history_time = per_call(read, user_ids)
+        assert actual == expected, name
+        print(f'{name:18s} sqlite {sqlite_time * 1000:6.2f} ms, history {history_time * 1000:6.2f} ms, '
+              f'x{sqlite_time / history_time:.1f}, same result')
+
+    # дневной ряд за всю историю - окно, которого нет среди графиков бота
+    query = '''
+        SELECT date, water_as_is, water_norm, calories_consumed, calories_burned, calories_norm
+        FROM daily_statistics WHERE user_id = ? AND date >= ? AND date <= ? ORDER BY date
+    '''
+    today = datetime.date.today()
+    first = today - datetime.timedelta(days=args.days)
+
+    def from_sqlite(user_id):
+        return db._fetch_series(query, (user_id, str(first), str(today)), datetime.date.fromisoformat)
+
+    def from_history(user_id):
+        return store.window(connection, user_id, first, today)
+
+    assert [from_sqlite(user_id) for user_id in user_ids[:50]] == [from_history(user_id) for user_id in user_ids[:50]]
+    sqlite_time = per_call(from_sqlite, user_ids)
+    history_time = per_call(from_history, user_ids)
+    print(f'{"daily, all days":18s} sqlite {sqlite_time * 1000:6.2f} ms, history {history_time * 1000:6.2f} ms, '
+          f'x{sqlite_time / history_time:.1f}, same result')
+
+    # запись: сегодняшние приращения пачками, как flush бота
+    today = str(today)
+    for label, current in (('without history', None), ('with history', store)):
+        db.history_store = current
+        start = time.perf_counter()
+        for _ in range(20):
+            for user_id in rng.sample(range(1, args.users + 1), min(args.users, 500)):
+                db.log_water(user_id, today, 250)
+            db.flush()
+        print(f'500 log_water + flush {label}: {(time.perf_counter() - start) / 20 * 1000:.1f} ms')
+
+        # запись мимо файлов - ровно то, что должен найти check
+        start = time.perf_counter()
+        result = store.check(connection, repair=current is None)
+        print(f'  check: {result} in {time.perf_counter() - start:.2f} s')
+        assert current is None or result['ok'] == args.users
+
+    # порча: день вне SQLite и лишний файл
+    with open(store.path(1), 'r+b') as file:
+        file.seek(history.HEADER.size)
+        file.write(history.RECORD.pack(1, 2, 3, 4, 5))
+    os.makedirs(os.path.dirname(store.path(args.users + 1)), exist_ok=True)
+    with open(store.path(args.users + 1), 'wb') as file:
+        file.write(b'garbage')
+    result = store.check(connection, repair=True)
+    print(f'check with a damaged and an orphaned file: {result}')
+    assert result['mismatched'] == 1 and result['orphaned'] == 1
+    assert store.check(connection)['ok'] == args.users
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
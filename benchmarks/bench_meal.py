@@ -0,0 +1,123 @@
+"""
+Запись приема пищи из нескольких продуктов через Dispatcher бота
+(Bot API - FakeSession, OpenFoodFacts - локальный сервер с задержкой).
+
+1. По продукту за раз: /log_food <продукт> и граммы следующим
+   сообщением, для каждого продукта.
+2. Одним сообщением: /log_food яблоко 150, хлеб 50, ... - продукты
+   ищутся параллельно, прием пищи записывается одним событием.
+3. Для сравнения - те же поиски в ProductCatalog по очереди и через
+   get_products_calories.
+
+Продукты у каждого приема пищи новые, так что каждый поиск доходит
+до OpenFoodFacts. Записанные калории в обоих вариантах совпадают.
+
+    python -m benchmarks.bench_meal --meals 50 --items 4 --api-latency 0.2
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import tempfile
+
+from benchmarks import dataset
+from benchmarks.bench_suite import text_update, start_fake_apis
+from benchmarks.bench_webhook import TOKEN
+
+
+async def run(args):
+    runner, api_url = await start_fake_apis(args.api_latency)
+    os.environ.update(OPENWEATHER_URL=api_url + '/weather', OPENFOODFACTS_URL=api_url + '/food')
+
+    from benchmarks.fake_telegram import FakeSession
+    import bot as app
+    import bd_operations as db
+
+    app.bot.session = FakeSession()
+    await app.dp.emit_startup(bot=app.bot)
+    update_id = 0
+
+    async def send(user_id, text):
+        nonlocal update_id
+        update_id += 1
+        await app.dp.feed_raw_update(app.bot, text_update(update_id, user_id, text))
+
+    def meal(number):
+        # цифры в названии парсер принял бы за граммы
+        word = ''.join(chr(ord('а') + int(digit)) for digit in str(number))
+        return [(f'продукт {word} {chr(ord("а") + item)}', 50 + 25 * item) for item in range(args.items)]
+
+    async def per_item(user_id, number):
+        for name, grams in meal(number):
+            await send(user_id, f'/log_food {name}')
+            await send(user_id, str(grams))
+
+    async def one_message(user_id, number):
+        await send(user_id, '/log_food ' + ', '.join(f'{name} {grams}' for name, grams in meal(number)))
+
+    # вызовы Bot API на прием пищи, калории и события журнала; у каждого
+    # приема пищи свой пользователь, чтобы не упереться в лимит /log_food
+    results = {}
+    for label, flow, offset in (('message per item', per_item, 0), ('one message', one_message, args.meals)):
+        calls = sum(app.bot.session.calls.values())
+        latencies = []
+        for number in range(offset, offset + args.meals):
+            start = time.perf_counter()
+            await flow(number + 1, number)
+            latencies.append(time.perf_counter() - start)
+        db.flush()
+        consumed, events = db.get_connection().execute(
+            "SELECT SUM(amount), COUNT(*) FROM activity_events WHERE user_id > ? AND user_id <= ? AND kind = 'food'",
+            (offset, offset + args.meals)
+        ).fetchone()
+        latencies.sort()
+        results[label] = consumed
+        print(f'{label:17s} {args.items} items: {(sum(app.bot.session.calls.values()) - calls) / args.meals:4.1f} '
+              f'bot replies, {events / args.meals:4.1f} food events per meal; '
+              f'p50 {latencies[len(latencies) // 2] * 1000:7.1f} ms, max {latencies[-1] * 1000:7.1f} ms per meal')
+    assert results['message per item'] == results['one message'], results
+
+    names = [f'другой продукт {chr(ord("а") + item)}' for item in range(args.items)]
+    start = time.perf_counter()
+    for name in names:
+        await app.products.get_product_calories(name)
+    sequential = time.perf_counter() - start
+    names = [f'еще продукт {chr(ord("а") + item)}' for item in range(args.items)]
+    start = time.perf_counter()
+    await app.products.get_products_calories(names)
+    concurrent = time.perf_counter() - start
+    print(f'{args.items} remote lookups: one by one {sequential * 1000:.1f} ms, gather {concurrent * 1000:.1f} ms')
+
+    await app.dp.emit_shutdown(bot=app.bot)
+    await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--meals', type=int, default=50)
+    parser.add_argument('--items', type=int, default=4)
+    parser.add_argument('--api-latency', type=float, default=0.2)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, 'users.db')
+    dataset.generate(path, 2 * args.meals, 0)
+    os.environ.update(
+        DB_PATH=path,
+        PRODUCTS_DB_PATH=os.path.join(workdir, 'products.db'),
+        CHART_CACHE_DIR=os.path.join(workdir, 'charts'),
+        BOT_TOKEN=TOKEN,
+        OPENWEATHER_API_KEY='bench',
+        METRICS_PORT='0',
+        WATER_JOB_HOUR='-1',
+        CHART_PREWARM_DELAY='-1',
+        THROTTLE_RATE='1000000',
+        THROTTLE_BURST='1000000',
+    )
+    asyncio.run(run(args))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
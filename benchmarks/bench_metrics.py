@@ -0,0 +1,116 @@
+"""
+Стоимость инструментирования и проверка /metrics.
+
+1. Сколько стоит одно наблюдение гистограммы и инкремент счетчика.
+2. bot.py в режиме polling против фейкового Bot API: после прогона
+   апдейтов забираются метрики с локального порта и печатается
+   сводка по хэндлерам и функциям БД.
+
+    python -m benchmarks.bench_metrics --updates 1000
+"""
+import os
+import re
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from collections import defaultdict
+
+import aiohttp
+
+from benchmarks.fake_telegram import FakeTelegram
+from benchmarks.bench_webhook import TOKEN, COMMANDS, make_update
+
+SAMPLE = re.compile(r'^(\w+?)_(sum|count)(?:\{\w+="([^"]*)"\})? (\S+)$')
+
+
+def micro(iterations=200000):
+    import metrics
+
+    histogram = metrics.Histogram('bench_seconds', 'bench', ['label'])
+    counter = metrics.Counter('bench_total', 'bench', ['label'])
+    for name, func in (('empty call', lambda: None),
+                       ('histogram.observe', lambda: histogram.observe(0.003, 'x')),
+                       ('counter.inc', lambda: counter.inc('x'))):
+        start = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        print(f'{name:18s} {(time.perf_counter() - start) / iterations * 1e9:6.0f} ns/op')
+
+
+def summary(text, metric):
+    totals = defaultdict(dict)
+    for line in text.splitlines():
+        match = SAMPLE.match(line)
+        if match and match.group(1) == metric:
+            totals[match.group(3) or '-'][match.group(2)] = float(match.group(4))
+    for label, values in sorted(totals.items()):
+        count = values.get('count', 0)
+        print(f'  {label:32s} {int(count):6d} calls, avg {values.get("sum", 0) / count * 1000:7.2f} ms')
+    return totals
+
+
+async def end_to_end(args):
+    workdir = tempfile.mkdtemp()
+    fake = FakeTelegram()
+    api_url = await fake.start()
+    rng = random.Random(1)
+    fake.updates.extend(
+        make_update(update_id, rng.randrange(1, args.users + 1), rng.choice(COMMANDS))
+        for update_id in range(1, args.updates + 1)
+    )
+    fake.expected = args.updates
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(
+        os.environ,
+        BOT_TOKEN=TOKEN,
+        OPENWEATHER_API_KEY='bench',
+        TELEGRAM_API_URL=api_url,
+        BOT_MODE='polling',
+        METRICS_PORT=str(args.port),
+        DB_PATH=os.path.join(workdir, 'users.db'),
+        THROTTLE_BURST='1000',
+    )
+    with open(os.path.join(workdir, 'bot.log'), 'w') as log:
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(root, 'bot.py')],
+            cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT,
+        )
+    try:
+        await asyncio.wait_for(fake.done.wait(), timeout=300)
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f'http://127.0.0.1:{args.port}/metrics') as response:
+                text = await response.text()
+    finally:
+        process.terminate()
+        process.wait()
+        await fake.stop()
+
+    print(f'/metrics: {len(text)} bytes, {len(text.splitlines())} lines')
+    print('handlers:')
+    handlers = summary(text, 'bot_handler_seconds')
+    print('db:')
+    summary(text, 'bot_db_seconds')
+    print('event loop lag:')
+    summary(text, 'bot_event_loop_lag_seconds')
+    assert sum(values['count'] for values in handlers.values()) == args.updates
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--updates', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--port', type=int, default=19100)
+    args = parser.parse_args()
+
+    micro()
+    asyncio.run(end_to_end(args))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
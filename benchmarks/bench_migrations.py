@@ -0,0 +1,223 @@
+"""
+Миграции на большой базе без версий (как до migrations.py).
+
+1. Обычный CREATE INDEX (date, user_id) под нагрузкой записи: сколько
+   ждет запись бота, пока строится индекс.
+   То же для полного пересчета monthly_statistics одним запросом (как
+   init_db делал при старте с пустой сводкой).
+2. Онлайн-миграции (migrations.migrate) под той же нагрузкой: задержка
+   записи, число пачек; после них daily_statistics_days совпадает
+   с таблицей, включая строки, записанные во время миграции, а
+   monthly_statistics - с пересчетом из daily_statistics.
+3. Выборки за диапазон дат по всем пользователям: полный просмотр
+   против daily_statistics_days; цена триггера на вставку.
+
+    python -m benchmarks.bench_migrations --users 20000 --days 365
+"""
+import os
+import sys
+import time
+import random
+import logging
+import sqlite3
+import datetime
+import argparse
+import tempfile
+import threading
+
+from benchmarks import dataset
+
+
+def make_legacy(path):
+    # база в том виде, в каком ее создавал init_db до версий схемы
+    connection = sqlite3.connect(path)
+    connection.executescript('''
+        DROP TRIGGER IF EXISTS daily_statistics_days_insert;
+        DROP TRIGGER IF EXISTS daily_statistics_days_delete;
+        DROP TABLE IF EXISTS daily_statistics_days;
+        DROP INDEX IF EXISTS idx_water_adjustments_date;
+        DROP TABLE IF EXISTS schema_version;
+        DELETE FROM monthly_statistics;
+        VACUUM;
+    ''')
+    connection.close()
+
+
+class Writer(threading.Thread):
+    """
+    Запись как у бота: короткие транзакции в отдельном соединении,
+    задержка каждой записи включает ожидание блокировки.
+    """
+
+    def __init__(self, path, users):
+        super().__init__(daemon=True)
+        self.path = path
+        self.users = users
+        self.latencies = []
+        self.errors = 0
+        self.stop = threading.Event()
+
+    def run(self):
+        import bd_operations as db
+
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        for pragma in db.PRAGMAS:
+            connection.execute(pragma)
+        rng = random.Random(3)
+        today = str(datetime.date.today())
+        while not self.stop.is_set():
+            start = time.perf_counter()
+            try:
+                with connection:
+                    connection.execute(
+                        '''INSERT INTO daily_statistics VALUES (?, ?, 250, 0, 0, 2000, 2000)
+                           ON CONFLICT(user_id, date) DO UPDATE SET water_as_is = water_as_is + 250''',
+                        (rng.randrange(1, self.users + 1), today)
+                    )
+            except sqlite3.OperationalError:
+                self.errors += 1
+            self.latencies.append(time.perf_counter() - start)
+            time.sleep(0.002)
+        connection.close()
+
+    def report(self):
+        latencies = sorted(self.latencies)
+        p99 = latencies[int(len(latencies) * 0.99)] * 1000
+        return (f'{len(latencies)} writes, p99 {p99:.1f} ms, max {latencies[-1] * 1000:.1f} ms, '
+                f'{self.errors} errors')
+
+
+def under_load(path, users, func):
+    writer = Writer(path, users)
+    writer.start()
+    time.sleep(0.2)
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    time.sleep(0.2)
+    writer.stop.set()
+    writer.join()
+    return elapsed, writer.report(), result
+
+
+def timed(func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--batch-rows', type=int, default=1000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, 'users.db')
+    start = time.perf_counter()
+    dataset.generate(path, args.users, args.days)
+    make_legacy(path)
+    print(f'dataset: {args.users} users x {args.days} days in {time.perf_counter() - start:.1f} s')
+
+    import bd_operations as db
+    import migrations
+
+    connection = db.get_connection()
+    rows = connection.execute('SELECT COUNT(*) FROM daily_statistics').fetchone()[0]
+
+    def create_index():
+        connection.execute('CREATE INDEX idx_daily_statistics_date ON daily_statistics (date, user_id)')
+        connection.commit()
+
+    elapsed, load, _ = under_load(path, args.users, create_index)
+    print(f'CREATE INDEX on {rows} rows: {elapsed:.2f} s; writes meanwhile: {load}')
+    connection.execute('DROP INDEX idx_daily_statistics_date')
+    connection.commit()
+
+    def refresh_monthly():
+        with connection:
+            connection.execute(db.REFRESH_MONTHLY_STATISTICS_ALL)
+
+    elapsed, load, _ = under_load(path, args.users, refresh_monthly)
+    print(f'monthly_statistics in one query: {elapsed:.2f} s; writes meanwhile: {load}')
+    with connection:
+        connection.execute('DELETE FROM monthly_statistics')
+
+    # цена триггера: вставка новых дней до и после миграции
+    def insert_day(offset):
+        day = str(datetime.date.today() + datetime.timedelta(days=offset))
+        with connection:
+            connection.executemany('INSERT INTO daily_statistics VALUES (?, ?, 0, 0, 0, 0, 0)',
+                                   ((user_id, day) for user_id in range(1, args.users + 1)))
+
+    start = time.perf_counter()
+    insert_day(10)
+    insert_plain = time.perf_counter() - start
+
+    db.init_db()
+    elapsed, load, version = under_load(
+        path, args.users, lambda: migrations.migrate(connection, batch_rows=args.batch_rows)
+    )
+    total, indexed = connection.execute(
+        'SELECT (SELECT COUNT(*) FROM daily_statistics), (SELECT COUNT(*) FROM daily_statistics_days)'
+    ).fetchone()
+    print(f'online migration to v{version}, batches of {args.batch_rows}: {elapsed:.2f} s; writes meanwhile: {load}')
+    print(f'daily_statistics {total} rows, daily_statistics_days {indexed} rows')
+    assert total == indexed
+    # текущий и следующие месяцы пишет Writer в обход сводки - их не сравниваем
+    monthly = ('SELECT user_id, month, days, water_as_is, water_norm FROM monthly_statistics '
+               'WHERE month < ? ORDER BY 1, 2')
+    month = (datetime.date.today().strftime('%Y-%m'), )
+    backfilled = connection.execute(monthly, month).fetchall()
+    refresh_monthly()
+    assert backfilled == connection.execute(monthly, month).fetchall()
+    print(f'monthly_statistics {len(backfilled)} rows before this month, same as a full refresh')
+
+    start = time.perf_counter()
+    insert_day(11)
+    insert_triggered = time.perf_counter() - start
+    print(f'insert {args.users} new day rows: {insert_plain * 1000:.0f} ms without trigger, '
+          f'{insert_triggered * 1000:.0f} ms with trigger')
+
+    # выборки за неделю по всем пользователям
+    week = (str(datetime.date.today() - datetime.timedelta(days=7)), str(datetime.date.today()))
+    scan, active = timed(lambda: connection.execute(
+        'SELECT COUNT(DISTINCT user_id) FROM daily_statistics WHERE date BETWEEN ? AND ?', week
+    ).fetchone()[0])
+    day_number = migrations.DAY_NUMBER_SQL.format('?')
+    indexed, active_indexed = timed(lambda: connection.execute(
+        f'SELECT COUNT(DISTINCT user_id) FROM daily_statistics_days WHERE day BETWEEN {day_number} AND {day_number}',
+        week
+    ).fetchone()[0])
+    assert active == active_indexed
+    print(f'active users in a week: full scan {scan * 1000:.0f} ms, '
+          f'daily_statistics_days {indexed * 1000:.1f} ms ({active} users)')
+
+    import export
+
+    def export_week():
+        return sum(len(chunk) for chunk in export.file_chunks(None, 'csv', 5000, *week))
+
+    indexed, size = timed(export_week, repeat=1)
+    version = connection.execute('SELECT * FROM schema_version WHERE version = ?',
+                                 (migrations.DAILY_STATISTICS_DAYS_VERSION, )).fetchone()
+    connection.execute('DELETE FROM schema_version WHERE version = ?', (version[0], ))
+    connection.commit()
+    scan, size_scan = timed(export_week, repeat=1)
+    connection.execute('INSERT INTO schema_version VALUES (?, ?, ?, ?)', version)
+    connection.commit()
+    assert size == size_scan
+    print(f'export of a week for all users ({size / 2 ** 20:.1f} MB): full scan {scan:.2f} s, '
+          f'daily_statistics_days {indexed:.2f} s')
+    return 0
+
+
+if __name__ == '__main__':
+    # migrations пишет в лог время миграций и самую долгую пачку
+    logging.basicConfig(level=logging.INFO, format='  %(message)s')
+    sys.exit(main())
@@ -0,0 +1,68 @@
+"""
+Задержка поиска в локальном индексе продуктов (p50/p99)
+на синтетическом индексе из N названий.
+
+    python -m benchmarks.bench_products --products 200000 --queries 5000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+ROOTS = ['яблок', 'груш', 'хлеб', 'молок', 'сыр', 'курин', 'говяж', 'рис', 'греч', 'творог',
+         'apple', 'bread', 'cheese', 'chicken', 'rice', 'yogurt', 'banana', 'овсян', 'кефир', 'масл']
+ENDINGS = ['о', 'и', 'ый', 'ая', 'ое', 'а', '', 'ы']
+WORDS = ['белый', 'домашний', 'сушеные', 'печеное', 'light', 'classic', 'bio', 'нежирный', 'грудка', 'филе']
+
+
+def random_name(rng):
+    name = rng.choice(ROOTS) + rng.choice(ENDINGS)
+    for _ in range(rng.randint(0, 3)):
+        name += ' ' + rng.choice(WORDS)
+    return f'{name} {rng.randint(1, 10**6)}'
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--products', type=int, default=200000)
+    parser.add_argument('--queries', type=int, default=5000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    os.environ['DB_PATH'] = os.path.join(workdir, 'users.db')
+    csv_path = os.path.join(workdir, 'products.csv')
+    import products
+
+    rng = random.Random(1)
+    with open(csv_path, 'w', encoding='utf-8') as file:
+        file.write('code\tproduct_name\tenergy-kcal_100g\n')
+        for i in range(args.products):
+            file.write(f'{i}\t{random_name(rng)}\t{rng.randint(20, 900)}\n')
+
+    index = products.ProductIndex(os.path.join(workdir, 'products.db'))
+    start = time.perf_counter()
+    loaded = index.load_csv(csv_path)
+    print(f'loaded {loaded} products in {time.perf_counter() - start:.1f}s')
+
+    queries = [rng.choice(ROOTS) + rng.choice(ENDINGS) + rng.choice(['', ' ' + rng.choice(WORDS)])
+               for _ in range(args.queries)]
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        index.search(query)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    print(f'search p50: {percentile(latencies, 0.5):.2f} ms, '
+          f'p99: {percentile(latencies, 0.99):.2f} ms, max: {max(latencies):.2f} ms')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,117 @@
+"""
+Нагрузочная проверка напоминаний.
+
+1. Симуляция в памяти: 1M напоминаний, разбросанных по суткам, с
+   подгрузкой окнами из отсортированного "индекса" (как из таблицы
+   reminders) и модельными часами. Каждое должно сработать ровно один
+   раз, по порядку и не позже шага часов.
+2. Выборка окна из SQLite по индексу idx_reminders_next_at на 1M строк.
+3. Общий лимитер: реальная скорость отправки не превышает заданную.
+
+    python -m benchmarks.bench_reminders --reminders 1000000
+"""
+import os
+import sys
+import time
+import bisect
+import random
+import asyncio
+import argparse
+import tempfile
+
+DAY = 24 * 3600
+
+
+def simulate(count, window, step, batch_size):
+    from reminders import ReminderQueue
+
+    rng = random.Random(1)
+    start = 1_700_000_000
+    schedule = sorted((start + rng.randrange(DAY), user_id) for user_id in range(count))
+    index = [due for due, _ in schedule]
+
+    queue = ReminderQueue()
+    fired = 0
+    max_late = 0
+    max_heap = 0
+    last_due = 0
+    loaded = 0
+    began = time.perf_counter()
+    for now in range(start, start + DAY + step, step):
+        # подгрузка окна, как ReminderScheduler._load
+        until = bisect.bisect_right(index, now + window)
+        queue.extend(schedule[loaded:until])
+        loaded = until
+        max_heap = max(max_heap, len(queue))
+        while True:
+            batch = queue.pop_due(now, batch_size)
+            if not batch:
+                break
+            for due, _ in batch:
+                assert due >= last_due, 'out of order'
+                last_due = due
+                max_late = max(max_late, now - due)
+            fired += len(batch)
+    elapsed = time.perf_counter() - began
+
+    assert fired == count and len(queue) == 0, (fired, len(queue))
+    assert max_late < step
+    print(f'simulation: {count} reminders over 24h in {elapsed:.2f} s '
+          f'({count / elapsed:.0f} reminders/sec), max heap {max_heap}, max lateness {max_late} s')
+
+
+def due_query(count, window):
+    import bd_operations as db
+
+    db.init_db()
+    rng = random.Random(2)
+    now = int(time.time())
+    connection = db.get_connection()
+    with connection:
+        connection.executemany(
+            'INSERT INTO reminders (user_id, next_at, interval) VALUES (?, ?, ?)',
+            ((user_id, now + rng.randrange(DAY), 3 * 3600) for user_id in range(count))
+        )
+    plan = connection.execute(
+        'EXPLAIN QUERY PLAN SELECT next_at, user_id FROM reminders WHERE next_at <= ? ORDER BY next_at', (now, )
+    ).fetchall()
+    rows = db.get_due_reminders(now + window)
+    start = time.perf_counter()
+    db.get_due_reminders(now + window)
+    elapsed = time.perf_counter() - start
+    print(f'due query: {len(rows)} rows in a {window} s window of {count} in {elapsed * 1000:.1f} ms; '
+          f'plan: {plan[-1][-1]}')
+
+
+async def limiter(rate, messages):
+    from reminders import RateLimiter
+
+    rate_limiter = RateLimiter(rate)
+    # стартовый запас бакета тратится сразу
+    start = time.perf_counter()
+    for _ in range(messages):
+        await rate_limiter.acquire()
+    elapsed = time.perf_counter() - start
+    expected = (messages - rate) / rate
+    print(f'rate limiter: {messages} sends at {rate}/s took {elapsed:.2f} s (expected >= {expected:.2f} s)')
+    assert elapsed >= expected * 0.95
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--reminders', type=int, default=1000000)
+    parser.add_argument('--window', type=int, default=600)
+    parser.add_argument('--step', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=500)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    os.environ['DB_PATH'] = os.path.join(workdir, 'bench.db')
+    simulate(args.reminders, args.window, args.step, args.batch_size)
+    due_query(args.reminders, args.window)
+    asyncio.run(limiter(25, 100))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+"""
+Массовый пересчет норм профилей: построчный Python (water_norm_calc /
+calories_norm_calc на каждую строку) против векторного rescore_profiles
+с разными размерами пачек. Перед каждым прогоном нормы портятся,
+чтобы пересчет записывал все строки; результаты сверяются со скалярными
+формулами. Отдельно - прогон без изменений и время одних формул.
+
+    python -m benchmarks.bench_rescore --users 2000000
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+
+from benchmarks import dataset
+
+
+def scalar_rescore(db, norms):
+    connection = db.get_connection()
+    rows = connection.execute('SELECT user_id, weight, height, age, activity FROM profiles').fetchall()
+    updates = [
+        (norms.water_norm_calc(weight, activity), norms.calories_norm_calc(weight, height, age, activity), user_id)
+        for user_id, weight, height, age, activity in rows
+    ]
+    db.update_profile_norms(updates)
+    return len(updates)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=2000000)
+    parser.add_argument('--chunk-sizes', default='10000,50000,200000')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, 'users.db')
+    start = time.perf_counter()
+    dataset.generate(path, args.users, 0)
+    print(f'dataset: {args.users} profiles in {time.perf_counter() - start:.1f} s')
+
+    import bd_operations as db
+    import norms
+
+    expected = None
+    runs = [('scalar python', None)] + [(f'numpy, chunk {size}', int(size)) for size in args.chunk_sizes.split(',')]
+    for name, chunk_size in runs:
+        db.get_connection().execute('UPDATE profiles SET water_norm = 0, calories_norm = 0')
+        db.get_connection().commit()
+        start = time.perf_counter()
+        if chunk_size is None:
+            changed = scalar_rescore(db, norms)
+        else:
+            _, changed = norms.rescore_profiles(chunk_size)
+        elapsed = time.perf_counter() - start
+
+        result = db.get_connection().execute(
+            'SELECT SUM(water_norm), SUM(calories_norm), COUNT(*) FROM profiles'
+        ).fetchone()
+        expected = expected or result
+        assert result == expected and changed == args.users, (result, expected, changed)
+        print(f'{name:22s} {elapsed:6.2f} s, {args.users / elapsed:10.0f} profiles/sec')
+
+    # формулы не менялись - ничего не пишется
+    start = time.perf_counter()
+    _, changed = norms.rescore_profiles()
+    elapsed = time.perf_counter() - start
+    assert changed == 0
+    print(f'{"numpy, no changes":22s} {elapsed:6.2f} s, {args.users / elapsed:10.0f} profiles/sec')
+
+    # только вычисление формул, без чтения и записи
+    user_ids, (weight, height, age, activity, _, _) = next(db.iter_profile_columns(args.users))
+    rows = list(zip(weight.tolist(), height.tolist(), age.tolist(), activity.tolist()))
+    start = time.perf_counter()
+    for w, h, a, act in rows:
+        norms.water_norm_calc(w, act)
+        norms.calories_norm_calc(w, h, a, act)
+    scalar = time.perf_counter() - start
+    start = time.perf_counter()
+    norms.water_norm_calc_np(weight, activity)
+    norms.calories_norm_calc_np(weight, height, age, activity)
+    vector = time.perf_counter() - start
+    print(f'formulas only: scalar {scalar:.2f} s, numpy {vector:.3f} s ({scalar / vector:.0f}x)')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
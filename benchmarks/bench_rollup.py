@@ -0,0 +1,142 @@
+"""
+Запросы за месяц и за год: старые (strftime/GROUP BY по сырым строкам)
+против диапазона по date и помесячной сводки monthly_statistics.
+
+Полный размер из задачи - 100k пользователей x 2 года (~73M строк,
+десятки ГБ и долгая генерация):
+    python -m benchmarks.bench_rollup --users 100000 --days 730
+По умолчанию используется уменьшенный набор.
+
+Сравнивается только SQL (fetchall), без разбора результата.
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import argparse
+import datetime
+import tempfile
+
+OLD_MONTH_QUERY = '''
+    SELECT *
+    FROM daily_statistics
+    WHERE user_id = ? and
+          strftime('%Y-%m', date) = strftime('%Y-%m', 'now')
+    ORDER BY date
+'''
+
+OLD_YEAR_QUERY = '''
+    SELECT
+        strftime('%Y-%m', date) as month,
+        AVG(water_as_is) as avg_water,
+        AVG(calories_consumed) as avg_calories_consumed,
+        AVG(calories_burned) as avg_calories_burned,
+        AVG(water_norm) as avg_water_norm,
+        AVG(calories_norm) as avg_calories_norm
+    FROM daily_statistics
+    WHERE user_id = ?
+        AND date >= date('now', '-1 year')
+    GROUP BY strftime('%Y-%m', date)
+    ORDER BY month
+'''
+
+
+NEW_MONTH_QUERY = '''
+    SELECT *
+    FROM daily_statistics
+    WHERE user_id = ? and
+          date >= ? and date <= ?
+    ORDER BY date
+'''
+
+NEW_YEAR_QUERY = '''
+    SELECT
+        month,
+        water_as_is * 1.0 / days as avg_water,
+        calories_consumed * 1.0 / days as avg_calories_consumed,
+        calories_burned * 1.0 / days as avg_calories_burned,
+        water_norm * 1.0 / days as avg_water_norm,
+        calories_norm * 1.0 / days as avg_calories_norm
+    FROM monthly_statistics
+    WHERE user_id = ?
+        AND month >= ?
+    ORDER BY month
+'''
+
+
+def generate(path, users, days):
+    connection = sqlite3.connect(path)
+    connection.execute('PRAGMA journal_mode = WAL')
+    connection.execute('PRAGMA synchronous = OFF')
+    today = datetime.date.today()
+    dates = [str(today - datetime.timedelta(days=day)) for day in range(days)]
+    rng = random.Random(1)
+    with connection:
+        connection.executemany(
+            'INSERT INTO profiles VALUES (?, 70, 175, 30, 30, ?, 2600, 2500)',
+            ((user_id, 'Moscow') for user_id in range(users))
+        )
+        connection.executemany(
+            'INSERT INTO daily_statistics VALUES (?, ?, ?, ?, ?, 2600, 2500)',
+            ((user_id, date, rng.randrange(3000), rng.randrange(800), rng.randrange(3000))
+             for user_id in range(users) for date in dates)
+        )
+    connection.close()
+
+
+def timed(func, users, samples):
+    rng = random.Random(2)
+    start = time.perf_counter()
+    for _ in range(samples):
+        func(rng.randrange(users))
+    return (time.perf_counter() - start) / samples * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--days', type=int, default=730)
+    parser.add_argument('--samples', type=int, default=500)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    os.environ['DB_PATH'] = os.path.join(workdir, 'bench.db')
+    import bd_operations as db
+
+    db.init_db()
+    start = time.perf_counter()
+    generate(db.DB_PATH, args.users, args.days)
+    print(f'generated {args.users} users x {args.days} days in {time.perf_counter() - start:.1f}s')
+
+    start = time.perf_counter()
+    connection = db.get_connection()
+    with connection:
+        connection.execute(db.REFRESH_MONTHLY_STATISTICS_ALL)
+    print(f'rollup backfill: {time.perf_counter() - start:.1f}s')
+
+    today = datetime.date.today()
+    month = today.strftime('%Y-%m')
+    start_month = today.replace(year=today.year - 1, day=1).strftime('%Y-%m')
+
+    def old_month(user_id):
+        connection.execute(OLD_MONTH_QUERY, (user_id, )).fetchall()
+
+    def new_month(user_id):
+        connection.execute(NEW_MONTH_QUERY, (user_id, month + '-01', month + '-31')).fetchall()
+
+    def old_year(user_id):
+        connection.execute(OLD_YEAR_QUERY, (user_id, )).fetchall()
+
+    def new_year(user_id):
+        connection.execute(NEW_YEAR_QUERY, (user_id, start_month)).fetchall()
+
+    print(f'month, strftime filter: {timed(old_month, args.users, args.samples):8.3f} ms')
+    print(f'month, date range:      {timed(new_month, args.users, args.samples):8.3f} ms')
+    print(f'year,  GROUP BY raw:    {timed(old_year, args.users, args.samples):8.3f} ms')
+    print(f'year,  rollup:          {timed(new_year, args.users, args.samples):8.3f} ms')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,73 @@
+"""
+Масштабирование многопроцессного режима: bot.py с BOT_WORKERS=1..N
+в режиме polling против фейкового Bot API, у которого заранее
+накоплены апдейты. Считаются ответы в секунду от первого до последнего.
+
+    python -m benchmarks.bench_sharding --updates 3000 --max-workers 4
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+from benchmarks.fake_telegram import FakeTelegram
+from benchmarks.bench_webhook import TOKEN, COMMANDS, make_update
+
+
+async def measure(workers, args):
+    workdir = tempfile.mkdtemp()
+    fake = FakeTelegram()
+    api_url = await fake.start()
+    rng = random.Random(1)
+    fake.updates.extend(
+        make_update(update_id, rng.randrange(1, args.users + 1), rng.choice(COMMANDS))
+        for update_id in range(1, args.updates + 1)
+    )
+    fake.expected = args.updates
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(
+        os.environ,
+        BOT_TOKEN=TOKEN,
+        OPENWEATHER_API_KEY='bench',
+        TELEGRAM_API_URL=api_url,
+        BOT_MODE='polling',
+        BOT_WORKERS=str(workers),
+        DB_PATH=os.path.join(workdir, 'users.db'),
+    )
+    with open(os.path.join(workdir, 'bot.log'), 'w') as log:
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(root, 'bot.py')],
+            cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT,
+        )
+    try:
+        await asyncio.wait_for(fake.done.wait(), timeout=600)
+        elapsed = time.perf_counter() - fake.first_sent_at
+    finally:
+        process.terminate()
+        process.wait()
+        await fake.stop()
+    return args.updates / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--updates', type=int, default=3000)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    workers = 1
+    while workers <= args.max_workers:
+        rate = asyncio.run(measure(workers, args))
+        print(f'{workers:2d} workers: {rate:8.0f} updates/sec')
+        workers *= 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+"""
+Холодный старт: время импорта модулей и пиковый RSS процесса.
+Каждый вариант измеряется в отдельном чистом интерпретаторе.
+Дополнительно проверяется, что импорт не создает ни базу (схема
+создается только в init_db при старте), ни products.db, ни каталог
+кэша графиков (они создаются при первом обращении), и сравнивается запуск
+пула графиков из процесса, где главный модуль - bot.py: как раньше
+(каждый процесс пула заново импортирует bot.py) и через
+ChartRenderer.prewarm. Процессы пула запускаются по мере надобности,
+поэтому после прогрева пул нагружается задачами, пока каждый процесс
+не выполнит хотя бы одну, и считается, сколько из них импортировали bot.
+
+    python -m benchmarks.bench_startup
+"""
+import os
+import sys
+import argparse
+import tempfile
+import subprocess
+
+PROBE = '''
+import time, resource
+start = time.perf_counter()
+{imports}
+elapsed = time.perf_counter() - start
+print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+'''
+
+SCENARIOS = {
+    'pandas (old read path)': 'import pandas, bd_operations, charts',
+    'bd_operations + charts': 'import bd_operations, charts',
+    'bot': 'import bot',
+    'bot + matplotlib (eager)': 'import bot, matplotlib.figure, numpy',
+}
+
+# Главный модуль для проверки пула: сам импортирует bot, как bot.py при запуске
+POOL_PROBE = '''
+import sys, time, asyncio, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import bot
+import charts
+
+
+def rss_mb(pid):
+    with open(f'/proc/{pid}/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+
+
+# задача для пула: pid процесса и импортирован ли в нем bot
+PROBE_TASK = "__import__('time').sleep(0.2) or (__import__('os').getpid(), 'bot' in __import__('sys').modules)"
+
+
+async def main(mode, workers):
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    if mode == 'old':
+        executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=charts._init_worker)
+        await loop.run_in_executor(executor, int)
+    else:
+        renderer = charts.ChartRenderer(workers=workers)
+        await renderer.prewarm(delay=0)
+        executor = renderer._executor
+    elapsed = time.perf_counter() - start
+    # задачи, пока каждый процесс пула не выполнит хотя бы одну
+    seen = {}
+    while len(seen) < workers:
+        seen.update(await asyncio.gather(*[loop.run_in_executor(executor, eval, PROBE_TASK)
+                                           for _ in range(workers * 2)]))
+    imported = sum(seen.values())
+    print(elapsed, sum(rss_mb(pid) for pid in executor._processes) / len(executor._processes),
+          len(executor._processes), imported)
+    executor.shutdown()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(sys.argv[1], int(sys.argv[2])))
+'''
+
+
+def measure(imports, runs, env):
+    times, rss = [], []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', PROBE.format(imports=imports)],
+            capture_output=True, text=True, check=True, env=env,
+        ).stdout.split()
+        times.append(float(output[0]))
+        rss.append(int(output[1]))
+    return min(times), min(rss)
+
+
+def measure_pool(mode, workers, runs, env, workdir):
+    path = os.path.join(workdir, 'pool_probe.py')
+    with open(path, 'w') as file:
+        file.write(POOL_PROBE)
+    times, rss, imported = [], [], []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, path, mode, str(workers)], capture_output=True, text=True, check=True, env=env,
+            cwd=workdir,
+        ).stdout.split()
+        times.append(float(output[0]))
+        rss.append(float(output[1]))
+        imported.append(f'{output[3]}/{output[2]}')
+    return min(times), min(rss), imported
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--workers', type=int, default=3)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    db_path = os.path.join(workdir, 'bench.db')
+    env = dict(os.environ, DB_PATH=db_path,
+               PYTHONPATH=os.getcwd() + os.pathsep + os.environ.get('PYTHONPATH', ''),
+               BOT_TOKEN='123456:bench', OPENWEATHER_API_KEY='bench',
+               PRODUCTS_DB_PATH=os.path.join(workdir, 'products.db'),
+               CHART_CACHE_DIR=os.path.join(workdir, 'charts'), METRICS_PORT='0')
+
+    for name, imports in SCENARIOS.items():
+        try:
+            elapsed, rss = measure(imports, args.runs, env)
+        except subprocess.CalledProcessError:
+            print(f'{name:28s} skipped (import failed)')
+            continue
+        print(f'{name:28s} import {elapsed * 1000:8.1f} ms, peak RSS {rss / 1024:7.1f} MB')
+    created = [name for name in (db_path, env['PRODUCTS_DB_PATH'], env['CHART_CACHE_DIR']) if os.path.exists(name)]
+    print(f'files created by imports: {", ".join(map(os.path.basename, created)) or "none"}')
+
+    for name, mode in (('chart pool, re-imports bot', 'old'), ('chart pool, prewarm', 'new')):
+        elapsed, rss, imported = measure_pool(mode, args.workers, min(args.runs, 3), env, workdir)
+        print(f'{name:28s} ready in {elapsed * 1000:8.1f} ms, worker RSS {rss:7.1f} MB, '
+              f'workers that imported bot: {", ".join(imported)}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+"""
+Бенчмарк слоя хранения: ops/sec для log_water до и после пула соединений.
+
+Запуск из корня репозитория:
+    python -m benchmarks.bench_storage --users 200 --ops 5000
+
+Что параллельные приращения не теряются, проверяет
+benchmarks/test_storage.py.
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import sqlite3
+import argparse
+import datetime
+import tempfile
+
+
+def legacy_log_water(path, user_id, date, water_delta):
+    # Старая реализация: новое соединение на каждый вызов
+    connection = sqlite3.connect(path)
+    cursor = connection.cursor()
+    cursor.execute('SELECT * FROM daily_statistics WHERE user_id = ? and date = ?', (user_id, date))
+    if cursor.fetchone() is None:
+        cursor.execute('SELECT water_norm, calories_norm FROM profiles WHERE user_id = ?', (user_id,))
+        water_norm, calories_norm = cursor.fetchone()
+        cursor.execute('''
+            INSERT INTO daily_statistics
+            (user_id, date, water_as_is, calories_burned, calories_consumed, water_norm, calories_norm)
+            VALUES (?, ?, 0, 0, 0, ?, ?)
+            ''', (user_id, date, water_norm, calories_norm))
+        connection.commit()
+    cursor.execute('SELECT water_as_is FROM daily_statistics WHERE user_id = ? and date = ?', (user_id, date))
+    water_as_is = cursor.fetchone()[0]
+    cursor.execute('UPDATE daily_statistics SET water_as_is = ? + ? WHERE user_id = ? and date = ?',
+                   (water_as_is, water_delta, user_id, date))
+    connection.commit()
+    connection.close()
+
+
+def seed_profiles(db, users):
+    for user_id in range(users):
+        db.save_profiles_data(user_id, {
+            'weight': 70, 'height': 175, 'age': 30, 'activity': 30,
+            'city': 'Moscow', 'water_norm': 2600, 'calories_norm': 2500,
+        })
+
+
+async def run_pooled(db, users, ops, concurrency):
+    date = datetime.date.today()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            await db.run(db.log_water, random.randrange(users), date, 250)
+
+    await asyncio.gather(*(one() for _ in range(ops)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--ops', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    os.environ['DB_PATH'] = os.path.join(workdir, 'bench.db')
+    import bd_operations as db
+
+    db.init_db()
+    seed_profiles(db, args.users)
+    date = datetime.date.today()
+
+    start = time.perf_counter()
+    for _ in range(args.ops):
+        legacy_log_water(db.DB_PATH, random.randrange(args.users), date, 250)
+    legacy = args.ops / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    asyncio.run(run_pooled(db, args.users, args.ops, args.concurrency))
+    pooled = args.ops / (time.perf_counter() - start)
+
+    db.close_connections()
+    print(f'legacy connect-per-call: {legacy:10.0f} ops/sec')
+    print(f'pooled + WAL:            {pooled:10.0f} ops/sec')
+    print(f'speedup:                 {pooled / legacy:10.1f}x')
+    print(f'profiles cache:          {db.profiles_cache.stats()}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,301 @@
+"""
+Воспроизводимый набор сценариев нагрузки. Апдейты прогоняются через
+Dispatcher бота в том же процессе: Bot API подменен FakeSession,
+OpenWeatherMap и OpenFoodFacts - локальным фейковым сервером.
+База - синтетическая (benchmarks/dataset.py), копия на каждый сценарий.
+
+Каждый сценарий запускается в отдельном интерпретаторе, чтобы пиковый
+RSS и прогрев кэшей не смешивались между сценариями. Итог печатается
+таблицей и сохраняется в JSON для сравнения прогонов:
+
+    python -m benchmarks.bench_suite --users 10000 --days 365 --active 300
+    python -m benchmarks.bench_suite --compare bench_results/old.json bench_results/new.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+
+from benchmarks import dataset
+from benchmarks.bench_webhook import TOKEN, make_update
+from benchmarks.bench_throttling import make_callback
+
+RESULTS_DIR = 'bench_results'
+
+
+def text_update(update_id, user_id, text):
+    update = make_update(update_id, user_id, text)
+    if not text.startswith('/'):
+        del update['message']['entities']
+    return update
+
+
+# Сценарии: что отправляет один пользователь, по порядку
+def profile_flow(rng):
+    return ['/set_profile', str(rng.randint(50, 110)), str(rng.randint(155, 200)),
+            str(rng.randint(18, 70)), str(rng.choice([0, 30, 60])), rng.choice(dataset.CITIES)]
+
+
+def log_burst(rng):
+    return ['/log_water 250', '/log_workout бег 30', f'/log_food {rng.choice(["яблоко", "банан", "хлеб"])}',
+            str(rng.randint(50, 300)), '/log_water 300', '/log_workout йога 45']
+
+
+def check_progress(rng):
+    return ['/check_progress'] * 5
+
+
+def statistics(rng):
+    return ['/show_statistics', 'cb:btn_week', 'cb:btn_month', 'cb:btn_year']
+
+
+def mixed(rng):
+    flows = [log_burst, check_progress, statistics]
+    return [step for flow in rng.sample(flows, len(flows)) for step in flow(rng)]
+
+
+SCENARIOS = {
+    'profile': profile_flow,
+    'log_burst': log_burst,
+    'check_progress': check_progress,
+    'statistics': statistics,
+    'mixed': mixed,
+}
+
+
+def build_script(scenario, users, active, seed):
+    """
+    Список последовательностей апдейтов, по одной на пользователя.
+    """
+    rng = random.Random(seed)
+    update_id = 0
+    script = []
+    for user_id in rng.sample(range(1, users + 1), min(active, users)):
+        updates = []
+        for step in SCENARIOS[scenario](rng):
+            update_id += 1
+            if step.startswith('cb:'):
+                updates.append(make_callback(update_id, user_id, step[3:]))
+            else:
+                updates.append(text_update(update_id, user_id, step))
+        script.append(updates)
+    return script
+
+
+async def start_fake_apis(latency):
+    from aiohttp import web
+
+    async def weather(request):
+        await asyncio.sleep(latency)
+        return web.json_response({'cod': 200, 'name': request.query['q'], 'main': {'temp': 24.0}})
+
+    async def food(request):
+        await asyncio.sleep(latency)
+        return web.json_response({'products': [
+            {'product_name': request.query['search_terms'], 'nutriments': {'energy-kcal_100g': 52}}
+        ]})
+
+    app = web.Application()
+    app.router.add_get('/weather', weather)
+    app.router.add_get('/food', food)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner, f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}'
+
+
+def peak_rss_mb():
+    # VmHWM сбрасывается при exec, в отличие от ru_maxrss, унаследованного от родителя
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentile(values, q):
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+async def replay(args):
+    """
+    Режим дочернего процесса: один сценарий, результат - JSON в stdout.
+    """
+    runner, api_url = await start_fake_apis(args.api_latency)
+    os.environ.update(OPENWEATHER_URL=api_url + '/weather', OPENFOODFACTS_URL=api_url + '/food')
+
+    from benchmarks.fake_telegram import FakeSession
+    import bot as app
+
+    app.bot.session = FakeSession()
+    script = build_script(args.scenario, args.users, args.active, args.seed)
+    await app.dp.emit_startup(bot=app.bot)
+
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def user(updates):
+        nonlocal errors
+        async with semaphore:
+            for update in updates:
+                start = time.perf_counter()
+                try:
+                    await app.dp.feed_raw_update(app.bot, update)
+                except Exception:
+                    errors += 1
+                latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(user(updates) for updates in script))
+    elapsed = time.perf_counter() - start
+
+    await app.dp.emit_shutdown(bot=app.bot)
+    await runner.cleanup()
+
+    latencies.sort()
+    return {
+        'updates': len(latencies),
+        'errors': errors,
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': latencies[-1] * 1000,
+        'peak_rss_mb': peak_rss_mb(),
+        'bot_api_calls': dict(app.bot.session.calls),
+    }
+
+
+def run_scenario(name, template, args):
+    workdir = tempfile.mkdtemp()
+    db_path = os.path.join(workdir, 'users.db')
+    shutil.copy(template, db_path)
+    env = dict(
+        os.environ,
+        DB_PATH=db_path,
+        PRODUCTS_DB_PATH=os.path.join(workdir, 'products.db'),
+        CHART_CACHE_DIR=os.path.join(workdir, 'charts'),
+        BOT_TOKEN=TOKEN,
+        OPENWEATHER_API_KEY='bench',
+        METRICS_PORT='0',
+        WATER_JOB_HOUR='-1',
+        CHART_PREWARM_DELAY='-1',
+        # сценарии шлют апдейты быстрее живого человека, лимитер не должен мешать
+        THROTTLE_RATE='1000000',
+        THROTTLE_BURST='1000000',
+    )
+    command = [sys.executable, '-m', 'benchmarks.bench_suite', '--child', name,
+               '--users', str(args.users), '--active', str(args.active), '--seed', str(args.seed),
+               '--concurrency', str(args.concurrency), '--api-latency', str(args.api_latency)]
+    try:
+        output = subprocess.run(command, env=env, capture_output=True, text=True, check=True).stdout
+    except subprocess.CalledProcessError as e:
+        print(e.stderr[-2000:], file=sys.stderr)
+        raise
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_table(results):
+    print(f'{"scenario":16s} {"updates":>8s} {"upd/sec":>9s} {"p50 ms":>8s} {"p95 ms":>8s} '
+          f'{"p99 ms":>8s} {"RSS MB":>8s} {"errors":>7s}')
+    for name, result in results.items():
+        print(f'{name:16s} {result["updates"]:8d} {result["throughput"]:9.0f} {result["p50_ms"]:8.2f} '
+              f'{result["p95_ms"]:8.2f} {result["p99_ms"]:8.2f} {result["peak_rss_mb"]:8.1f} {result["errors"]:7d}')
+
+
+def compare(old_path, new_path):
+    with open(old_path) as file:
+        old = json.load(file)['scenarios']
+    with open(new_path) as file:
+        new = json.load(file)['scenarios']
+    print(f'{"scenario":16s} {"upd/sec":>18s} {"p95 ms":>18s} {"p99 ms":>18s} {"RSS MB":>18s}')
+    for name in new:
+        if name not in old:
+            continue
+        cells = []
+        for key in ('throughput', 'p95_ms', 'p99_ms', 'peak_rss_mb'):
+            before, after = old[name][key], new[name][key]
+            change = (after - before) / before * 100 if before else 0
+            cells.append(f'{after:9.1f} ({change:+5.0f}%)')
+        print(f'{name:16s} ' + ' '.join(f'{cell:>18s}' for cell in cells))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=10000, help='пользователей в синтетической базе')
+    parser.add_argument('--days', type=int, default=365, help='дней истории у каждого пользователя')
+    parser.add_argument('--active', type=int, default=300, help='пользователей, отправляющих апдейты')
+    parser.add_argument('--concurrency', type=int, default=64, help='одновременно активных пользователей')
+    parser.add_argument('--api-latency', type=float, default=0.05, help='задержка фейковых внешних API, с')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'tgbot-bench-data'))
+    parser.add_argument('--output', help=f'JSON с результатами (по умолчанию {RESULTS_DIR}/suite-<время>.json)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return 0
+
+    if args.child:
+        args.scenario = args.child
+        print(json.dumps(asyncio.run(replay(args))))
+        return 0
+
+    start = time.perf_counter()
+    template = dataset.ensure(args.data_dir, args.users, args.days, args.seed)
+    print(f'dataset {template} ready in {time.perf_counter() - start:.1f} s')
+
+    results = {}
+    for name in args.scenarios.split(','):
+        results[name] = run_scenario(name, template, args)
+        print(f'{name}: {results[name]["throughput"]:.0f} updates/sec')
+    print_table(results)
+
+    output = args.output or os.path.join(RESULTS_DIR, time.strftime('suite-%Y%m%d-%H%M%S.json'))
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as file:
+        json.dump({
+            'meta': {
+                'commit': git_commit(),
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': os.cpu_count(),
+                'params': {key: value for key, value in vars(args).items()
+                           if key not in ('compare', 'child', 'output', 'data_dir')},
+            },
+            'scenarios': results,
+        }, file, indent=2)
+    print(f'results: {output}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,139 @@
+"""
+Один пользователь заваливает бота. Сначала одновременные нажатия
+"За неделю" и одинаковые /log_food в пределах лимита: нажатия
+склеиваются и график рендерится один раз; /log_food - запись, каждая
+обрабатывается и получает ответ, но запрос к OpenFoodFacts уходит
+один (склейка поиска в ProductCatalog). Затем поток из N запросов
+сверх лимита: лишние отсекаются до хэндлеров.
+
+    python -m benchmarks.bench_throttling --burst 300
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import datetime
+import tempfile
+
+from benchmarks.fake_telegram import FakeTelegram
+from benchmarks.bench_webhook import TOKEN, make_update
+
+USER_ID = 42
+SPAMMER_ID = 43
+
+
+def make_callback(update_id, user_id, data):
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id),
+            'chat_instance': '1',
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench'},
+            'message': {
+                'message_id': 1,
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private'},
+            },
+            'data': data,
+        },
+    }
+
+
+async def run(args):
+    fake = FakeTelegram()
+    os.environ['TELEGRAM_API_URL'] = await fake.start()
+    import bot as app
+    from bot import db
+
+    db.init_db()
+    profile = {'weight': 70, 'height': 180, 'age': 30, 'activity': 30,
+               'city': 'Moscow', 'water_norm': 2400, 'calories_norm': 2500}
+    db.save_profiles_data(USER_ID, profile)
+    db.log_water(USER_ID, datetime.date.today(), 500)
+
+    renders = 0
+    render = app.chart_renderer.render
+
+    async def counted_render(series):
+        nonlocal renders
+        renders += 1
+        await asyncio.sleep(0.2)
+        return await render(series)
+
+    async def fetch_remote(product_name):
+        await asyncio.sleep(0.2)
+        return {'name': product_name, 'calories_per_100g': 52}
+
+    app.chart_renderer.render = counted_render
+    app.products.fetch_remote = fetch_remote
+    remote = 0
+    original = app.products._lookup_remote
+
+    async def counted_lookup(product_name, key):
+        nonlocal remote
+        remote += 1
+        return await original(product_name, key)
+
+    app.products._lookup_remote = counted_lookup
+
+    update_id = 0
+
+    def next_id():
+        nonlocal update_id
+        update_id += 1
+        return update_id
+
+    # одинаковые запросы в пределах лимита склеиваются
+    duplicates = 3
+    replies = fake.sent()
+    await asyncio.gather(
+        *(app.dp.feed_raw_update(app.bot, make_callback(next_id(), USER_ID, 'btn_week')) for _ in range(duplicates)),
+        *(app.dp.feed_raw_update(app.bot, make_update(next_id(), USER_ID, '/log_food синтетический'))
+          for _ in range(duplicates)),
+    )
+    replies = fake.sent() - replies
+    print(f'{duplicates} x btn_week + {duplicates} x /log_food: '
+          f'chart renders {renders}, OpenFoodFacts lookups {remote}, replies {replies}')
+    assert renders == 1 and remote == 1 and replies >= 1 + duplicates, (renders, remote, replies)
+
+    # поток сверх лимита
+    commands = ['/help', '/check_progress', '/log_food синтетический']
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        app.dp.feed_raw_update(app.bot, make_update(next_id(), SPAMMER_ID, commands[index % len(commands)]))
+        for index in range(args.burst)
+    ))
+    elapsed = time.perf_counter() - start
+
+    stats = app.throttling.stats()
+    await app.dp.emit_shutdown(bot=app.bot)
+    await app.bot.session.close()
+    await fake.stop()
+
+    print(f'{args.burst} updates from one user in {elapsed * 1000:.0f} ms')
+    print(f"passed {stats['passed']}, throttled {stats['throttled']}, coalesced {stats['coalesced']}")
+    for command, counts in sorted(stats['commands'].items()):
+        print(f'  {command:12s} {dict(counts)}')
+    print(f"Bot API calls: {dict(fake.calls)}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--burst', type=int, default=300)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    os.environ.update(
+        DB_PATH=os.path.join(workdir, 'users.db'),
+        PRODUCTS_DB_PATH=os.path.join(workdir, 'products.db'),
+        CHART_CACHE_DIR=os.path.join(workdir, 'charts'),
+        BOT_TOKEN=TOKEN,
+        OPENWEATHER_API_KEY='bench',
+    )
+    asyncio.run(run(args))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
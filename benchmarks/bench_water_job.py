@@ -0,0 +1,133 @@
+"""
+Пересчет норм воды по погоде на синтетической базе: время задачи,
+число запросов погоды (по одному на город) и задержка event loop,
+пока задача работает. Параллельно поток пишет воду и сбрасывает
+буфер, как бот: самый долгий flush показывает, как долго задача
+держит блокировку записи. Половина городов фейкового сервера "жаркие".
+
+Синтетическая база содержит историю до вчерашнего дня, поэтому
+пересчет делается за вчера - так обновляются существующие строки.
+
+    python -m benchmarks.bench_water_job --users 200000
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import datetime
+import tempfile
+import threading
+
+from aiohttp import web
+
+from benchmarks import dataset
+
+
+async def start_fake_weather(latency):
+    hits = []
+
+    async def handle(request):
+        city = request.query['q']
+        hits.append(city)
+        await asyncio.sleep(latency)
+        hot = dataset.CITIES.index(city) % 2 == 0 if city in dataset.CITIES else False
+        return web.json_response({'cod': 200, 'name': city, 'main': {'temp': 31.0 if hot else 18.0}})
+
+    app = web.Application()
+    app.router.add_get('/weather', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner, f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/weather', hits
+
+
+async def run(args, path):
+    runner, url, hits = await start_fake_weather(args.latency)
+    import bd_operations as db
+    import norms
+    from weather import WeatherClient
+
+    weather = WeatherClient('bench', base_url=url)
+    yesterday = datetime.date.today() - datetime.timedelta(days=1)
+    before = db.get_connection().execute(
+        'SELECT SUM(water_norm) FROM daily_statistics WHERE date = ?', (str(yesterday), )
+    ).fetchone()[0]
+
+    # задержка event loop, пока идет пересчет
+    lags = []
+    stop = asyncio.Event()
+
+    async def ticker(interval=0.01):
+        loop = asyncio.get_running_loop()
+        while not stop.is_set():
+            started = loop.time()
+            await asyncio.sleep(interval)
+            lags.append(loop.time() - started - interval)
+
+    # запись бота во время пересчета: log_water и flush каждые 50 мс
+    flushes = []
+    errors = []
+
+    def writer():
+        today = datetime.date.today()
+        user_id = 0
+        while not stop.is_set():
+            user_id = user_id % args.users + 1
+            db.log_water(user_id, today, 250)
+            started = time.perf_counter()
+            try:
+                db.flush()
+            except Exception as error:
+                errors.append(error)
+            flushes.append(time.perf_counter() - started)
+            time.sleep(0.05)
+
+    writer_thread = threading.Thread(target=writer)
+    ticker_task = asyncio.create_task(ticker())
+    writer_thread.start()
+    start = time.perf_counter()
+    result = await norms.recalculate_water_norms(weather, yesterday, args.concurrency)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await ticker_task
+    writer_thread.join()
+
+    again = await norms.recalculate_water_norms(weather, yesterday, args.concurrency)
+    after = db.get_connection().execute(
+        'SELECT SUM(water_norm) FROM daily_statistics WHERE date = ?', (str(yesterday), )
+    ).fetchone()[0]
+    await weather.close()
+    await runner.cleanup()
+
+    lags.sort()
+    print(f'{result["users"]} users, {result["cities"]} cities: {elapsed:.2f} s, '
+          f'{len(hits)} weather requests, {result["changed"]} users adjusted')
+    print(f'event loop lag while running: p50 {lags[len(lags) // 2] * 1000:.1f} ms, '
+          f'p99 {lags[int(len(lags) * 0.99)] * 1000:.1f} ms, max {lags[-1] * 1000:.1f} ms')
+    print(f'concurrent flushes: {len(flushes)}, max {max(flushes) * 1000:.1f} ms, errors {len(errors)}')
+    print(f'water_norm sum for {yesterday}: {before} -> {after}')
+    print(f'second run changed {again["changed"]} users (idempotent)')
+    assert len(hits) == result['cities'] and again['changed'] == 0 and not errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200000)
+    parser.add_argument('--days', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.2, help='задержка фейкового API погоды, с')
+    parser.add_argument('--concurrency', type=int, default=10)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    path = os.path.join(workdir, 'users.db')
+    start = time.perf_counter()
+    dataset.generate(path, args.users, args.days)
+    print(f'dataset: {time.perf_counter() - start:.1f} s')
+    asyncio.run(run(args, path))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
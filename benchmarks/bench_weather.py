@@ -0,0 +1,74 @@
+"""
+Проверка клиента погоды на локальном фейковом сервере OpenWeatherMap:
+N одновременных запросов одного города должны дать один запрос наружу,
+повторные - обслуживаться из кэша.
+
+    python -m benchmarks.bench_weather --lookups 1000 --cities 10
+"""
+import sys
+import time
+import asyncio
+import argparse
+
+from aiohttp import web
+
+from weather import WeatherClient
+
+
+async def start_fake_server(latency):
+    hits = []
+
+    async def handle(request):
+        hits.append(request.query['q'])
+        await asyncio.sleep(latency)
+        return web.json_response({'cod': 200, 'name': request.query['q'], 'main': {'temp': 27.5}})
+
+    app = web.Application()
+    app.router.add_get('/data/2.5/weather', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f'http://127.0.0.1:{port}/data/2.5/weather', hits
+
+
+async def run(args):
+    runner, url, hits = await start_fake_server(args.latency)
+    client = WeatherClient('test-key', base_url=url)
+    cities = [f'City{i}' for i in range(args.cities)]
+
+    start = time.perf_counter()
+    temps = await asyncio.gather(*(
+        client.get_current_temperature(cities[i % args.cities]) for i in range(args.lookups)
+    ))
+    cold = time.perf_counter() - start
+
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        client.get_current_temperature(cities[i % args.cities]) for i in range(args.lookups)
+    ))
+    warm = time.perf_counter() - start
+
+    await client.close()
+    await runner.cleanup()
+
+    if len(hits) != args.cities or set(temps) != {27.5}:
+        raise AssertionError(f'expected {args.cities} upstream requests, got {len(hits)}')
+    print(f'{args.lookups} concurrent lookups, {args.cities} cities: {len(hits)} upstream requests')
+    print(f'cold: {args.lookups / cold:10.0f} lookups/sec, warm: {args.lookups / warm:10.0f} lookups/sec')
+    print(f'cache: {client.cache.stats()}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lookups', type=int, default=1000)
+    parser.add_argument('--cities', type=int, default=10)
+    parser.add_argument('--latency', type=float, default=0.05)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
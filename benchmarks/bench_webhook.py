@@ -0,0 +1,150 @@
+"""
+Нагрузочный тест режима webhook: поднимает фейковый Bot API, один или
+несколько экземпляров bot.py (BOT_MODE=webhook) и шлет им синтетические
+Update по кругу, как балансировщик.
+
+    python -m benchmarks.bench_webhook --updates 2000 --instances 2
+"""
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import aiohttp
+
+from benchmarks.fake_telegram import FakeTelegram
+
+SECRET = 'bench-secret'
+TOKEN = '123456:BENCHBENCHBENCHBENCHBENCHBENCHBENCH'
+COMMANDS = ['/help', '/check_progress', '/log_water 250', '/show_profile']
+
+
+def make_update(update_id, user_id, text):
+    command = text.split(' ')[0]
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'bench'},
+            'text': text,
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(command)}],
+        },
+    }
+
+
+def start_instances(count, api_url, workdir, base_port):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(
+        os.environ,
+        BOT_TOKEN=TOKEN,
+        OPENWEATHER_API_KEY='bench',
+        TELEGRAM_API_URL=api_url,
+        BOT_MODE='webhook',
+        WEBHOOK_URL='',
+        WEBHOOK_SECRET=SECRET,
+        WEBAPP_HOST='127.0.0.1',
+        DB_PATH=os.path.join(workdir, 'users.db'),
+        # нагрузка идет от небольшого числа пользователей: троттлинг
+        # отбросил бы апдейты без ответа, и тест ждал бы их до таймаута
+        THROTTLE_RATE='1000000',
+        THROTTLE_BURST='1000000',
+    )
+    processes = []
+    for index in range(count):
+        env['PORT'] = str(base_port + index)
+        # логи экземпляров пишутся в рабочий каталог теста
+        with open(os.path.join(workdir, f'bot-{index}.log'), 'w') as log:
+            processes.append(subprocess.Popen(
+                [sys.executable, os.path.join(root, 'bot.py')],
+                cwd=workdir, env=dict(env), stdout=log, stderr=subprocess.STDOUT,
+            ))
+    return processes
+
+
+async def wait_healthy(session, urls, timeout=30):
+    deadline = time.monotonic() + timeout
+    for url in urls:
+        while True:
+            try:
+                async with session.get(url + '/health') as response:
+                    if response.status == 200:
+                        break
+            except aiohttp.ClientError:
+                pass
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'{url} did not become healthy')
+            await asyncio.sleep(0.2)
+
+
+async def run(args):
+    workdir = tempfile.mkdtemp()
+    fake = FakeTelegram()
+    api_url = await fake.start()
+    processes = start_instances(args.instances, api_url, workdir, args.port)
+    urls = [f'http://127.0.0.1:{args.port + index}' for index in range(args.instances)]
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            await wait_healthy(session, urls)
+
+            # неверный секрет должен отклоняться
+            async with session.post(urls[0] + '/webhook', json=make_update(0, 1, '/help')) as response:
+                assert response.status == 401, response.status
+
+            rng = random.Random(1)
+            semaphore = asyncio.Semaphore(args.concurrency)
+            latencies = []
+            fake.expected = args.updates
+
+            async def post(update_id):
+                update = make_update(update_id, rng.randrange(1, args.users + 1), rng.choice(COMMANDS))
+                async with semaphore:
+                    start = time.perf_counter()
+                    async with session.post(
+                        urls[update_id % len(urls)] + '/webhook', json=update,
+                        headers={'X-Telegram-Bot-Api-Secret-Token': SECRET},
+                    ) as response:
+                        await response.read()
+                    latencies.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            await asyncio.gather(*(post(update_id) for update_id in range(1, args.updates + 1)))
+            accepted = time.perf_counter() - start
+            await asyncio.wait_for(fake.done.wait(), timeout=120)
+            handled = time.perf_counter() - start
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        await fake.stop()
+
+    latencies.sort()
+    print(f'{args.instances} instance(s), {args.updates} updates')
+    print(f'accepted: {args.updates / accepted:8.0f} updates/sec, '
+          f'p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, '
+          f'p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms')
+    print(f'handled:  {args.updates / handled:8.0f} updates/sec (replies seen by fake Bot API)')
+    print(f'instance logs: {workdir}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--instances', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--port', type=int, default=18080)
+    args = parser.parse_args()
+    asyncio.run(run(args))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+"""
+Бенчмарк буфера отложенной записи: количество коммитов (fsync) и ops/sec
+при записи каждого приращения сразу и с буфером. Что сброшенные
+приращения переживают SIGKILL, проверяет benchmarks/test_storage.py.
+
+    python -m benchmarks.bench_write_behind --ops 20000
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import datetime
+import tempfile
+
+
+def seed_profiles(db, users):
+    for user_id in range(users):
+        db.save_profiles_data(user_id, {
+            'weight': 70, 'height': 175, 'age': 30, 'activity': 30,
+            'city': 'Moscow', 'water_norm': 2600, 'calories_norm': 2500,
+        })
+
+
+def run_workload(db, users, ops, interval):
+    db.DB_FLUSH_INTERVAL = interval
+    date = datetime.date.today()
+    flushes = db.write_stats['flushes']
+
+    start = time.perf_counter()
+    for _ in range(ops):
+        db.log_water(random.randrange(users), date, 250)
+    db.flush()
+    elapsed = time.perf_counter() - start
+
+    commits = ops if interval <= 0 else db.write_stats['flushes'] - flushes
+    return ops / elapsed, commits
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--ops', type=int, default=20000)
+    parser.add_argument('--interval', type=float, default=2.0)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp()
+    os.environ['DB_PATH'] = os.path.join(workdir, 'bench.db')
+    import bd_operations as db
+
+    db.init_db()
+    seed_profiles(db, args.users)
+
+    direct_rate, direct_commits = run_workload(db, args.users, args.ops, 0)
+    buffered_rate, buffered_commits = run_workload(db, args.users, args.ops, args.interval)
+    print(f'write-through: {direct_rate:10.0f} ops/sec, {direct_commits:6d} commits')
+    print(f'write-behind:  {buffered_rate:10.0f} ops/sec, {buffered_commits:6d} commits')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
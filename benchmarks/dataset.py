@@ -0,0 +1,106 @@
+"""
+Синтетическая база users.db: N пользователей с профилями и историей
+за D дней (ежедневная статистика и помесячные суммы). Данные
+детерминированы seed'ом, чтобы прогоны были сравнимы.
+
+    python -m benchmarks.dataset --users 10000 --days 365 --out users.db
+"""
+import os
+import sys
+import time
+import random
+import sqlite3
+import argparse
+import datetime
+
+CITIES = ['Moscow', 'Saint Petersburg', 'Novosibirsk', 'Yekaterinburg', 'Kazan',
+          'Nizhny Novgorod', 'Chelyabinsk', 'Samara', 'Omsk', 'Rostov-on-Don',
+          'Ufa', 'Krasnoyarsk', 'Voronezh', 'Perm', 'Volgograd', 'Krasnodar',
+          'Sochi', 'Tyumen', 'Irkutsk', 'Vladivostok']
+
+
+def generate(path, users, days, seed=1, batch_size=50000):
+    """
+    Создает базу по пути path. Схему создает bd_operations.init_db,
+    поэтому база всегда соответствует текущему коду.
+    """
+    if os.path.exists(path):
+        os.remove(path)
+    os.environ['DB_PATH'] = path
+    import bd_operations as db
+
+    db.close_connections()
+    db.DB_PATH = path
+    # база пустая, онлайн-миграции проходят сразу
+    db.init_db(online=True)
+    rng = random.Random(seed)
+    connection = db.get_connection()
+    today = datetime.date.today()
+
+    profiles = []
+    for user_id in range(1, users + 1):
+        weight = rng.randint(50, 110)
+        height = rng.randint(155, 200)
+        age = rng.randint(18, 70)
+        activity = rng.choice([0, 15, 30, 45, 60, 90])
+        water_norm = (weight * 30 + 500 * (activity // 30) + 99) // 100 * 100
+        calories_norm = int((10 * weight + 6.25 * height - 5 * age + (activity // 30) * 300 + 99) // 100 * 100)
+        profiles.append((user_id, weight, height, age, activity, rng.choice(CITIES), water_norm, calories_norm))
+
+    with connection:
+        connection.executemany('INSERT INTO profiles VALUES (?, ?, ?, ?, ?, ?, ?, ?)', profiles)
+
+    def rows():
+        for user_id, weight, _, _, _, _, water_norm, calories_norm in profiles:
+            for offset in range(days, 0, -1):
+                # пользователи пропускают часть дней
+                if rng.random() < 0.2:
+                    continue
+                yield (user_id, str(today - datetime.timedelta(days=offset)),
+                       rng.randint(0, water_norm + 500), rng.randint(0, 800),
+                       rng.randint(800, calories_norm + 600), water_norm, calories_norm)
+
+    batch = []
+    with connection:
+        for row in rows():
+            batch.append(row)
+            if len(batch) >= batch_size:
+                connection.executemany('INSERT INTO daily_statistics VALUES (?, ?, ?, ?, ?, ?, ?)', batch)
+                batch = []
+        connection.executemany('INSERT INTO daily_statistics VALUES (?, ?, ?, ?, ?, ?, ?)', batch)
+        connection.execute('DELETE FROM monthly_statistics')
+        connection.execute(db.REFRESH_MONTHLY_STATISTICS_ALL)
+    connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    db.close_connections()
+
+
+def ensure(directory, users, days, seed=1):
+    """
+    Путь к базе с заданными параметрами; генерирует ее при первом обращении.
+    """
+    path = os.path.join(directory, f'users-{users}x{days}-{seed}.db')
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        generate(path + '.tmp', users, days, seed)
+        os.replace(path + '.tmp', path)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', default='users.db')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    generate(args.out, args.users, args.days, args.seed)
+    rows = sqlite3.connect(args.out).execute('SELECT COUNT(*) FROM daily_statistics').fetchone()[0]
+    print(f'{args.out}: {args.users} users, {rows} daily rows, '
+          f'{os.path.getsize(args.out) / 2 ** 20:.1f} MB in {time.perf_counter() - start:.1f} s')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
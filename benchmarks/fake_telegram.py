@@ -0,0 +1,108 @@
+"""
+Фейковый Bot API для нагрузочных тестов: отвечает на любой метод
+минимальным успешным результатом и считает вызовы. FakeTelegram -
+HTTP-сервер (для bot.py в отдельном процессе), FakeSession - сессия
+aiogram без сети (для прогона апдейтов через Dispatcher в том же процессе).
+"""
+import json
+import time
+import asyncio
+from collections import Counter, deque
+
+from aiohttp import web
+from aiogram.client.session.base import BaseSession
+
+# Минимальные ответы, которые aiogram сможет разобрать
+BOOL_METHODS = {'answercallbackquery', 'setwebhook', 'deletewebhook'}
+
+
+def fake_message(chat_id, with_photo=False):
+    message = {
+        'message_id': 1,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+    }
+    if with_photo:
+        message['photo'] = [{'file_id': f'photo-{chat_id}', 'file_unique_id': 'u', 'width': 1, 'height': 1}]
+    return message
+
+
+def fake_result(method, chat_id):
+    if method in BOOL_METHODS:
+        return True
+    if method == 'getme':
+        return {'id': 1, 'is_bot': True, 'first_name': 'bench'}
+    return fake_message(chat_id, with_photo=method == 'sendphoto')
+
+
+class FakeSession(BaseSession):
+    def __init__(self):
+        super().__init__()
+        self.calls = Counter()
+
+    async def make_request(self, bot, method, timeout=None):
+        name = method.__api_method__.lower()
+        self.calls[name] += 1
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None and getattr(method, 'message', None) is not None:
+            chat_id = method.message.chat.id
+        content = json.dumps({'ok': True, 'result': fake_result(name, chat_id or 0)})
+        response = self.check_response(bot=bot, method=method, status_code=200, content=content)
+        return response.result
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b''
+
+    async def close(self):
+        pass
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.calls = Counter()
+        self.done = asyncio.Event()
+        self.expected = None
+        # апдейты, которые будут отданы через getUpdates
+        self.updates = deque()
+        self.first_sent_at = None
+        self._runner = None
+        self.url = None
+
+    async def handle(self, request):
+        method = request.match_info['method'].lower()
+        self.calls[method] += 1
+        data = await request.post()
+        chat_id = int(data.get('chat_id') or 0)
+
+        if method == 'getupdates':
+            offset = int(data.get('offset') or 0)
+            while self.updates and self.updates[0]['update_id'] < offset:
+                self.updates.popleft()
+            if not self.updates:
+                await asyncio.sleep(0.5)
+            result = [self.updates[i] for i in range(min(100, len(self.updates)))]
+        else:
+            result = fake_result(method, chat_id)
+            if method.startswith('send') and self.first_sent_at is None:
+                self.first_sent_at = time.perf_counter()
+
+        if self.expected is not None and self.sent() >= self.expected:
+            self.done.set()
+        return web.json_response({'ok': True, 'result': result})
+
+    def sent(self):
+        return sum(count for method, count in self.calls.items() if method.startswith('send'))
+
+    async def start(self, host='127.0.0.1', port=0):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f'http://{host}:{port}'
+        return self.url
+
+    async def stop(self):
+        await self._runner.cleanup()
@@ -0,0 +1,228 @@
+"""
+Проверки корректности слоя хранения, которые раньше запускались
+флагами бенчмарков (bench_storage --stress, bench_write_behind --crash):
+бенчмарки теперь только меряют. У каждого теста своя временная база.
+
+    python -m pytest -q benchmarks
+"""
+import os
+import sys
+import time
+import signal
+import sqlite3
+import asyncio
+import datetime
+import tempfile
+import threading
+import subprocess
+
+import pytest
+
+from benchmarks.bench_storage import seed_profiles
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKDIR = tempfile.mkdtemp()
+# до импорта модулей бота: пути по умолчанию указывают в корень репозитория
+os.environ.update(
+    DB_PATH=os.path.join(WORKDIR, 'users.db'),
+    PRODUCTS_DB_PATH=os.path.join(WORKDIR, 'products.db'),
+    CHART_CACHE_DIR=os.path.join(WORKDIR, 'charts'),
+    BOT_TOKEN='123456:ABCdefGhIJKlmnoPQRstuVWXyz',
+    OPENWEATHER_API_KEY='test',
+    REMINDERS_ENABLED='0',
+)
+
+USERS = 20
+DATE = datetime.date(2000, 1, 1)
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    import bd_operations as db
+
+    monkeypatch.setattr(db, 'DB_PATH', str(tmp_path / 'users.db'))
+    monkeypatch.setattr(db, 'DB_FLUSH_INTERVAL', 0)
+    db.close_connections()
+    db.profiles_cache.clear()
+    db.init_db()
+    seed_profiles(db, USERS)
+    yield db
+    db.flush()
+    db.close_connections()
+    db.profiles_cache.clear()
+
+
+@pytest.mark.parametrize('interval', [0, 0.01])
+def test_parallel_increments_are_not_lost(db, interval):
+    db.DB_FLUSH_INTERVAL = interval
+    threads, per_thread = 8, 200
+
+    def writer():
+        for i in range(per_thread):
+            user_id = i % USERS
+            db.log_water(user_id, DATE, 1)
+            db.log_food(user_id, DATE, 2)
+            db.log_workout(user_id, DATE, 3, 4)
+
+    workers = [threading.Thread(target=writer) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    count = threads * per_thread // USERS
+    for user_id in range(USERS):
+        data = db.get_daily_statistics(user_id, DATE)
+        actual = (data['water_as_is'], data['calories_consumed'], data['calories_burned'], data['water_norm'])
+        assert actual == (count, 2 * count, 3 * count, 2600 + 4 * count), user_id
+
+
+def crash_child(path, users):
+    # процесс-писатель для test_flushed_increments_survive_sigkill
+    import random
+    import bd_operations as db
+
+    db.DB_PATH = path
+    flushes = 0
+    while True:
+        db.log_water(random.randrange(users), DATE, 1)
+        if db.write_stats['flushes'] != flushes:
+            flushes = db.write_stats['flushes']
+            print(db.write_stats['increments'], flush=True)
+
+
+def test_flushed_increments_survive_sigkill(db):
+    db.close_connections()
+    env = dict(os.environ, DB_FLUSH_INTERVAL='0.2')
+    child = subprocess.Popen(
+        [sys.executable, '-c', f'from benchmarks.test_storage import crash_child; crash_child({db.DB_PATH!r}, {USERS})'],
+        stdout=subprocess.PIPE, env=env, cwd=ROOT, text=True,
+    )
+    # убиваем посреди нагрузки, когда хотя бы один сброс уже прошел
+    durable = [int(child.stdout.readline())]
+    time.sleep(1)
+    child.send_signal(signal.SIGKILL)
+    durable += [int(line) for line in child.stdout.read().split()]
+    child.wait()
+
+    connection = sqlite3.connect(db.DB_PATH)
+    integrity = connection.execute('PRAGMA integrity_check').fetchone()[0]
+    total = connection.execute(
+        'SELECT COALESCE(SUM(water_as_is), 0) FROM daily_statistics WHERE date = ?', (str(DATE), )
+    ).fetchone()[0]
+    connection.close()
+
+    assert integrity == 'ok'
+    # коммит мог успеть перед SIGKILL, но не успеть напечататься
+    assert total >= durable[-1]
+
+
+@pytest.mark.parametrize('interval', [0, 60])
+def test_redelivered_update_is_counted_once(db, interval):
+    db.DB_FLUSH_INTERVAL = interval
+    assert db.log_water(1, DATE, 250, update_id=10)
+    assert not db.log_water(1, DATE, 250, update_id=10)
+    db.flush()
+    # повтор после сброса буфера отсекает уже уникальный индекс в БД
+    db.log_water(1, DATE, 250, update_id=10)
+    db.flush()
+    # тот же update_id у другого пользователя - другой апдейт
+    assert db.log_water(2, DATE, 250, update_id=10)
+
+    assert db.get_daily_statistics(1, DATE)['water_as_is'] == 250
+    assert db.get_daily_statistics(2, DATE)['water_as_is'] == 250
+
+
+def test_undo_reverts_whole_update(db):
+    db.DB_FLUSH_INTERVAL = 60
+    db.log_water(1, DATE, 250, update_id=1)
+    db.log_workout(1, DATE, 300, 500, update_id=2)
+
+    assert db.undo_last_entry(1, DATE, update_id=3) == [('workout', 300), ('water_norm', 500)]
+    # повтор того же /undo не отменяет следующую запись
+    assert db.undo_last_entry(1, DATE, update_id=3) == [('workout', 300), ('water_norm', 500)]
+    data = db.get_daily_statistics(1, DATE)
+    assert (data['water_as_is'], data['calories_burned'], data['water_norm']) == (250, 0, 2600)
+
+    assert db.undo_last_entry(1, DATE, update_id=4) == [('water', 250)]
+    assert db.undo_last_entry(1, DATE, update_id=5) == []
+    assert db.get_daily_statistics(1, DATE)['water_as_is'] == 0
+
+
+@pytest.mark.parametrize('text, expected', [
+    ('яблоко 150, куриная грудка 200 г', [('яблоко', 150), ('куриная грудка', 200)]),
+    ('молоко 2,5% 200', [('молоко 2,5%', 200)]),
+    ('хлеб 50гр; сыр\nчай 200 g.', [('хлеб', 50), ('сыр', None), ('чай', 200)]),
+    ('банан,, ', [('банан', None)]),
+])
+def test_parse_meal(text, expected):
+    from bot import parse_meal
+
+    assert parse_meal(text) == expected
+
+
+def storage_key(user_id):
+    from aiogram.fsm.storage.base import StorageKey
+
+    return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+
+def test_fsm_state_survives_restart(db):
+    from fsm_storage import SQLiteStorage
+
+    async def run():
+        storage = SQLiteStorage()
+        await storage.set_state(storage_key(1), 'Product:calories')
+        await storage.set_data(storage_key(1), {'product_name': 'яблоко'})
+        await storage.set_state(storage_key(2), 'Profile:weight')
+        await storage.set_state(storage_key(2), None)
+        await storage.close()
+
+        restarted = SQLiteStorage()
+        return (await restarted.get_state(storage_key(1)), await restarted.get_data(storage_key(1)),
+                await restarted.get_state(storage_key(2)))
+
+    assert asyncio.run(run()) == ('Product:calories', {'product_name': 'яблоко'}, None)
+
+
+def test_fsm_batch_is_visible_while_written(db):
+    from fsm_storage import SQLiteStorage
+
+    async def run():
+        storage = SQLiteStorage(flush_interval=0.01)
+        write = storage._write
+
+        def slow_write(batch, purge):
+            time.sleep(0.3)
+            write(batch, purge)
+
+        storage._write = slow_write
+        await storage.set_state(storage_key(1), 'Product:calories')
+        await asyncio.sleep(0.1)
+        during = await storage.get_state(storage_key(1))
+        await storage.close()
+        return during
+
+    assert asyncio.run(run()) == 'Product:calories'
+
+
+def test_fsm_failed_flush_is_retried(db):
+    from fsm_storage import SQLiteStorage
+
+    async def run():
+        storage = SQLiteStorage(flush_interval=0.01)
+        write = storage._write
+        failures = []
+
+        def failing_write(batch, purge):
+            if len(failures) < 2:
+                failures.append(batch)
+                raise sqlite3.OperationalError('database is locked')
+            write(batch, purge)
+
+        storage._write = failing_write
+        await storage.set_data(storage_key(1), {'weight': '70'})
+        await asyncio.sleep(0.2)
+        return await db.run(storage._select, storage._key(storage_key(1)))
+
+    assert asyncio.run(run()) == (None, {'weight': '70'})
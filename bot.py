@@ -1,68 +1,72 @@
+import os
+import re
 import math
 import asyncio
-import aiohttp
+import logging
 import datetime
-import io
+from aiohttp import web
 from aiogram.types import BufferedInputFile
 from aiogram import Router
 from aiogram import Bot, Dispatcher
-from aiogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.types import Message, Update, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.filters import Command
+from aiogram.dispatcher.event.bases import SkipHandler
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-import numpy as np
-import matplotlib.pyplot as plt
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 import bd_operations as db
-
-with open("api.txt", 'r') as file:
-    openweathermap_api_key = file.readline().rstrip()
-    bot_api_key = file.readline().rstrip()
-
-bot = Bot(token=bot_api_key)
-dp = Dispatcher()
-
-async def get_current_temperature(city_name, api_key):
-  url = "http://api.openweathermap.org/data/2.5/weather"
-  params = {
-        'q': city_name,
-        'appid': api_key,
-        'units': 'metric'
-  }
-  try:
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, params=params, timeout=10) as response:
-            return await response.json()
-  except Exception as e:
-        return {"error": str(e), "cod": 500}
-
-
-async def get_product_calories(product_name):
-    url = "https://world.openfoodfacts.org/cgi/search.pl"
-    params = {
-        'search_terms': product_name,
-        'json': 1,
-        'page_size': 1
-    }
-    
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, params=params) as response:
-                data = await response.json()
-                
-                if data.get('products'):
-                    product = data['products'][0]
-                    calories = product.get('nutriments', {}).get('energy-kcal_100g')
-                    
-                    if calories:
-                        return {
-                            'name': product.get('product_name', product_name),
-                            'calories_per_100g': calories
-                        }
-    
-    except:
-        pass
-    
-    return None
+import charts
+import export
+from weather import WeatherClient
+from products import ProductCatalog
+from fsm_storage import SQLiteStorage
+import reminders
+import norms
+from norms import water_norm_calc, calories_norm_calc
+from middlewares import ThrottlingMiddleware, MetricsMiddleware
+import metrics
+
+# Ключи берутся из окружения (Render), иначе из api.txt
+openweathermap_api_key = os.getenv('OPENWEATHER_API_KEY')
+bot_api_key = os.getenv('BOT_TOKEN')
+if not bot_api_key:
+    with open("api.txt", 'r') as file:
+        openweathermap_api_key = file.readline().rstrip()
+        bot_api_key = file.readline().rstrip()
+
+# Режим работы: polling или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL') or os.getenv('RENDER_EXTERNAL_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBAPP_HOST = os.getenv('WEBAPP_HOST', '0.0.0.0')
+WEBAPP_PORT = int(os.getenv('PORT', '8080'))
+# Хранилище FSM: sqlite (переживает рестарты, общее для процессов) или memory
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'sqlite')
+# Число процессов-воркеров (см. sharding.py), 1 - обычный однопроцессный режим
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '1'))
+# Сколько продуктов можно записать одним /log_food
+MEAL_MAX_ITEMS = int(os.getenv('MEAL_MAX_ITEMS', '10'))
+# Собственный сервер Bot API (или фейковый для нагрузочных тестов)
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+
+if TELEGRAM_API_URL:
+    bot = Bot(token=bot_api_key, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=bot_api_key)
+dp = Dispatcher(storage=SQLiteStorage()) if FSM_STORAGE == 'sqlite' else Dispatcher()
+weather = WeatherClient(openweathermap_api_key)
+products = ProductCatalog()
+chart_renderer = charts.ChartRenderer()
+chart_cache = charts.ChartCache()
+reminder_scheduler = reminders.ReminderScheduler(bot)
+throttling = ThrottlingMiddleware()
+dp.message.outer_middleware(throttling)
+dp.callback_query.outer_middleware(throttling)
+dp.message.middleware(MetricsMiddleware())
+dp.callback_query.middleware(MetricsMiddleware())
 
 
 activities_list = {
@@ -84,6 +88,25 @@ activities_list = {
 }
 
 
+# Продукт приема пищи: название и, по желанию, граммы числом в конце
+MEAL_SEPARATOR = re.compile(r'(?<!\d),|,(?!\d)|[;\n]')
+MEAL_ITEM = re.compile(r'^(?P<name>.*?)\s*(?:(?P<grams>\d+)\s*(?:г|гр|грамм|g)?\.?)?$')
+
+
+def parse_meal(text):
+    """
+    "яблоко 150, куриная грудка 200 г" -> [(название, граммы или None)].
+    Продукты разделяются запятой, точкой с запятой или новой строкой;
+    запятая между цифрами - десятичная ("молоко 2,5% 200").
+    """
+    items = []
+    for part in MEAL_SEPARATOR.split(text):
+        match = MEAL_ITEM.match(part.strip())
+        if match[0]:
+            items.append((match['name'], int(match['grams']) if match['grams'] else None))
+    return items
+
+
 class Profile(StatesGroup):
     weight = State()
     height = State()
@@ -109,11 +132,14 @@ async def cmd_help(message: Message):
 /show_profile - Показать данные профиля
 
 /log_water [кол-во мл] - Записать выпитую воду
-/log_food [название продукта] - Добавить съеденную еду
+/log_food [продукт] [граммы], ... - Добавить съеденную еду
 /log_workout [тип тренировки] [время в мин] - Записать тренировку
+/undo - Отменить последнюю запись за сегодня
 
 /check_progress - Текущий прогресс за день
 /show_statistics - Графики за неделю/месяц/год
+/reminders [часы|off] - Напоминать, если отстаю от нормы
+/export [csv|parquet] - Выгрузить историю в файл
 
 Типы тренировок:
 ходьба, бег, велосипед, плавание, йога, 
@@ -124,6 +150,7 @@ async def cmd_help(message: Message):
 Примеры использования:
 /log_water 500
 /log_food яблоко
+/log_food яблоко 150, хлеб 50
 /log_workout бег 30
     """
     await message.answer(help_text)
@@ -158,29 +185,6 @@ async def process_activity(message: Message, state: FSMContext):
     await message.answer("Город")
     await state.set_state(Profile.city)
 
-def water_norm_calc(weight, activity, temperature=0):
-    """
-    Базовая норма=Вес×30мл/кг 
-    +500мл  за каждые 30 минут активности.
-    +500−1000мл  за жаркую погоду (> 25°C)
-    """
-
-    norm = weight*30 + 500*(int(activity)//30)
-    if temperature > 25:
-       norm += 750
-
-    return math.ceil(norm / 100) * 100
-
-def calories_norm_calc(weight, height, age, activity):
-    """
-    Норма калорий:
-    Калории=10*Вес (кг)+6.25*Рост (см)-5*Возраст 
-    + (минуты активности / 30) * 300 ккал
-    """
-
-    norm = 10*weight + 6.25*height - 5*age + (activity // 30)*300
-    return math.ceil(norm / 100) * 100
-
 # Завершение заполнения профиля и сохранение данных в БД
 @dp.message(Profile.city)
 async def process_city(message: Message, state: FSMContext):
@@ -196,7 +200,7 @@ async def process_city(message: Message, state: FSMContext):
     water_norm = water_norm_calc(float(weight), float(activity))
     calories_norm = calories_norm_calc(float(weight), float(height), int(age), int(activity))
 
-    db.save_profiles_data(message.from_user.id, {
+    await db.run(db.save_profiles_data, message.from_user.id, {
         'weight': weight,
         'height': height,
         'age': age,
@@ -221,7 +225,7 @@ async def process_city(message: Message, state: FSMContext):
 @dp.message(Command("show_profile"))
 async def cmd_show_profile(message: Message):
     try:
-        data = db.get_profiles_data(message.from_user.id)
+        data = await db.run(db.get_profiles_data, message.from_user.id)
         await message.answer(
             f"Данные пользователя:\n"
             f"Вес: {data['weight']} кг\n"
@@ -232,21 +236,20 @@ async def cmd_show_profile(message: Message):
             f"Норма воды: {data['water_norm']}\n"
             f"Норма калорий: {data['calories_norm']}\n"
             )
-    except:
+    except TypeError:
         await message.answer('По твоему профилю пока что нет данных\nИспользуй /set_profile')
 
 
 @dp.message(Command("test"))
 async def cmd_test(message: Message):
     try:
-        data = db.get_profiles_data(message.from_user.id)
+        data = await db.run(db.get_profiles_data, message.from_user.id)
         city = data['city']
         water_norm = water_norm_calc(data['weight'], data['activity'])
         await message.answer(f'{water_norm}')
         await message.answer(f'{city}')
 
-        weather_info = await get_current_temperature(city, openweathermap_api_key)
-        curr_temp = weather_info.get('main').get('temp')
+        curr_temp = await weather.get_current_temperature(city)
         await message.answer(f'{curr_temp}')
 
         water_norm = water_norm_calc(data['weight'], data['activity'], curr_temp)
@@ -256,61 +259,106 @@ async def cmd_test(message: Message):
         await message.answer(f'{calories_norm}')
 
 
-    except:
+    except TypeError:
         await message.answer('По твоему профилю пока что нет данных\nИспользуй /set_profile')
 
 
 @dp.message(Command("log_water"))
-async def log_water(message: Message):
+async def log_water(message: Message, event_update: Update):
     try:
         user_id = message.from_user.id
         date = datetime.date.today()
         water_delta = int(message.text.split(' ')[1])
-        db.log_water(user_id, date, water_delta)
+        await db.run(db.log_water, user_id, date, water_delta, event_update.update_id)
+        chart_cache.invalidate(user_id)
         await message.answer('Данные сохранены!')
-    except:
+    except (IndexError, ValueError):
+        await message.answer('Укажите количество воды в мл, например: /log_water 500')
+    except LookupError:
         await message.answer('По твоему профилю пока что нет данных\nИспользуй /set_profile')
 
 
 @dp.message(Command("log_food"))
-async def start_food_form(message: Message, state: FSMContext):
-    product_name = message.text.split(' ')[1]
-    product_data = await get_product_calories(product_name)
-    calories_100g = int(product_data['calories_per_100g'])
-    await state.update_data(product_name=product_name, calories_100g=calories_100g)
-    await message.answer(
-        f"{product_name} - {calories_100g} ккал на 100 г.\n"
-        "Сколько грамм вы съели?"
-        )
-    await state.set_state(Product.calories)
+async def start_food_form(message: Message, state: FSMContext, event_update: Update):
+    items = parse_meal(message.text.partition(' ')[2])
+    if not items or not all(name for name, _ in items) or len(items) > MEAL_MAX_ITEMS:
+        await message.answer('Укажите продукты и граммы, например: /log_food яблоко 150, хлеб 50')
+        return
+    if len(items) > 1 and any(grams is None for _, grams in items):
+        await message.answer('Укажите граммы для каждого продукта, например: /log_food яблоко 150, хлеб 50')
+        return
+
+    # все продукты ищутся одновременно
+    found = await products.get_products_calories([name for name, _ in items])
+    missing = [name for (name, _), product in zip(items, found) if product is None]
+    if missing:
+        await message.answer('Не удалось найти: ' + ', '.join(missing))
+        return
+
+    if items[0][1] is None:
+        # один продукт без граммов - спрашиваем их следующим сообщением
+        product_name = items[0][0]
+        calories_100g = int(found[0]['calories_per_100g'])
+        await state.update_data(product_name=product_name, calories_100g=calories_100g)
+        await message.answer(
+            f"{product_name} - {calories_100g} ккал на 100 г.\n"
+            "Сколько грамм вы съели?"
+            )
+        await state.set_state(Product.calories)
+        return
+
+    lines = []
+    total = 0
+    for (name, grams), product in zip(items, found):
+        calories = math.ceil(grams * int(product['calories_per_100g']) / 100)
+        total += calories
+        lines.append(f"{name} {grams} г - {calories} ккал")
+    user_id = message.from_user.id
+    try:
+        # весь прием пищи - одно событие в журнале
+        await db.run(db.log_food, user_id, datetime.date.today(), total, event_update.update_id)
+    except LookupError:
+        await message.answer('По твоему профилю пока что нет данных\nИспользуй /set_profile')
+        return
+    chart_cache.invalidate(user_id)
+    await message.answer("\n".join(lines) + f"\nЗаписано: {total} ккал")
 
 @dp.message(Product.calories)
-async def product_calories(message: Message, state: FSMContext):
+async def product_calories(message: Message, state: FSMContext, event_update: Update):
+    if (message.text or '').startswith('/'):
+        # команда вместо граммов - выходим из диалога и передаем ее дальше
+        await state.clear()
+        raise SkipHandler()
     try:
         user_id = message.from_user.id
         date = datetime.date.today()
         data = await state.get_data()
         calories_100g = data['calories_100g']
         calories = math.ceil(int(message.text) * calories_100g/100)
-        db.log_food(user_id, date, calories)
+        await db.run(db.log_food, user_id, date, calories, event_update.update_id)
+        await state.clear()
+        chart_cache.invalidate(user_id)
         await message.answer(f"Записано: {calories} ккал")
-    except:
+    except (TypeError, ValueError):
+        await message.answer('Введите количество грамм числом, например: 150')
+    except LookupError:
         await message.answer('По твоему профилю пока что нет данных\nИспользуй /set_profile')
         await state.clear()
 
 
 @dp.message(Command("log_workout"))
-async def log_workout(message: Message):
+async def log_workout(message: Message, event_update: Update):
     try:
         user_id = message.from_user.id
         date = datetime.date.today()
         activity_type = message.text.split(' ')[1]
         activity_time = int(message.text.split(' ')[2])
-        data = db.get_profiles_data(message.from_user.id)
+        data = await db.run(db.get_profiles_data, message.from_user.id)
         kkal_delta = math.ceil(activities_list[activity_type] * data['weight'] * activity_time / 60)
         add_water = math.ceil(activity_time / 30)*200
 
-        db.log_workout(user_id, date, kkal_delta, add_water)
+        await db.run(db.log_workout, user_id, date, kkal_delta, add_water, event_update.update_id)
+        chart_cache.invalidate(user_id)
         
         await message.answer(f"{activity_type} {activity_time} минут — {kkal_delta} ккал\n"
                              f"Дополнительно: выпейте {add_water} мл воды.")
@@ -322,17 +370,41 @@ async def log_workout(message: Message):
             f"{activities_text}"
         )
         return 
-    except:
+    except (IndexError, ValueError):
+        await message.answer('Укажите тип и время тренировки, например: /log_workout бег 30')
+    except (TypeError, LookupError):
         await message.answer('По твоему профилю пока что нет данных\nИспользуй /set_profile')
 
 
+# Названия событий журнала для ответа на /undo
+EVENT_NAMES = {
+    'water': ('вода', 'мл'),
+    'food': ('еда', 'ккал'),
+    'workout': ('тренировка', 'ккал'),
+    'water_norm': ('норма воды', 'мл'),
+}
+
+
+@dp.message(Command("undo"))
+async def cmd_undo(message: Message, event_update: Update):
+    user_id = message.from_user.id
+    undone = await db.run(db.undo_last_entry, user_id, datetime.date.today(), event_update.update_id)
+    if not undone:
+        await message.answer('За сегодня отменять нечего')
+        return
+    chart_cache.invalidate(user_id)
+    await message.answer('Отменено: ' + ', '.join(
+        f'{EVENT_NAMES[kind][0]} {amount} {EVENT_NAMES[kind][1]}' for kind, amount in undone
+    ))
+
+
 
 @dp.message(Command("check_progress"))
 async def check_progress(message: Message, state: FSMContext):
     try:
         user_id = message.from_user.id
         date = datetime.date.today()
-        data = db.get_daily_statistics(user_id, date)
+        data = await db.run(db.get_daily_statistics, user_id, date)
         todo_water = max(data['water_norm'] - data['water_as_is'], 0)
         balance = data['calories_consumed'] - data['calories_burned']
 
@@ -344,11 +416,57 @@ async def check_progress(message: Message, state: FSMContext):
                              f"- Сожжено: {data['calories_burned']} ккал\n"
                              f"- Баланс: {balance} ккал\n"
                              )
-    except:
+    except TypeError:
         await message.answer('По твоему профилю пока что нет данных\nИспользуй /set_profile')
 
 
 
+@dp.message(Command("reminders"))
+async def cmd_reminders(message: Message):
+    user_id = message.from_user.id
+    args = message.text.split()[1:]
+    if args and args[0] == 'off':
+        await reminder_scheduler.cancel(user_id)
+        await message.answer('Напоминания выключены')
+        return
+
+    try:
+        hours = float(args[0]) if args else reminders.REMINDER_INTERVAL_HOURS
+    except ValueError:
+        await message.answer('Укажите интервал в часах, например: /reminders 3')
+        return
+    if await db.run(db.get_profiles_data, user_id) is None:
+        await message.answer('По твоему профилю пока что нет данных\nИспользуй /set_profile')
+        return
+
+    next_at = await reminder_scheduler.schedule(user_id, int(max(hours, 0.5) * 3600))
+    await message.answer(
+        f"Буду напоминать каждые {max(hours, 0.5):g} ч, если отстаете от нормы.\n"
+        f"Следующая проверка: {datetime.datetime.fromtimestamp(next_at):%d.%m %H:%M}\n"
+        "Выключить: /reminders off"
+    )
+
+
+@dp.message(Command("export"))
+async def cmd_export(message: Message):
+    user_id = message.from_user.id
+    args = message.text.split()[1:]
+    format = args[0].lower() if args else 'csv'
+    if format not in export.FORMATS:
+        await message.answer('Формат выгрузки: csv или parquet, например: /export csv')
+        return
+    try:
+        export.check_format(format)
+    except RuntimeError as e:
+        await message.answer(str(e))
+        return
+    if not await db.run(export.count_rows, user_id):
+        await message.answer('История пока пустая, выгружать нечего')
+        return
+
+    await message.answer_document(export.ExportFile(user_id, format), caption='История по дням')
+
+
 @router.message(Command("show_statistics"))
 async def show_keyboard(message: Message):
     keyboard = InlineKeyboardMarkup(
@@ -356,83 +474,155 @@ async def show_keyboard(message: Message):
             [InlineKeyboardButton(text="За неделю", callback_data="btn_week")],
             [InlineKeyboardButton(text="За месяц", callback_data="btn_month")],
             [InlineKeyboardButton(text="За год", callback_data="btn_year")],
+            [InlineKeyboardButton(text="За все время", callback_data="btn_all")],
         ]
     )
     await message.answer("Выберите опцию:", reply_markup=keyboard)
 
 
-def plot_stats(df, period='week'):
-    if df.empty:
-        return None
-    
-    # Создаем график
-    fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(12, 10))
-    
-    if period == 'year':
-        dates = df['month'].dt.strftime('%b')
-        water = df['avg_water']
-        water_norm = df['avg_water_norm']
-        calories_cons = df['avg_calories_consumed']
-        calories_burn = df['avg_calories_burned']
-        calories_norm = df['avg_calories_norm']
-    else:
-        df = df.sort_values('date')
-        dates = df['date'].dt.strftime('%d.%m')
-        water = df['water_as_is']
-        water_norm = df['water_norm']
-        calories_cons = df['calories_consumed']
-        calories_burn = df['calories_burned']
-        calories_norm = df['calories_norm']
-    
-    # Вода
-    ax1.bar(dates, water, color='skyblue', label='Выпито')
-    ax1.plot(dates, water_norm, 'b--', label='Норма', marker='o')
-    ax1.set_title('Вода')
-    ax1.set_ylabel('Мл')
-    ax1.legend()
-    
-    # Калории
-    x = np.arange(len(dates))
-    width = 0.35
-    
-    ax2.bar(x - width/2, calories_cons, width, color='lightgreen', label='Потреблено')
-    ax2.bar(x + width/2, calories_burn, width, color='lightcoral', label='Сожжено')
-    ax2.plot(x, calories_norm, 'r--', label='Норма', marker='o')
-    ax2.set_title('Калории')
-    ax2.set_ylabel('Ккал')
-    ax2.set_xticks(x)
-    ax2.set_xticklabels(dates)
-    ax2.legend()
-    
-    buf = io.BytesIO()
-    plt.savefig(buf, format='png')
-    plt.close()
-    return BufferedInputFile(buf.getvalue(), filename='graph.png')
+STATISTICS_PERIODS = {
+    "btn_week": ('week', db.get_week_data, "Статистика за неделю"),
+    "btn_month": ('month', db.get_month_data, "Статистика за месяц"),
+    "btn_year": ('year', db.get_year_data, "Статистика за год"),
+    "btn_all": ('all', db.get_all_time_data, "Статистика за все время"),
+}
 
 
 @router.callback_query()
 async def handle_callback(callback_query):
     user_id = callback_query.from_user.id
-    photo = None
-    
-    if callback_query.data == "btn_week":
-        df = db.get_week_data(user_id)
-        photo = plot_stats(df, 'week')
-        await callback_query.message.answer_photo(photo=photo, caption="Статистика за неделю")
-    elif callback_query.data == "btn_month":
-        df = db.get_month_data(user_id)
-        photo = plot_stats(df, 'month')
-        await callback_query.message.answer_photo(photo=photo, caption="Статистика за месяц")
-    elif callback_query.data == "btn_year":
-        df = db.get_year_data(user_id)
-        photo = plot_stats(df, 'year')
-        await callback_query.message.answer_photo(photo=photo, caption="Статистика за год")
+    if callback_query.data not in STATISTICS_PERIODS:
+        return
+    period, get_data, caption = STATISTICS_PERIODS[callback_query.data]
+
+    data = await db.run(get_data, user_id)
+    series = charts.chart_series(data, period)
+    if series is None:
+        await callback_query.message.answer("За этот период пока нет данных")
+        return
+
+    # повторная отправка уже загруженного в Telegram графика по file_id
+    key = chart_cache.key(user_id, period, series)
+    file_id = chart_cache.get_file_id(key)
+    if file_id:
+        await callback_query.message.answer_photo(photo=file_id, caption=caption)
+        return
+
+    png = chart_cache.get_png(key)
+    if png is None:
+        try:
+            png = await chart_renderer.render(series)
+        except charts.ChartQueueFull:
+            await callback_query.answer("Сервер занят, попробуйте через минуту")
+            return
+        chart_cache.put_png(key, png)
+
+    photo = BufferedInputFile(png, filename='graph.png')
+    sent = await callback_query.message.answer_photo(photo=photo, caption=caption)
+    chart_cache.set_file_id(key, sent.photo[-1].file_id)
+
+
+# Фоновые задачи бота (сброс буфера записи и т.п.)
+background_tasks = set()
+metrics_server = {'runner': None}
+online_migration = {'task': None}
+
+
+async def on_startup():
+    await db.run(db.init_db)
+    background_tasks.add(asyncio.create_task(db.flush_periodically()))
+    background_tasks.add(asyncio.create_task(weather.refresh_hottest()))
+    background_tasks.add(asyncio.create_task(metrics.monitor_event_loop()))
+    # пул графиков поднимается после старта, а не при импорте
+    background_tasks.add(asyncio.create_task(chart_renderer.prewarm()))
+    # пересчет норм воды и напоминания - один на все процессы (WATER_JOB_HOUR=-1 выключает)
+    if norms.WATER_JOB_HOUR >= 0 and os.getenv('SHARD_INDEX', '0') == '0':
+        background_tasks.add(asyncio.create_task(norms.run_daily(weather)))
+    if reminders.REMINDERS_ENABLED and os.getenv('SHARD_INDEX', '0') == '0':
+        background_tasks.add(asyncio.create_task(reminder_scheduler.run()))
+    # онлайн-миграции больших таблиц - пачками в отдельном потоке
+    if os.getenv('SHARD_INDEX', '0') == '0':
+        online_migration['task'] = asyncio.create_task(asyncio.to_thread(db.migrate_online))
+    # у воркеров многопроцессного режима свои порты: METRICS_PORT + 1 + номер
+    port = metrics.METRICS_PORT
+    if port and os.getenv('SHARD_INDEX'):
+        port += 1 + int(os.getenv('SHARD_INDEX'))
+    metrics_server['runner'] = await metrics.start_server(port=port)
+
+
+async def on_shutdown():
+    for task in background_tasks:
+        task.cancel()
+    # поток миграции нельзя отменить: дождаться конца текущей пачки
+    db.migration_stop.set()
+    if online_migration['task'] is not None:
+        await online_migration['task']
+    if metrics_server['runner'] is not None:
+        await metrics_server['runner'].cleanup()
+    await db.run(db.flush)
+    db.close_connections()
+    await weather.close()
+    await products.close()
+    chart_renderer.close()
+
+
+dp.startup.register(on_startup)
+dp.shutdown.register(on_shutdown)
+
+
+async def set_webhook():
+    # несколько экземпляров за балансировщиком ставят один и тот же URL
+    if WEBHOOK_URL:
+        await bot.set_webhook(WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET or None)
+
+
+async def health(request):
+    return web.json_response({'status': 'ok', 'throttling': throttling.stats()})
+
+
+def create_webhook_app():
+    app = web.Application()
+    app.router.add_get('/health', health)
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET or None,
+    ).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    return app
 
 
 # Основная функция запуска бота
 async def main():
-    print("Бот запущен!")
+    logging.info("Бот запущен!")
+    # после работы в режиме webhook getUpdates не работает, пока webhook не снят
+    await bot.delete_webhook()
     await dp.start_polling(bot)
 
+
+def run_webhook():
+    dp.startup.register(set_webhook)
+    logging.info(f"Бот запущен (webhook, порт {WEBAPP_PORT})!")
+    web.run_app(create_webhook_app(), host=WEBAPP_HOST, port=WEBAPP_PORT, print=None)
+
+
+def run_sharded():
+    import sharding
+
+    logging.info(f"Бот запущен ({BOT_WORKERS} воркеров, {BOT_MODE})!")
+    asyncio.run(sharding.run_front(
+        BOT_WORKERS,
+        BOT_MODE,
+        TELEGRAM_API_URL or 'https://api.telegram.org',
+        bot_api_key,
+        webhook=(WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBAPP_HOST, WEBAPP_PORT),
+    ))
+
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    if BOT_WORKERS > 1:
+        run_sharded()
+    elif BOT_MODE == 'webhook':
+        run_webhook()
+    else:
+        asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,296 @@
+import os
+import io
+import sys
+import json
+import time
+import asyncio
+import types
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import metrics
+from cache import TTLCache, MISSING
+
+CHART_WORKERS = int(os.getenv('CHART_WORKERS', str(min(4, os.cpu_count() or 1))))
+CHART_QUEUE_SIZE = int(os.getenv('CHART_QUEUE_SIZE', '16'))
+CHART_CACHE_DIR = os.getenv('CHART_CACHE_DIR', 'chart_cache')
+CHART_CACHE_MEMORY_ITEMS = int(os.getenv('CHART_CACHE_MEMORY_ITEMS', '256'))
+CHART_CACHE_DISK_BYTES = int(os.getenv('CHART_CACHE_DISK_BYTES', str(256 * 1024 * 1024)))
+# Через сколько секунд после старта поднять пул заранее (-1 - при первом графике)
+CHART_PREWARM_DELAY = float(os.getenv('CHART_PREWARM_DELAY', '5'))
+
+
+class ChartQueueFull(Exception):
+    pass
+
+
+# Шаблон фигуры, создается один раз в каждом процессе пула
+_figure = None
+
+
+def _init_worker():
+    global _figure
+    import matplotlib
+    matplotlib.use('Agg')
+    from matplotlib.figure import Figure
+
+    _figure = Figure(figsize=(12, 10))
+    _figure.subplots(2, 1)
+    # первая отрисовка прогревает шрифты и кэши Agg
+    _figure.savefig(io.BytesIO(), format='png')
+
+
+def chart_series(data, period='week'):
+    """
+    Подписи по оси X и колонки из bd_operations.get_*_data;
+    array('d') передаются в процесс пула как есть.
+    """
+    if not data:
+        return None
+
+    label_format = {'year': '%b', 'all': '%m.%y'}.get(period, '%d.%m')
+    series = dict(data)
+    series['dates'] = [date.strftime(label_format) for date in data['dates']]
+    return series
+
+
+def render_stats(series):
+    """
+    Отрисовать график в PNG. Выполняется в процессе пула
+    на переиспользуемой фигуре (объектный API matplotlib, без pyplot).
+    """
+    if _figure is None:
+        _init_worker()
+    import numpy as np
+
+    ax1, ax2 = _figure.axes
+    ax1.clear()
+    ax2.clear()
+    dates = series['dates']
+
+    # Вода
+    ax1.bar(dates, series['water'], color='skyblue', label='Выпито')
+    ax1.plot(dates, series['water_norm'], 'b--', label='Норма', marker='o')
+    ax1.set_title('Вода')
+    ax1.set_ylabel('Мл')
+    ax1.legend()
+
+    # Калории
+    x = np.arange(len(dates))
+    width = 0.35
+
+    ax2.bar(x - width/2, series['calories_consumed'], width, color='lightgreen', label='Потреблено')
+    ax2.bar(x + width/2, series['calories_burned'], width, color='lightcoral', label='Сожжено')
+    ax2.plot(x, series['calories_norm'], 'r--', label='Норма', marker='o')
+    ax2.set_title('Калории')
+    ax2.set_ylabel('Ккал')
+    ax2.set_xticks(x)
+    ax2.set_xticklabels(dates)
+    ax2.legend()
+
+    buf = io.BytesIO()
+    _figure.savefig(buf, format='png')
+    return buf.getvalue()
+
+
+class _WorkerProcess(multiprocessing.context.SpawnProcess):
+    # spawn импортирует в каждом процессе главный модуль (bot.py) целиком:
+    # aiogram, клиент бота, соединения. Процессам нужен только charts,
+    # поэтому на время запуска процесса главный модуль подменяется пустым.
+    # Пул запускает процессы по мере надобности, так что подмена - здесь,
+    # а не вокруг первого submit
+    def start(self):
+        main = sys.modules['__main__']
+        sys.modules['__main__'] = types.ModuleType('__main__')
+        try:
+            super().start()
+        finally:
+            sys.modules['__main__'] = main
+
+
+class _WorkerContext(multiprocessing.context.SpawnContext):
+    Process = _WorkerProcess
+
+
+class ChartRenderer:
+    """
+    Пул процессов для отрисовки графиков с ограниченной очередью:
+    при переполнении render() сразу выбрасывает ChartQueueFull.
+    """
+
+    def __init__(self, workers=CHART_WORKERS, queue_size=CHART_QUEUE_SIZE):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.rejected = 0
+        self._pending = 0
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            # spawn, а не fork: процесс бота многопоточный (пул БД, event loop)
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=_WorkerContext(),
+                initializer=_init_worker,
+            )
+        return self._executor
+
+    async def prewarm(self, delay=CHART_PREWARM_DELAY):
+        """
+        Запустить пул в фоне после старта бота, чтобы первый график
+        не ждал запуска процессов и импорта matplotlib.
+        """
+        if delay < 0:
+            return
+        await asyncio.sleep(delay)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self._get_executor(), int)
+
+    async def render(self, series):
+        if self._pending >= self.queue_size:
+            self.rejected += 1
+            metrics.CHART_REJECTED.inc()
+            raise ChartQueueFull()
+
+        self._pending += 1
+        start = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._get_executor(), render_stats, series)
+        finally:
+            self._pending -= 1
+            metrics.CHART_RENDER.observe(time.perf_counter() - start)
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+class ChartCache:
+    """
+    Кэш готовых графиков: ключ - пользователь, период и хэш данных графика.
+    PNG хранится в памяти (LRU) и на диске (с ограничением по размеру),
+    дополнительно запоминается file_id Telegram после первой отправки.
+    """
+
+    def __init__(self, directory=CHART_CACHE_DIR, memory_items=CHART_CACHE_MEMORY_ITEMS,
+                 disk_bytes=CHART_CACHE_DISK_BYTES):
+        self.directory = directory
+        self.disk_bytes = disk_bytes
+        self.memory = TTLCache(maxsize=memory_items)
+        self.file_ids = TTLCache(maxsize=memory_items * 16)
+        # ключи по пользователю для invalidate; чистятся вместе с диском
+        self._user_keys = {}
+        self._tracked_keys = 0
+        self._prune_at = memory_items * 16
+        # каталог создается и подсчитывается при первой записи, а не при импорте бота
+        self._disk_usage = None
+
+    def key(self, user_id, period, series):
+        digest = hashlib.sha1(json.dumps(series, sort_keys=True, default=list).encode()).hexdigest()
+        key = f'{user_id}-{period}-{digest}'
+        keys = self._user_keys.setdefault(user_id, set())
+        if key not in keys:
+            keys.add(key)
+            self._tracked_keys += 1
+            if self._tracked_keys > self._prune_at:
+                self._prune_user_keys()
+        return key
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.png')
+
+    def get_file_id(self, key):
+        file_id = self.file_ids.get(key)
+        return None if file_id is MISSING else file_id
+
+    def set_file_id(self, key, file_id):
+        self.file_ids.set(key, file_id)
+
+    def get_png(self, key):
+        png = self.memory.get(key)
+        if png is not MISSING:
+            return png
+        try:
+            with open(self._path(key), 'rb') as file:
+                png = file.read()
+        except FileNotFoundError:
+            return None
+        self.memory.set(key, png)
+        return png
+
+    def put_png(self, key, png):
+        self.memory.set(key, png)
+        if self._disk_usage is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._disk_usage = self._trim_disk()
+        with open(self._path(key), 'wb') as file:
+            file.write(png)
+        self._disk_usage += len(png)
+        if self._disk_usage > self.disk_bytes:
+            self._disk_usage = self._trim_disk()
+
+    def invalidate(self, user_id):
+        keys = self._user_keys.pop(user_id, ())
+        self._tracked_keys -= len(keys)
+        for key in keys:
+            self.memory.invalidate(key)
+            self.file_ids.invalidate(key)
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def _disk_entries(self):
+        # (mtime, размер, путь) PNG на диске. Каталог общий для воркеров,
+        # файл может удалить другой процесс между scandir и stat
+        entries = []
+        try:
+            scan = os.scandir(self.directory)
+        except FileNotFoundError:
+            return entries
+        with scan:
+            for entry in scan:
+                if entry.name.endswith('.png'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def _prune_user_keys(self, on_disk=None):
+        # оставляем только ключи, у которых что-то осталось в кэше
+        if on_disk is None:
+            on_disk = {os.path.basename(path)[:-4] for _, _, path in self._disk_entries()}
+        tracked = 0
+        for user_id in list(self._user_keys):
+            keys = {key for key in self._user_keys[user_id]
+                    if key in on_disk or key in self.memory or key in self.file_ids}
+            if keys:
+                self._user_keys[user_id] = keys
+                tracked += len(keys)
+            else:
+                del self._user_keys[user_id]
+        self._tracked_keys = tracked
+        # следующая чистка - когда ключей станет вдвое больше оставшихся
+        self._prune_at = max(self.file_ids.maxsize, 2 * tracked)
+
+    def _trim_disk(self):
+        entries = self._disk_entries()
+        total = sum(size for _, size, _ in entries)
+        on_disk = {os.path.basename(path)[:-4] for _, _, path in entries}
+        # удаляем самые старые файлы, пока не уложимся в лимит
+        for _, size, path in sorted(entries):
+            if total <= self.disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            on_disk.discard(os.path.basename(path)[:-4])
+        self._prune_user_keys(on_disk)
+        return total
@@ -0,0 +1,206 @@
+"""
+Потоковая выгрузка истории (daily_statistics) в CSV или Parquet.
+
+Строки читаются курсором пачками по EXPORT_CHUNK_ROWS через отдельное
+read-only соединение, так что память не зависит от размера базы.
+В Telegram файл уходит через ExportFile - multipart-загрузкой
+по частям, без сборки всего файла в памяти.
+
+    python export.py history.csv
+    python export.py --user 123 --format parquet history.parquet
+    python export.py --since 2024-01-01 --until 2024-01-31 january.csv
+"""
+import io
+import os
+import csv
+import sys
+import time
+import sqlite3
+import argparse
+import datetime
+
+from aiogram.types import InputFile
+
+import bd_operations as db
+import migrations
+
+EXPORT_CHUNK_ROWS = int(os.getenv('EXPORT_CHUNK_ROWS', '5000'))
+COLUMNS = ('user_id', 'date', 'water_as_is', 'calories_burned', 'calories_consumed', 'water_norm', 'calories_norm')
+FORMATS = ('csv', 'parquet')
+MIN_DATE, MAX_DATE = '0000-01-01', '9999-12-31'
+
+
+def _range_query(connection, date_from, date_to):
+    # все пользователи за диапазон дат: по индексу daily_statistics_days,
+    # если он уже заполнен, иначе полным просмотром таблицы
+    if migrations.is_applied(connection, migrations.DAILY_STATISTICS_DAYS_VERSION):
+        columns = ', '.join(f'd.{column}' for column in COLUMNS)
+        return connection.execute(f'''
+            SELECT {columns} FROM daily_statistics_days x
+            JOIN daily_statistics d ON d.user_id = x.user_id AND d.date = date(x.day * 86400, 'unixepoch')
+            WHERE x.day BETWEEN {migrations.DAY_NUMBER_SQL.format('?')} AND {migrations.DAY_NUMBER_SQL.format('?')}
+            ORDER BY x.day, x.user_id
+        ''', (date_from, date_to))
+    return connection.execute(
+        f'SELECT {", ".join(COLUMNS)} FROM daily_statistics WHERE date BETWEEN ? AND ? ORDER BY date, user_id',
+        (date_from, date_to)
+    )
+
+
+def iter_row_chunks(user_id=None, chunk_rows=EXPORT_CHUNK_ROWS, date_from=None, date_to=None):
+    """
+    Пачки строк истории пользователя (или всех пользователей)
+    в порядке первичного ключа. Выгрузка всех пользователей за
+    диапазон дат идет по дням.
+    """
+    # несброшенные приращения должны попасть в выгрузку
+    db.flush()
+    connection = sqlite3.connect(f'file:{db.DB_PATH}?mode=ro', uri=True, check_same_thread=False)
+    try:
+        query = f'SELECT {", ".join(COLUMNS)} FROM daily_statistics'
+        dates = (str(date_from or MIN_DATE), str(date_to or MAX_DATE))
+        if user_id is not None:
+            cursor = connection.execute(query + ' WHERE user_id = ? AND date BETWEEN ? AND ? ORDER BY date',
+                                        (user_id, *dates))
+        elif date_from is None and date_to is None:
+            cursor = connection.execute(query + ' ORDER BY user_id, date')
+        else:
+            cursor = _range_query(connection, *dates)
+        while True:
+            rows = cursor.fetchmany(chunk_rows)
+            if not rows:
+                break
+            yield rows
+    finally:
+        connection.close()
+
+
+def csv_chunks(row_chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    for rows in row_chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+class _ChunkSink(io.RawIOBase):
+    # приемник для ParquetWriter: копит байты до очередной отдачи
+    def __init__(self):
+        self.parts = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def take(self):
+        data = b''.join(self.parts)
+        self.parts = []
+        return data
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError('Для выгрузки в Parquet нужен пакет pyarrow') from None
+    return pa, pq
+
+
+def check_format(format):
+    # ошибку лучше показать до начала загрузки, а не посреди нее
+    if format not in FORMATS:
+        raise RuntimeError(f'Неизвестный формат выгрузки: {format}')
+    if format == 'parquet':
+        _import_pyarrow()
+
+
+def parquet_chunks(row_chunks):
+    pa, pq = _import_pyarrow()
+    schema = pa.schema([('user_id', pa.int64()), ('date', pa.string())] +
+                       [(name, pa.int64()) for name in COLUMNS[2:]])
+    sink = _ChunkSink()
+    # одна группа строк на пачку: в памяти не больше одной пачки
+    with pq.ParquetWriter(sink, schema) as writer:
+        for rows in row_chunks:
+            writer.write_table(pa.Table.from_pylist([dict(zip(COLUMNS, row)) for row in rows], schema=schema))
+            yield sink.take()
+    yield sink.take()
+
+
+def file_chunks(user_id=None, format='csv', chunk_rows=EXPORT_CHUNK_ROWS, date_from=None, date_to=None):
+    rows = iter_row_chunks(user_id, chunk_rows, date_from, date_to)
+    return parquet_chunks(rows) if format == 'parquet' else csv_chunks(rows)
+
+
+class ExportFile(InputFile):
+    """
+    Выгрузка как файл для отправки ботом: пачки готовятся в пуле БД,
+    aiohttp отправляет их по мере готовности.
+    """
+
+    def __init__(self, user_id, format='csv', chunk_rows=EXPORT_CHUNK_ROWS):
+        super().__init__(filename=f'history_{user_id}.{format}')
+        self.user_id = user_id
+        self.format = format
+        self.chunk_rows = chunk_rows
+
+    async def read(self, bot):
+        chunks = file_chunks(self.user_id, self.format, self.chunk_rows)
+        try:
+            while True:
+                chunk = await db.run(next, chunks, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    yield chunk
+        finally:
+            await db.run(chunks.close)
+
+
+def count_rows(user_id):
+    return db.get_connection().execute(
+        'SELECT COUNT(*) FROM daily_statistics WHERE user_id = ?', (user_id, )
+    ).fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Выгрузка истории daily_statistics')
+    parser.add_argument('output', help="файл для записи, '-' - stdout (только csv)")
+    parser.add_argument('--user', type=int, help='только этот пользователь')
+    parser.add_argument('--format', choices=FORMATS, help='по умолчанию - по расширению файла')
+    parser.add_argument('--chunk-rows', type=int, default=EXPORT_CHUNK_ROWS)
+    parser.add_argument('--since', type=datetime.date.fromisoformat, help='с даты YYYY-MM-DD')
+    parser.add_argument('--until', type=datetime.date.fromisoformat, help='по дату YYYY-MM-DD включительно')
+    args = parser.parse_args()
+
+    format = args.format or ('parquet' if args.output.endswith('.parquet') else 'csv')
+    start = time.perf_counter()
+    size = 0
+    output = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    try:
+        for chunk in file_chunks(args.user, format, args.chunk_rows, args.since, args.until):
+            output.write(chunk)
+            size += len(chunk)
+    finally:
+        if output is not sys.stdout.buffer:
+            output.close()
+    print(f'{size / 2 ** 20:.1f} MB за {time.perf_counter() - start:.1f} с', file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import asyncio
+import logging
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+
+import bd_operations as db
+
+# Через сколько секунд брошенная анкета (Profile/Product) забывается
+FSM_STATE_TTL = int(os.getenv('FSM_STATE_TTL', str(24 * 3600)))
+# Окно, за которое изменения состояний копятся и пишутся одной транзакцией
+FSM_FLUSH_INTERVAL = float(os.getenv('FSM_FLUSH_INTERVAL', '0.1'))
+FSM_PURGE_INTERVAL = float(os.getenv('FSM_PURGE_INTERVAL', '600'))
+
+
+def _dump(data):
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')) if data else ''
+
+
+def _load(data):
+    return json.loads(data) if data else {}
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище FSM в таблице fsm_states базы users.db.
+
+    Запись отложенная: изменения копятся в памяти не дольше
+    FSM_FLUSH_INTERVAL и сбрасываются пачкой, чтение сначала смотрит
+    в несброшенные изменения, затем в пачку, которая сейчас пишется.
+    Несколько процессов могут работать с одной базой, если апдейты
+    одного пользователя попадают в один процесс (см. sharding.py).
+    """
+
+    def __init__(self, ttl=FSM_STATE_TTL, flush_interval=FSM_FLUSH_INTERVAL):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self._pending = {}
+        # пачка, которая пишется сейчас: до коммита в SQLite ее еще нет
+        self._inflight = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        self._last_purge = 0
+
+    @staticmethod
+    def _key(key):
+        return (f'{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ""}:'
+                f'{key.business_connection_id or ""}:{key.destiny}')
+
+    def _select(self, key):
+        row = db.get_connection().execute(
+            'SELECT state, data FROM fsm_states WHERE key = ? AND expires_at > ?',
+            (key, int(time.time()))
+        ).fetchone()
+        return (row[0], _load(row[1])) if row else (None, {})
+
+    async def _get(self, key):
+        record = self._pending.get(key)
+        if record is None:
+            record = self._inflight.get(key)
+        if record is None:
+            record = await db.run(self._select, key)
+        return record
+
+    async def _put(self, key, state, data):
+        self._pending[key] = (state, data)
+        if self.flush_interval <= 0:
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        self._flush_task = None
+        try:
+            await self.flush()
+        except Exception:
+            # изменения вернулись в _pending - повторяем через интервал
+            logging.exception('Ошибка записи состояний FSM')
+            if self._flush_task is None:
+                self._flush_task = asyncio.create_task(self._flush_later())
+
+    def _write(self, batch, purge):
+        now = int(time.time())
+        upserts = []
+        deletes = []
+        for key, (state, data) in batch.items():
+            if state is None and not data:
+                deletes.append((key, ))
+            else:
+                upserts.append((key, state, _dump(data), now + self.ttl))
+
+        connection = db.get_connection()
+        with connection:
+            connection.executemany('''
+                INSERT INTO fsm_states (key, state, data, expires_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    state = excluded.state,
+                    data = excluded.data,
+                    expires_at = excluded.expires_at
+                ''',
+                upserts
+            )
+            connection.executemany('DELETE FROM fsm_states WHERE key = ?', deletes)
+            if purge:
+                connection.execute('DELETE FROM fsm_states WHERE expires_at <= ?', (now, ))
+
+    async def flush(self):
+        # по одной пачке за раз, иначе потоки пула могут закоммитить
+        # более старую пачку после более новой
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            batch = self._inflight = self._pending
+            self._pending = {}
+            purge = time.monotonic() - self._last_purge >= FSM_PURGE_INTERVAL
+            if purge:
+                self._last_purge = time.monotonic()
+            try:
+                await db.run(self._write, batch, purge)
+            except Exception:
+                # более новые изменения, пришедшие во время записи, важнее
+                self._pending = {**batch, **self._pending}
+                raise
+            finally:
+                self._inflight = {}
+
+    async def set_state(self, key, state=None):
+        key = self._key(key)
+        _, data = await self._get(key)
+        await self._put(key, state.state if isinstance(state, State) else state, data)
+
+    async def get_state(self, key):
+        state, _ = await self._get(self._key(key))
+        return state
+
+    async def set_data(self, key, data):
+        key = self._key(key)
+        state, _ = await self._get(key)
+        await self._put(key, state, data.copy())
+
+    async def get_data(self, key):
+        _, data = await self._get(self._key(key))
+        return data.copy()
+
+    async def close(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
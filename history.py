@@ -0,0 +1,334 @@
+"""
+Бинарная история по дням для графиков за длинные периоды.
+
+Один файл на пользователя: заголовок и записи фиксированной ширины,
+по int32 на каждую колонку COLUMNS; запись i - день first_day + i
+(дни считаются от 1970-01-01). Дни без строки в daily_statistics
+хранятся как MISSING. Источник истины - SQLite: файл создается из
+daily_statistics при первом чтении, а путь записи bd_operations
+после коммита переписывает в существующих файлах затронутые дни.
+Чтение идет через mmap: окно любой длины - срез NumPy по смещению
+дня без копирования файла.
+
+Включается через HISTORY_DIR. Проверка файлов по SQLite и ремонт:
+    python history.py check [--repair]
+    python history.py rebuild [--user 123]
+"""
+import os
+import sys
+import mmap
+import time
+import fcntl
+import struct
+import logging
+import argparse
+import datetime
+import threading
+from array import array
+
+# Каталог файлов истории; пусто - графики читаются из SQLite
+HISTORY_DIR = os.getenv('HISTORY_DIR', '')
+
+COLUMNS = ('water_as_is', 'calories_burned', 'calories_consumed', 'water_norm', 'calories_norm')
+# Порядок колонок, в котором bd_operations.get_*_data отдают ряды
+SERIES_COLUMNS = (
+    ('water', 0), ('water_norm', 3), ('calories_consumed', 2), ('calories_burned', 1), ('calories_norm', 4),
+)
+MISSING = -2 ** 31
+MAGIC = b'HST1'
+# magic, первый день, число колонок, резерв - 16 байт, записи выровнены
+HEADER = struct.Struct('<4siii')
+RECORD = struct.Struct('<' + 'i' * len(COLUMNS))
+EMPTY_RECORD = RECORD.pack(*[MISSING] * len(COLUMNS))
+
+EPOCH = datetime.date(1970, 1, 1)
+_EPOCH_ORDINAL = EPOCH.toordinal()
+
+
+def day_number(date):
+    if isinstance(date, str):
+        date = datetime.date.fromisoformat(date)
+    return date.toordinal() - _EPOCH_ORDINAL
+
+
+def _select_rows(connection, user_id, dates=None):
+    query = f'''
+        SELECT date, {", ".join(f"IFNULL({column}, 0)" for column in COLUMNS)}
+        FROM daily_statistics WHERE user_id = ?
+    '''
+    if dates is None:
+        return connection.execute(query + ' ORDER BY date', (user_id, )).fetchall()
+    dates = sorted(dates)
+    return connection.execute(
+        query + f' AND date IN ({", ".join("?" * len(dates))}) ORDER BY date', (user_id, *dates)
+    ).fetchall()
+
+
+def _records(rows):
+    """
+    Строки (date, колонки...) из SQLite -> (first_day, массив записей
+    с MISSING в пропущенных днях), как они лежат в файле.
+    """
+    import numpy as np
+
+    days = np.array([day_number(row[0]) for row in rows], dtype=np.int64)
+    first_day = int(days[0])
+    records = np.full((int(days[-1]) - first_day + 1, len(COLUMNS)), MISSING, dtype='<i4')
+    records[days - first_day] = [row[1:] for row in rows]
+    return first_day, records
+
+
+class HistoryStore:
+    def __init__(self, directory=HISTORY_DIR):
+        self.directory = directory
+        self.stats = {'reads': 0, 'rebuilds': 0, 'updates': 0}
+        self._tmp_counter = 0
+        self._tmp_lock = threading.Lock()
+
+    def path(self, user_id):
+        return os.path.join(self.directory, f'{user_id % 256:02x}', f'{user_id}.bin')
+
+    def _open_locked(self, path):
+        # flock, а не lockf: блокировка lockf принадлежит процессу, не
+        # исключает потоки пула и снимается при закрытии любого
+        # дескриптора файла (например, в _map).
+        # Файл может быть заменен rebuild'ом, пока мы ждали блокировку:
+        # тогда открываем заново, иначе запись уйдет в удаленный файл
+        while True:
+            try:
+                file = open(path, 'r+b')
+            except FileNotFoundError:
+                return None
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                if os.stat(path).st_ino == os.fstat(file.fileno()).st_ino:
+                    return file
+            except FileNotFoundError:
+                pass
+            file.close()
+
+    def _replace(self, path, first_day, records):
+        with self._tmp_lock:
+            self._tmp_counter += 1
+            tmp = f'{path}.{os.getpid()}.{self._tmp_counter}.tmp'
+        with open(tmp, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, first_day, len(COLUMNS), 0))
+            file.write(records.tobytes())
+        os.replace(tmp, path)
+
+    def rebuild(self, connection, user_id):
+        """
+        Переписать файл пользователя целиком из daily_statistics.
+        Возвращает число дней в файле (0 - истории нет, файла тоже).
+        """
+        path = self.path(user_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # блокировка старого файла, чтобы не потерять параллельный update
+        file = self._open_locked(path)
+        try:
+            rows = _select_rows(connection, user_id)
+            if not rows:
+                if file is not None:
+                    os.remove(path)
+                return 0
+            first_day, records = _records(rows)
+            self._replace(path, first_day, records)
+            self.stats['rebuilds'] += 1
+            return len(records)
+        finally:
+            if file is not None:
+                file.close()
+
+    def update(self, connection, keys):
+        """
+        Переписать дни keys ((user_id, date), уже закоммиченные в SQLite)
+        в существующих файлах. Файлов, которых еще нет, не создает.
+        """
+        by_user = {}
+        for user_id, date in keys:
+            by_user.setdefault(user_id, set()).add(str(date))
+
+        for user_id, dates in by_user.items():
+            path = self.path(user_id)
+            file = self._open_locked(path)
+            if file is None:
+                continue
+            with file:
+                magic, first_day, columns, _ = HEADER.unpack(file.read(HEADER.size))
+                # SQLite читается под блокировкой файла: параллельные
+                # обновления пишут дни в том порядке, в каком их прочли
+                rows = _select_rows(connection, user_id, dates)
+                if magic != MAGIC or columns != len(COLUMNS) or any(day_number(row[0]) < first_day for row in rows):
+                    # день раньше начала файла (или чужой формат) - файл строится заново
+                    file.close()
+                    self.rebuild(connection, user_id)
+                    continue
+
+                count = (os.fstat(file.fileno()).st_size - HEADER.size) // RECORD.size
+                for row in rows:
+                    index = day_number(row[0]) - first_day
+                    if index > count:
+                        file.seek(HEADER.size + count * RECORD.size)
+                        file.write(EMPTY_RECORD * (index - count))
+                    file.seek(HEADER.size + index * RECORD.size)
+                    file.write(RECORD.pack(*row[1:]))
+                    count = max(count, index + 1)
+                self.stats['updates'] += 1
+
+    def _map(self, connection, user_id):
+        """
+        (first_day, записи) - представление NumPy поверх mmap файла;
+        mmap закрывается сам, когда последнее представление удалено.
+        Отсутствующий или испорченный файл строится из SQLite.
+        """
+        import numpy as np
+
+        path = self.path(user_id)
+        for _ in range(2):
+            try:
+                with open(path, 'rb') as file:
+                    size = os.fstat(file.fileno()).st_size
+                    if size > HEADER.size:
+                        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                        magic, first_day, columns, _ = HEADER.unpack_from(mapped)
+                        if magic == MAGIC and columns == len(COLUMNS):
+                            count = (size - HEADER.size) // RECORD.size
+                            records = np.frombuffer(mapped, dtype='<i4', count=count * len(COLUMNS),
+                                                    offset=HEADER.size).reshape(count, len(COLUMNS))
+                            self.stats['reads'] += 1
+                            return first_day, records
+                        mapped.close()
+            except FileNotFoundError:
+                pass
+            if not self.rebuild(connection, user_id):
+                return None
+        return None
+
+    def window(self, connection, user_id, date_from, date_to):
+        """
+        Дни [date_from, date_to] в формате bd_operations.get_*_data
+        (None, если за период нет данных).
+        """
+        import numpy as np
+
+        mapped = self._map(connection, user_id)
+        if mapped is None:
+            return None
+        first_day, records = mapped
+        start = max(day_number(date_from) - first_day, 0)
+        chunk = records[start:max(day_number(date_to) - first_day + 1, 0)]
+        present = np.flatnonzero(chunk[:, 0] != MISSING)
+        if not present.size:
+            return None
+
+        days = (present + first_day + start).astype('datetime64[D]')
+        values = chunk[present].astype(np.float64)
+        series = {'dates': days.astype(object).tolist()}
+        for name, column in SERIES_COLUMNS:
+            series[name] = array('d', values[:, column].tobytes())
+        return series
+
+    def monthly(self, connection, user_id, date_from=None):
+        """
+        Средние за месяц с date_from (или за всю историю) - как
+        в monthly_statistics: сумма за месяц на число дней с записями.
+        """
+        import numpy as np
+
+        mapped = self._map(connection, user_id)
+        if mapped is None:
+            return None
+        first_day, records = mapped
+        start = 0 if date_from is None else max(day_number(date_from) - first_day, 0)
+        chunk = records[start:]
+        present = np.flatnonzero(chunk[:, 0] != MISSING)
+        if not present.size:
+            return None
+
+        # дни идут по порядку, поэтому месяцы - непрерывные группы
+        months = (present + first_day + start).astype('datetime64[D]').astype('datetime64[M]')
+        starts = np.flatnonzero(np.diff(months.view(np.int64), prepend=-1))
+        counts = np.diff(starts, append=len(months))
+        averages = np.add.reduceat(chunk[present].astype(np.float64), starts) / counts[:, None]
+        series = {'dates': months[starts].astype('datetime64[D]').astype(object).tolist()}
+        for name, column in SERIES_COLUMNS:
+            series[name] = array('d', averages[:, column].tobytes())
+        return series
+
+    def user_ids(self):
+        if not os.path.isdir(self.directory):
+            return
+        for shard in sorted(os.scandir(self.directory), key=lambda entry: entry.name):
+            if not shard.is_dir():
+                continue
+            for entry in os.scandir(shard.path):
+                name, extension = os.path.splitext(entry.name)
+                if extension == '.bin' and name.lstrip('-').isdigit():
+                    yield int(name)
+
+    def check(self, connection, repair=False):
+        """
+        Сверить все файлы с daily_statistics. Возвращает счетчики
+        ok / mismatched / orphaned (файл без строк в SQLite) и, с
+        repair=True, чинит расхождения перестройкой из SQLite.
+        """
+        import numpy as np
+
+        result = {'ok': 0, 'mismatched': 0, 'orphaned': 0, 'repaired': 0}
+        for user_id in self.user_ids():
+            file = self._open_locked(self.path(user_id))
+            if file is None:
+                continue
+            with file:
+                rows = _select_rows(connection, user_id)
+                data = file.read()
+            if not rows:
+                result['orphaned'] += 1
+            else:
+                first_day, expected = _records(rows)
+                header = HEADER.unpack_from(data) if len(data) >= HEADER.size else None
+                actual = np.frombuffer(data, dtype='<i4', offset=HEADER.size) if header else None
+                if (header == (MAGIC, first_day, len(COLUMNS), 0)
+                        and actual.size == expected.size and np.array_equal(actual, expected.ravel())):
+                    result['ok'] += 1
+                    continue
+                result['mismatched'] += 1
+                logging.warning(f'История пользователя {user_id} расходится с SQLite')
+            if repair:
+                self.rebuild(connection, user_id)
+                result['repaired'] += 1
+        return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бинарная история по дням (HISTORY_DIR)')
+    parser.add_argument('command', choices=('check', 'rebuild'))
+    parser.add_argument('--repair', action='store_true', help='check: перестроить расходящиеся файлы')
+    parser.add_argument('--user', type=int, help='rebuild: только этот пользователь')
+    parser.add_argument('--directory', default=HISTORY_DIR)
+    args = parser.parse_args()
+    if not args.directory:
+        parser.error('не задан HISTORY_DIR (или --directory)')
+
+    import bd_operations as db
+
+    store = HistoryStore(args.directory)
+    connection = db.get_connection()
+    start = time.perf_counter()
+    if args.command == 'check':
+        result = store.check(connection, args.repair)
+        print(f'{result} за {time.perf_counter() - start:.1f} с')
+        return 1 if (result['mismatched'] or result['orphaned']) and not args.repair else 0
+
+    if args.user is not None:
+        user_ids = [args.user]
+    else:
+        user_ids = [row[0] for row in connection.execute('SELECT DISTINCT user_id FROM daily_statistics')]
+    days = sum(store.rebuild(connection, user_id) for user_id in user_ids)
+    print(f'{len(user_ids)} пользователей, {days} дней за {time.perf_counter() - start:.1f} с')
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    sys.exit(main())
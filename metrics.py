@@ -0,0 +1,179 @@
+"""
+Метрики в текстовом формате Prometheus без внешних зависимостей.
+
+Счетчики и гистограммы обновляются из event loop и из потоков пула БД,
+поэтому у каждой метрики своя блокировка; наблюдение - это поиск
+корзины и пара сложений. Отдаются на локальном порту:
+    curl http://127.0.0.1:9100/metrics
+"""
+import os
+import bisect
+import asyncio
+import logging
+import threading
+
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+# 0 - не поднимать HTTP-сервер метрик
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))
+# Как часто измеряется задержка event loop, секунды
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', '0.5'))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _labels(names, values, extra=''):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        with self._lock:
+            items = sorted(self._values.items())
+        for labels, value in items:
+            lines.extend(self._sample_lines(labels, value))
+        return lines
+
+    def _sample_lines(self, labels, value):
+        return [f'{self.name}{_labels(self.labelnames, labels)} {_number(value)}']
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super().__init__(name, documentation, labelnames)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # счетчики по корзинам (последняя - +Inf), сумма
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def snapshot(self, *labels):
+        with self._lock:
+            state = self._values.get(labels)
+            return (list(state[0]), state[1]) if state else None
+
+    def _sample_lines(self, labels, state):
+        counts, total = state
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'), ), counts):
+            cumulative += count
+            le = 'le="+Inf"' if bound == float('inf') else f'le="{bound}"'
+            lines.append(f'{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}')
+        lines.append(f'{self.name}_sum{_labels(self.labelnames, labels)} {total!r}')
+        lines.append(f'{self.name}_count{_labels(self.labelnames, labels)} {cumulative}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def expose(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+HANDLER_LATENCY = Histogram('bot_handler_seconds', 'Время работы хэндлера', ['handler'])
+HANDLER_ERRORS = Counter('bot_handler_errors_total', 'Необработанные исключения в хэндлерах', ['handler'])
+DB_LATENCY = Histogram('bot_db_seconds', 'Время выполнения функций работы с БД в пуле', ['function'])
+API_LATENCY = Histogram('bot_external_api_seconds', 'Время запросов к внешним API', ['service'])
+API_ERRORS = Counter('bot_external_api_errors_total', 'Ошибки запросов к внешним API', ['service'])
+CHART_RENDER = Histogram('bot_chart_render_seconds', 'Время рендера графика, включая ожидание в очереди')
+CHART_REJECTED = Counter('bot_chart_rejected_total', 'Рендеры, отклоненные из-за переполненной очереди')
+THROTTLE_EVENTS = Counter('bot_throttle_events_total', 'Решения лимитера запросов', ['result'])
+LOOP_LAG = Histogram('bot_event_loop_lag_seconds', 'Задержка срабатывания таймера event loop')
+
+
+async def monitor_event_loop(interval=LOOP_LAG_INTERVAL):
+    """
+    Фоновая задача: насколько позже запланированного просыпается
+    asyncio.sleep - прямая мера блокировок event loop.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, loop.time() - started - interval))
+
+
+async def handle_metrics(request):
+    from aiohttp import web
+
+    return web.Response(text=REGISTRY.expose(), content_type='text/plain', charset='utf-8')
+
+
+async def start_server(host=METRICS_HOST, port=METRICS_PORT):
+    """
+    Локальный HTTP-сервер с /metrics. Возвращает runner
+    (для остановки) или None, если сервер выключен или порт занят.
+    """
+    if not port:
+        return None
+    from aiohttp import web
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        logging.warning('Сервер метрик не запущен на %s:%s: %s', host, port, e)
+        await runner.cleanup()
+        return None
+    logging.info('Метрики: http://%s:%s/metrics', host, port)
+    return runner
+
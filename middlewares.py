@@ -0,0 +1,184 @@
+"""
+Защита от пользователя, который заваливает бота запросами: лимиты
+по токен-бакетам на пользователя и на тяжелые команды, плюс склейка
+одинаковых запросов, пока первый еще обрабатывается.
+
+Состояние живет в памяти процесса. В многопроцессном режиме
+(sharding.py) это корректно: пользователь всегда попадает в один воркер.
+"""
+import os
+import math
+import time
+import asyncio
+from collections import Counter
+
+from aiogram import BaseMiddleware
+from aiogram.types import Message, CallbackQuery
+
+import metrics
+from cache import TTLCache, MISSING
+
+# Общий лимит на пользователя: запросов в секунду и запас на всплеск
+THROTTLE_RATE = float(os.getenv('THROTTLE_RATE', '2'))
+THROTTLE_BURST = float(os.getenv('THROTTLE_BURST', '10'))
+# Сколько секунд помнить бакет неактивного пользователя
+THROTTLE_IDLE_TTL = float(os.getenv('THROTTLE_IDLE_TTL', '600'))
+
+# Отдельные лимиты для дорогих команд: (запросов в секунду, всплеск).
+# Для callback'ов командой считается callback_data.
+COMMAND_LIMITS = {
+    '/log_food': (0.5, 3),
+    '/undo': (0.5, 3),
+    '/test': (0.2, 2),
+    '/show_statistics': (0.5, 3),
+    'btn_week': (0.2, 3),
+    'btn_month': (0.2, 3),
+    'btn_year': (0.2, 3),
+    'btn_all': (0.2, 3),
+    '/export': (1 / 60, 2),
+}
+
+# Запросы, которые склеиваются: повтор с тем же текстом/данными,
+# пока первый в работе, не запускает вторую обработку. Только чтение:
+# повтор команды записи (/log_food) - это еще одна запись
+COALESCED_COMMANDS = {'/test', 'btn_week', 'btn_month', 'btn_year', 'btn_all', '/export'}
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated_at', 'warned')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        # предупреждение о лимите отправляется один раз, пока бакет пуст
+        self.warned = False
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.warned = False
+            return True
+        return False
+
+    def retry_after(self):
+        return (1 - self.tokens) / self.rate
+
+
+def event_command(event):
+    if isinstance(event, CallbackQuery):
+        return event.data or ''
+    text = event.text or event.caption or ''
+    if text.startswith('/'):
+        return text.split(maxsplit=1)[0].split('@')[0]
+    # ответы внутри анкет и прочий текст
+    return ''
+
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """
+    Outer-middleware для message и callback_query: отсекает запросы
+    сверх лимита до фильтров и хэндлеров.
+    """
+
+    def __init__(self, rate=THROTTLE_RATE, burst=THROTTLE_BURST,
+                 command_limits=COMMAND_LIMITS, coalesced=COALESCED_COMMANDS, idle_ttl=THROTTLE_IDLE_TTL):
+        self.rate = rate
+        self.burst = burst
+        self.command_limits = command_limits
+        self.coalesced = coalesced
+        self.buckets = TTLCache(maxsize=100000, ttl=idle_ttl)
+        self.counters = Counter()
+        self._inflight = {}
+
+    def _bucket(self, key, rate, burst):
+        bucket = self.buckets.get(key)
+        if bucket is MISSING:
+            bucket = TokenBucket(rate, burst)
+        # обновляем срок жизни при каждом обращении
+        self.buckets.set(key, bucket)
+        return bucket
+
+    def _check(self, user_id, command):
+        bucket = self._bucket(user_id, self.rate, self.burst)
+        if not bucket.take():
+            return bucket
+        limit = self.command_limits.get(command)
+        if limit:
+            bucket = self._bucket((user_id, command), *limit)
+            if not bucket.take():
+                return bucket
+        return None
+
+    async def __call__(self, handler, event, data):
+        user = data.get('event_from_user')
+        if user is None:
+            return await handler(event, data)
+        command = event_command(event)
+
+        empty = self._check(user.id, command)
+        if empty is not None:
+            self.counters['throttled', command] += 1
+            metrics.THROTTLE_EVENTS.inc('throttled')
+            await self._reject(event, empty)
+            return None
+
+        if command not in self.coalesced:
+            self.counters['passed', command] += 1
+            metrics.THROTTLE_EVENTS.inc('passed')
+            return await handler(event, data)
+
+        key = (user.id, event.data if isinstance(event, CallbackQuery) else event.text)
+        task = self._inflight.get(key)
+        if task is not None:
+            self.counters['coalesced', command] += 1
+            metrics.THROTTLE_EVENTS.inc('coalesced')
+            if isinstance(event, CallbackQuery):
+                await event.answer()
+            # shield: повтор не должен отменять исходную обработку
+            return await asyncio.shield(task)
+
+        self.counters['passed', command] += 1
+        metrics.THROTTLE_EVENTS.inc('passed')
+        task = asyncio.ensure_future(handler(event, data))
+        self._inflight[key] = task
+        task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _reject(self, event, bucket):
+        if isinstance(event, CallbackQuery):
+            await event.answer(f'Слишком часто, попробуйте через {math.ceil(bucket.retry_after())} с')
+        elif isinstance(event, Message) and not bucket.warned:
+            bucket.warned = True
+            await event.answer(f'Слишком много запросов, подождите {math.ceil(bucket.retry_after())} с')
+
+    def stats(self):
+        stats = {'passed': 0, 'throttled': 0, 'coalesced': 0, 'commands': {}}
+        for (kind, command), count in self.counters.items():
+            stats[kind] += count
+            stats['commands'].setdefault(command or 'text', Counter())[kind] += count
+        stats['inflight'] = len(self._inflight)
+        stats['buckets'] = len(self.buckets)
+        return stats
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    Inner-middleware: время работы и исключения каждого хэндлера,
+    метка - имя функции хэндлера.
+    """
+
+    async def __call__(self, handler, event, data):
+        name = data['handler'].callback.__name__
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            metrics.HANDLER_LATENCY.observe(time.perf_counter() - start, name)
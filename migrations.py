@@ -0,0 +1,389 @@
+"""
+Версионные миграции схемы users.db.
+
+Примененные версии записываются в таблицу schema_version. Миграции
+выполняются строго по порядку и идемпотентны, так что их можно
+запускать из нескольких процессов сразу и повторять после сбоя.
+
+Обычная миграция (DDL) выполняется одной транзакцией при старте.
+Онлайн-миграция обрабатывает большую таблицу пачками по
+MIGRATION_BATCH_ROWS строк: каждая пачка - отдельная короткая
+транзакция, позиция сохраняется в schema_version вместе с пачкой,
+а между пачками бот спокойно пишет. Онлайн-миграции идут в фоне
+после старта бота (bd_operations.migrate_online) или из консоли, а
+следующие за ними обычные миграции применяются при старте, не
+дожидаясь их:
+
+    python migrations.py
+    python migrations.py --status
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+
+MIGRATION_BATCH_ROWS = int(os.getenv('MIGRATION_BATCH_ROWS', '1000'))
+# Пауза между пачками онлайн-миграции, чтобы запись бота не ждала блокировку
+MIGRATION_PAUSE = float(os.getenv('MIGRATION_PAUSE', '0.005'))
+
+# Номер дня от 1970-01-01 для даты 'YYYY-MM-DD' (NULL для неверной даты)
+DAY_NUMBER_SQL = 'CAST(julianday({}) - 2440587.5 AS INTEGER)'
+
+
+def _base_schema(connection):
+    # таблицы, которые init_db создавал до появления версий;
+    # на существующей базе ничего не меняет
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS profiles (
+            user_id INTEGER PRIMARY KEY,
+            weight REAL,
+            height REAL,
+            age INTEGER,
+            activity INTEGER,
+            city VARCHAR(50),
+            water_norm INTEGER,
+            calories_norm INTEGER
+        )
+    ''')
+
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS daily_statistics (
+            user_id INTEGER,
+            date DATE,
+            water_as_is INTEGER,
+            calories_burned INTEGER,
+            calories_consumed INTEGER,
+            water_norm INTEGER,
+            calories_norm INTEGER,
+            PRIMARY KEY (user_id, date)
+        )
+    ''')
+
+    # Помесячные суммы по пользователю для графика за год
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS monthly_statistics (
+            user_id INTEGER,
+            month TEXT,
+            days INTEGER,
+            water_as_is INTEGER,
+            calories_burned INTEGER,
+            calories_consumed INTEGER,
+            water_norm INTEGER,
+            calories_norm INTEGER,
+            PRIMARY KEY (user_id, month)
+        )
+    ''')
+
+    # Надбавка к норме воды за жару на конкретный день (см. norms.py);
+    # хранится только для пользователей с ненулевой надбавкой
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS water_adjustments (
+            user_id INTEGER PRIMARY KEY,
+            date DATE,
+            adjustment INTEGER
+        )
+    ''')
+    connection.execute('CREATE INDEX IF NOT EXISTS idx_profiles_city ON profiles (city)')
+
+    # Расписание напоминаний (см. reminders.py): время следующего
+    # напоминания в unix-секундах и интервал между ними
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS reminders (
+            user_id INTEGER PRIMARY KEY,
+            next_at INTEGER NOT NULL,
+            interval INTEGER NOT NULL
+        )
+    ''')
+    connection.execute('CREATE INDEX IF NOT EXISTS idx_reminders_next_at ON reminders (next_at)')
+
+    # Состояния FSM (анкеты Profile/Product), см. fsm_storage.py
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            expires_at INTEGER
+        ) WITHOUT ROWID
+    ''')
+
+
+def _water_adjustments_by_date(connection):
+    # apply_water_adjustments выбирает и чистит надбавки по дате
+    # (user_id - rowid, он и так есть в индексе)
+    connection.execute('CREATE INDEX IF NOT EXISTS idx_water_adjustments_date ON water_adjustments (date)')
+
+
+def _daily_statistics_days(connection):
+    # Индекс (день, user_id) дневной статистики для выборок за диапазон
+    # дат по всем пользователям. Это таблица, а не CREATE INDEX: индекс
+    # строится одним запросом под блокировкой записи (секунды на
+    # миллионах строк), а таблицу можно заполнить пачками. Новые строки
+    # попадают в нее триггером с момента этой миграции
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS daily_statistics_days (
+            day INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            PRIMARY KEY (day, user_id)
+        ) WITHOUT ROWID
+    ''')
+    connection.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS daily_statistics_days_insert AFTER INSERT ON daily_statistics
+        BEGIN
+            INSERT OR IGNORE INTO daily_statistics_days (day, user_id)
+            VALUES ({DAY_NUMBER_SQL.format('NEW.date')}, NEW.user_id);
+        END
+    ''')
+    connection.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS daily_statistics_days_delete AFTER DELETE ON daily_statistics
+        BEGIN
+            DELETE FROM daily_statistics_days
+            WHERE day = {DAY_NUMBER_SQL.format('OLD.date')} AND user_id = OLD.user_id;
+        END
+    ''')
+
+
+def _backfill_daily_statistics_days(connection, position, batch_rows):
+    # строки, записанные до триггера, - пачками по первичному ключу;
+    # все, что вставлено позже позиции, уже добавил триггер
+    user_id, date = position or (-1, '')
+    rows = connection.execute(
+        f'''SELECT user_id, date, {DAY_NUMBER_SQL.format('date')} FROM daily_statistics
+            WHERE (user_id, date) > (?, ?) ORDER BY user_id, date LIMIT ?''',
+        (user_id, date, batch_rows)
+    ).fetchall()
+    if not rows:
+        return None
+    connection.executemany(
+        'INSERT OR IGNORE INTO daily_statistics_days (day, user_id) VALUES (?, ?)',
+        [(day, user_id) for user_id, _, day in rows]
+    )
+    return rows[-1][:2]
+
+
+def _activity_events(connection):
+    # Журнал действий пользователя; daily_statistics - его проекция
+    # (см. bd_operations.PROJECT_EVENTS). update_id - апдейт Telegram,
+    # из которого пришло событие: повторная доставка того же апдейта
+    # не записывается. reverts - id события, которое отменяет это
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS activity_events (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            created_at INTEGER NOT NULL,
+            date DATE NOT NULL,
+            kind TEXT NOT NULL,
+            amount INTEGER NOT NULL,
+            update_id INTEGER,
+            reverts INTEGER
+        )
+    ''')
+    connection.execute('CREATE INDEX IF NOT EXISTS idx_activity_events_user_date ON activity_events (user_id, date)')
+    # update_id после недели простоя бота Telegram выбирает случайно,
+    # поэтому уникальность - вместе с пользователем
+    connection.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_activity_events_update
+        ON activity_events (update_id, user_id, kind) WHERE update_id IS NOT NULL
+    ''')
+    connection.execute('''
+        CREATE INDEX IF NOT EXISTS idx_activity_events_reverts
+        ON activity_events (reverts) WHERE reverts IS NOT NULL
+    ''')
+
+
+def _backfill_monthly_statistics(connection, position, batch_rows):
+    # помесячная сводка из daily_statistics пачками пользователей: до
+    # пользователя, на котором набирается batch_rows дневных строк
+    # (его строки - целиком). Запись бота пересчитывает свои месяцы
+    # сама, поэтому пересчет готовых пользователей ничего не портит
+    after = -2 ** 63 if position is None else position
+    row = connection.execute(
+        'SELECT user_id FROM daily_statistics WHERE user_id > ? ORDER BY user_id LIMIT 1 OFFSET ?',
+        (after, batch_rows - 1)
+    ).fetchone()
+    if row is None:
+        row = connection.execute('SELECT MAX(user_id) FROM daily_statistics WHERE user_id > ?', (after, )).fetchone()
+        if row[0] is None:
+            return None
+    connection.execute(
+        '''INSERT OR REPLACE INTO monthly_statistics
+           (user_id, month, days, water_as_is, calories_burned, calories_consumed, water_norm, calories_norm)
+           SELECT user_id, substr(date, 1, 7), COUNT(*), SUM(water_as_is), SUM(calories_burned),
+                  SUM(calories_consumed), SUM(water_norm), SUM(calories_norm)
+           FROM daily_statistics
+           WHERE user_id > ? AND user_id <= ?
+           GROUP BY user_id, substr(date, 1, 7)''',
+        (after, row[0])
+    )
+    return row[0]
+
+
+# (версия, название, функция, онлайн). Онлайн-функция получает позицию
+# предыдущей пачки и возвращает новую или None, когда все готово
+MIGRATIONS = (
+    (1, 'base schema', _base_schema, False),
+    (2, 'index water_adjustments by date', _water_adjustments_by_date, False),
+    (3, 'daily_statistics_days table and triggers', _daily_statistics_days, False),
+    (4, 'backfill daily_statistics_days', _backfill_daily_statistics_days, True),
+    (5, 'activity_events log', _activity_events, False),
+    (6, 'backfill monthly_statistics', _backfill_monthly_statistics, True),
+)
+# С этой версии daily_statistics_days содержит все дни
+DAILY_STATISTICS_DAYS_VERSION = 4
+# Дни после даты этой миграции целиком построены из activity_events
+ACTIVITY_EVENTS_VERSION = 5
+# С этой версии monthly_statistics заполнена для всех пользователей
+MONTHLY_STATISTICS_VERSION = 6
+
+
+def _ensure_version_table(connection):
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at INTEGER,
+            position TEXT
+        )
+    ''')
+
+
+def _state(connection, version):
+    # (applied_at, позиция) или None, если миграция не начиналась
+    row = connection.execute(
+        'SELECT applied_at, position FROM schema_version WHERE version = ?', (version, )
+    ).fetchone()
+    if row is None:
+        return None
+    return row[0], json.loads(row[1]) if row[1] else None
+
+
+def is_applied(connection, version):
+    state = _state(connection, version)
+    return state is not None and state[0] is not None
+
+
+def applied_at(connection, version):
+    # unix-время применения миграции или None
+    state = _state(connection, version)
+    return state and state[0]
+
+
+def status(connection):
+    _ensure_version_table(connection)
+    connection.commit()
+    return [(version, name, online, _state(connection, version)) for version, name, _, online in MIGRATIONS]
+
+
+def _run(connection, version, name, migration):
+    # BEGIN IMMEDIATE: параллельный процесс ждет и видит уже примененную версию
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        if not is_applied(connection, version):
+            migration(connection)
+            connection.execute(
+                'INSERT OR REPLACE INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)',
+                (version, name, int(time.time()))
+            )
+            logging.info(f'Миграция {version} ({name}) применена')
+        connection.commit()
+    except BaseException:
+        connection.rollback()
+        raise
+
+
+def _run_online(connection, version, name, migration, batch_rows, pause, stop):
+    batches = 0
+    longest = 0.0
+    start = time.perf_counter()
+    while True:
+        batch_start = time.perf_counter()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            state = _state(connection, version)
+            if state is not None and state[0] is not None:
+                connection.commit()
+                return True
+            position = migration(connection, state and state[1], batch_rows)
+            connection.execute(
+                'INSERT OR REPLACE INTO schema_version (version, name, applied_at, position) VALUES (?, ?, ?, ?)',
+                (version, name, None if position is not None else int(time.time()),
+                 json.dumps(position) if position is not None else None)
+            )
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+        elapsed = time.perf_counter() - batch_start
+        longest = max(longest, elapsed)
+        if position is None:
+            logging.info(f'Миграция {version} ({name}) применена: {batches} пачек '
+                         f'за {time.perf_counter() - start:.1f} с, самая долгая {longest * 1000:.0f} мс')
+            return True
+        batches += 1
+        # Ждущий блокировку писатель SQLite проверяет ее с нарастающим
+        # интервалом (busy_timeout), поэтому пауза не короче самой пачки -
+        # иначе он не успевает между пачками. Остановка при выключении
+        # бота; миграция продолжится с позиции при следующем старте
+        if stop.wait(max(pause, elapsed)):
+            return False
+
+
+def migrate(connection, online=True, batch_rows=MIGRATION_BATCH_ROWS, pause=MIGRATION_PAUSE, stop=None):
+    """
+    Применить недостающие миграции по порядку. С online=False
+    онлайн-миграции (заполнение пачками) пропускаются до следующего
+    запуска (быстрый старт), а обычные после них применяются: от
+    заполнения зависят только запросы, которые проверяют is_applied.
+    stop (threading.Event) прерывает онлайн-миграцию между пачками.
+    Возвращает номер последней версии, до которой применено все.
+    """
+    stop = stop or threading.Event()
+    if connection.in_transaction:
+        connection.commit()
+    _ensure_version_table(connection)
+    connection.commit()
+    current = 0
+    complete = True
+    for version, name, migration, is_online in MIGRATIONS:
+        # без блокировки, если все уже применено (обычный старт)
+        if not is_applied(connection, version):
+            if not is_online:
+                _run(connection, version, name, migration)
+            elif not online or stop.is_set() or not _run_online(
+                    connection, version, name, migration, batch_rows, pause, stop):
+                complete = False
+                continue
+        if complete:
+            current = version
+    return current
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Миграции схемы users.db')
+    parser.add_argument('--status', action='store_true', help='только показать состояние')
+    parser.add_argument('--batch-rows', type=int, default=MIGRATION_BATCH_ROWS)
+    parser.add_argument('--pause', type=float, default=MIGRATION_PAUSE)
+    args = parser.parse_args()
+
+    import bd_operations as db
+
+    connection = db.get_connection()
+    if not args.status:
+        db.init_db()
+        migrate(connection, batch_rows=args.batch_rows, pause=args.pause)
+    for version, name, online, state in status(connection):
+        if state is None:
+            mark = 'не применена'
+        elif state[0] is None:
+            mark = f'в процессе, позиция {state[1]}'
+        else:
+            mark = 'применена'
+        print(f'{version:3d} {name}{" (онлайн)" if online else ""}: {mark}')
+    return 0
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    sys.exit(main())
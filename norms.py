@@ -0,0 +1,162 @@
+"""
+Расчет суточных норм и ежедневный пересчет нормы воды с учетом погоды.
+
+Векторные версии формул (*_np) считают нормы сразу для столбцов
+NumPy; ими пользуется массовый пересчет профилей после изменения формул:
+    python norms.py rescore --chunk-size 50000
+
+Задача пересчета раз в день берет города из профилей, запрашивает
+погоду по каждому городу один раз (не больше WATER_JOB_CONCURRENCY
+запросов одновременно) и короткими транзакциями обновляет надбавки за жару
+на сегодня (см. bd_operations.apply_water_adjustments).
+"""
+import os
+import sys
+import math
+import time
+import asyncio
+import logging
+import argparse
+import datetime
+
+import bd_operations as db
+
+# Час (по локальному времени сервера), в который пересчитываются нормы
+WATER_JOB_HOUR = int(os.getenv('WATER_JOB_HOUR', '6'))
+WATER_JOB_CONCURRENCY = int(os.getenv('WATER_JOB_CONCURRENCY', '10'))
+RESCORE_CHUNK_SIZE = int(os.getenv('RESCORE_CHUNK_SIZE', '50000'))
+
+
+def water_norm_calc(weight, activity, temperature=0):
+    """
+    Базовая норма=Вес×30мл/кг 
+    +500мл  за каждые 30 минут активности.
+    +500−1000мл  за жаркую погоду (> 25°C)
+    """
+
+    norm = weight*30 + 500*(int(activity)//30)
+    if temperature > 25:
+       norm += 750
+
+    return math.ceil(norm / 100) * 100
+
+
+def calories_norm_calc(weight, height, age, activity):
+    """
+    Норма калорий:
+    Калории=10*Вес (кг)+6.25*Рост (см)-5*Возраст 
+    + (минуты активности / 30) * 300 ккал
+    """
+
+    norm = 10*weight + 6.25*height - 5*age + (activity // 30)*300
+    return math.ceil(norm / 100) * 100
+
+
+def water_norm_calc_np(weight, activity, temperature=0):
+    # то же, что water_norm_calc, для массивов (int(activity) - отбрасывание дробной части)
+    import numpy as np
+
+    norm = weight * 30 + 500 * (np.trunc(activity) // 30) + np.where(np.asarray(temperature) > 25, 750, 0)
+    return (np.ceil(norm / 100) * 100).astype(np.int64)
+
+
+def calories_norm_calc_np(weight, height, age, activity):
+    import numpy as np
+
+    norm = 10 * weight + 6.25 * height - 5 * age + (activity // 30) * 300
+    return (np.ceil(norm / 100) * 100).astype(np.int64)
+
+
+def rescore_profiles(chunk_size=RESCORE_CHUNK_SIZE):
+    """
+    Пересчитать нормы всех профилей по текущим формулам: профили
+    читаются пачками по первичному ключу, нормы считаются векторно,
+    измененные записываются executemany (транзакция на пачку, чтобы
+    не держать блокировку записи у работающего бота).
+    Возвращает (просмотрено, изменено).
+    """
+    import numpy as np
+
+    seen = changed = 0
+    for user_ids, columns in db.iter_profile_columns(chunk_size):
+        weight, height, age, activity, water_norm, calories_norm = columns
+        with np.errstate(invalid='ignore'):
+            new_water = water_norm_calc_np(weight, activity)
+            new_calories = calories_norm_calc_np(weight, height, age, activity)
+        # профили с мусором или пустыми полями не трогаем
+        valid = (weight > 0) & ~np.isnan(height + age + activity)
+        mask = valid & ((new_water != water_norm) | (new_calories != calories_norm))
+        db.update_profile_norms(zip(
+            new_water[mask].tolist(), new_calories[mask].tolist(), user_ids[mask].tolist()
+        ))
+        seen += len(user_ids)
+        changed += int(np.count_nonzero(mask))
+    db.profiles_cache.clear()
+    return seen, changed
+
+
+def water_adjustment(weight, activity, temperature):
+    # надбавка за жару относительно нормы из профиля
+    return water_norm_calc(weight, activity, temperature) - water_norm_calc(weight, activity)
+
+
+async def fetch_temperatures(weather, cities, concurrency=WATER_JOB_CONCURRENCY):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(city):
+        async with semaphore:
+            return city, await weather.get_current_temperature(city)
+
+    return dict(await asyncio.gather(*(fetch(city) for city in cities)))
+
+
+async def recalculate_water_norms(weather, date=None, concurrency=WATER_JOB_CONCURRENCY):
+    date = date or datetime.date.today()
+    cities = await db.run(db.get_profile_cities)
+    temperatures = await fetch_temperatures(weather, cities, concurrency)
+    known = {city: temperature for city, temperature in temperatures.items() if temperature is not None}
+    changed = await db.run(db.apply_water_adjustments, date, known, water_adjustment)
+    return {
+        'cities': len(cities),
+        'users': sum(cities.values()),
+        'weather_failed': len(cities) - len(known),
+        'changed': changed,
+    }
+
+
+async def run_daily(weather, hour=WATER_JOB_HOUR):
+    """
+    Фоновая задача: пересчет при старте и затем каждый день в hour:00.
+    Повторный пересчет за тот же день ничего не меняет.
+    """
+    while True:
+        try:
+            result = await recalculate_water_norms(weather)
+            logging.info('Нормы воды пересчитаны: %s', result)
+        except Exception:
+            logging.exception('Ошибка пересчета норм воды')
+
+        now = datetime.datetime.now()
+        next_run = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+        if next_run <= now:
+            next_run += datetime.timedelta(days=1)
+        await asyncio.sleep((next_run - now).total_seconds())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Нормы воды и калорий')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    rescore = subparsers.add_parser('rescore', help='пересчитать нормы всех профилей')
+    rescore.add_argument('--chunk-size', type=int, default=RESCORE_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    db.init_db()
+    if args.command == 'rescore':
+        start = time.perf_counter()
+        seen, changed = rescore_profiles(args.chunk_size)
+        print(f'{seen} профилей, изменено {changed} за {time.perf_counter() - start:.1f} с')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
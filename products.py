@@ -0,0 +1,286 @@
+"""
+Локальный индекс калорийности продуктов (SQLite FTS5).
+
+Загрузка дампа OpenFoodFacts (CSV с разделителем табуляцией):
+    python products.py load en.openfoodfacts.org.products.csv
+Поиск:
+    python products.py search "куриная грудка"
+"""
+import os
+import re
+import sys
+import csv
+import time
+import sqlite3
+import asyncio
+import argparse
+import threading
+from difflib import SequenceMatcher
+
+import aiohttp
+
+import metrics
+import bd_operations as db
+from cache import TTLCache, MISSING
+
+PRODUCTS_DB_PATH = os.getenv('PRODUCTS_DB_PATH', 'products.db')
+OPENFOODFACTS_URL = os.getenv('OPENFOODFACTS_URL', 'https://world.openfoodfacts.org/cgi/search.pl')
+OPENFOODFACTS_TIMEOUT = float(os.getenv('OPENFOODFACTS_TIMEOUT', '5'))
+
+
+def normalize(name):
+    return ' '.join(re.findall(r'\w+', name.lower().replace('ё', 'е')))
+
+
+def _match_query(tokens, stem=False):
+    terms = []
+    for token in tokens:
+        # грубый стемминг для русских окончаний: "яблоки" -> "ябло"
+        if stem and len(token) > 4:
+            token = token[:-2]
+        terms.append('"' + token.replace('"', '') + '"*')
+    return ' AND '.join(terms)
+
+
+class ProductIndex:
+    """
+    Индекс продуктов на SQLite FTS5 с префиксным и нечетким поиском.
+    """
+
+    def __init__(self, path=PRODUCTS_DB_PATH):
+        self.path = path
+        self._local = threading.local()
+        # база и схема создаются при первом соединении, а не при импорте бота
+        self._schema_ready = False
+        self._schema_lock = threading.Lock()
+
+    def get_connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, cached_statements=64, check_same_thread=False)
+            for pragma in db.PRAGMAS:
+                connection.execute(pragma)
+            self._local.connection = connection
+            if not self._schema_ready:
+                with self._schema_lock:
+                    if not self._schema_ready:
+                        self.init_schema(connection)
+                        self._schema_ready = True
+        return connection
+
+    def init_schema(self, connection):
+        with connection:
+            connection.execute('''
+                CREATE TABLE IF NOT EXISTS products (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    name_key TEXT NOT NULL UNIQUE,
+                    calories_per_100g REAL NOT NULL
+                )
+            ''')
+            connection.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+                    name_key,
+                    content='products',
+                    content_rowid='id',
+                    tokenize='unicode61 remove_diacritics 2',
+                    prefix='2 3'
+                )
+            ''')
+
+    def add(self, name, calories_per_100g):
+        name_key = normalize(name)
+        if not name_key:
+            return
+        connection = self.get_connection()
+        with connection:
+            cursor = connection.execute(
+                'INSERT OR IGNORE INTO products (name, name_key, calories_per_100g) VALUES (?, ?, ?)',
+                (name, name_key, calories_per_100g)
+            )
+            if cursor.rowcount == 1:
+                connection.execute(
+                    'INSERT INTO products_fts (rowid, name_key) VALUES (?, ?)',
+                    (cursor.lastrowid, name_key)
+                )
+
+    def load_csv(self, path, batch_size=10000):
+        """
+        Потоковая загрузка дампа OpenFoodFacts, индекс FTS
+        перестраивается один раз в конце.
+        """
+        csv.field_size_limit(sys.maxsize)
+        connection = self.get_connection()
+        loaded = 0
+
+        with open(path, newline='', encoding='utf-8') as file:
+            reader = csv.DictReader(file, delimiter='\t')
+            batch = []
+            with connection:
+                for row in reader:
+                    name = (row.get('product_name') or '').strip()
+                    calories = row.get('energy-kcal_100g')
+                    try:
+                        calories = float(calories)
+                    except (TypeError, ValueError):
+                        continue
+                    name_key = normalize(name)
+                    if not name_key or not 0 < calories < 1000:
+                        continue
+                    batch.append((name, name_key, calories))
+                    if len(batch) >= batch_size:
+                        connection.executemany(
+                            'INSERT OR IGNORE INTO products (name, name_key, calories_per_100g) VALUES (?, ?, ?)',
+                            batch
+                        )
+                        loaded += len(batch)
+                        batch = []
+                connection.executemany(
+                    'INSERT OR IGNORE INTO products (name, name_key, calories_per_100g) VALUES (?, ?, ?)',
+                    batch
+                )
+                loaded += len(batch)
+                connection.execute("INSERT INTO products_fts (products_fts) VALUES ('rebuild')")
+
+        return loaded
+
+    def search(self, name, limit=20):
+        tokens = normalize(name).split()
+        if not tokens:
+            return None
+        query = ' '.join(tokens)
+        connection = self.get_connection()
+
+        row = connection.execute(
+            'SELECT name, calories_per_100g FROM products WHERE name_key = ?', (query, )
+        ).fetchone()
+        if row:
+            return {'name': row[0], 'calories_per_100g': row[1]}
+
+        for stem in (False, True):
+            rows = connection.execute('''
+                SELECT p.name, p.name_key, p.calories_per_100g
+                FROM products_fts f JOIN products p ON p.id = f.rowid
+                WHERE products_fts MATCH ?
+                ORDER BY bm25(products_fts)
+                LIMIT ?
+                ''',
+                (_match_query(tokens, stem), limit)
+            ).fetchall()
+            if rows:
+                best = max(rows, key=lambda r: SequenceMatcher(None, query, r[1]).ratio())
+                return {'name': best[0], 'calories_per_100g': best[2]}
+
+        return None
+
+
+class ProductCatalog:
+    """
+    Поиск калорийности: сначала локальный индекс, при промахе -
+    OpenFoodFacts, найденное сохраняется в индекс.
+    """
+
+    def __init__(self, index=None, base_url=OPENFOODFACTS_URL, timeout=OPENFOODFACTS_TIMEOUT):
+        self.index = index or ProductIndex()
+        self.base_url = base_url
+        self.timeout = timeout
+        self.misses = TTLCache(maxsize=10000, ttl=3600)
+        self.remote_requests = 0
+        self._session = None
+        self._inflight = {}
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=20, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def get_product_calories(self, product_name):
+        product = await db.run(self.index.search, product_name)
+        if product:
+            return product
+
+        key = normalize(product_name)
+        if self.misses.get(key) is not MISSING:
+            return None
+
+        # одинаковые запросы к OpenFoodFacts от разных пользователей склеиваются
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._lookup_remote(product_name, key))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def get_products_calories(self, product_names):
+        """
+        Калорийность нескольких продуктов: поиск в индексе и запросы
+        к OpenFoodFacts (общая сессия с таймаутом) идут параллельно.
+        """
+        return await asyncio.gather(*(self.get_product_calories(name) for name in product_names))
+
+    async def _lookup_remote(self, product_name, key):
+        product = await self.fetch_remote(product_name)
+        if product:
+            await db.run(self._remember, product_name, product)
+        else:
+            self.misses.set(key, True)
+        return product
+
+    def _remember(self, query, product):
+        self.index.add(query, product['calories_per_100g'])
+        self.index.add(product['name'], product['calories_per_100g'])
+
+    async def fetch_remote(self, product_name):
+        params = {
+            'search_terms': product_name,
+            'json': 1,
+            'page_size': 1
+        }
+        self.remote_requests += 1
+        start = time.perf_counter()
+        try:
+            async with self._get_session().get(self.base_url, params=params) as response:
+                data = await response.json(content_type=None)
+        except (aiohttp.ClientError, TimeoutError, ValueError):
+            metrics.API_ERRORS.inc('openfoodfacts')
+            return None
+        finally:
+            metrics.API_LATENCY.observe(time.perf_counter() - start, 'openfoodfacts')
+
+        if data.get('products'):
+            product = data['products'][0]
+            calories = product.get('nutriments', {}).get('energy-kcal_100g')
+            if calories:
+                return {
+                    'name': product.get('product_name') or product_name,
+                    'calories_per_100g': calories
+                }
+        return None
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Локальный индекс продуктов')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    load = subparsers.add_parser('load')
+    load.add_argument('csv_path')
+    search = subparsers.add_parser('search')
+    search.add_argument('name')
+    args = parser.parse_args()
+
+    index = ProductIndex()
+    if args.command == 'load':
+        print(f'Загружено строк: {index.load_csv(args.csv_path)}')
+    else:
+        print(index.search(args.name))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,226 @@
+"""
+Напоминания пользователям, которые отстают от дневной нормы воды
+или калорий.
+
+Расписание хранится в таблице reminders (время следующего напоминания
+по индексу). В памяти держится только куча ближайших напоминаний на
+REMINDER_WINDOW секунд вперед; окно перечитывается из БД, так что
+напоминания, включенные в других процессах, тоже подхватываются.
+Сработавшие пользователи проверяются пачкой одним запросом, сообщения
+уходят через общий лимитер, чтобы не превысить лимиты Telegram.
+"""
+import os
+import time
+import heapq
+import asyncio
+import logging
+import datetime
+
+from aiogram.exceptions import (TelegramForbiddenError, TelegramBadRequest, TelegramRetryAfter,
+                                TelegramNetworkError)
+
+import bd_operations as db
+from middlewares import TokenBucket
+
+# Включается ровно на одном экземпляре: каждая реплика с планировщиком
+# шлет те же напоминания, поэтому по умолчанию выключено
+REMINDERS_ENABLED = os.getenv('REMINDERS_ENABLED', '0') == '1'
+# Интервал по умолчанию между напоминаниями, часы
+REMINDER_INTERVAL_HOURS = float(os.getenv('REMINDER_INTERVAL_HOURS', '3'))
+# Напоминания приходят только с START до END часов по времени сервера
+REMINDER_START_HOUR = int(os.getenv('REMINDER_START_HOUR', '9'))
+REMINDER_END_HOUR = int(os.getenv('REMINDER_END_HOUR', '21'))
+# Отставание: выпито/съедено меньше этой доли от нормы, положенной к этому часу
+REMINDER_LAG_RATIO = float(os.getenv('REMINDER_LAG_RATIO', '0.8'))
+REMINDER_WINDOW = int(os.getenv('REMINDER_WINDOW', '600'))
+REMINDER_RELOAD_INTERVAL = float(os.getenv('REMINDER_RELOAD_INTERVAL', '60'))
+REMINDER_BATCH_SIZE = int(os.getenv('REMINDER_BATCH_SIZE', '500'))
+# Общий лимит Telegram - около 30 сообщений в секунду на бота
+TELEGRAM_RATE = float(os.getenv('TELEGRAM_RATE', '25'))
+
+
+def next_reminder_time(now, interval, start_hour=REMINDER_START_HOUR, end_hour=REMINDER_END_HOUR):
+    at = datetime.datetime.fromtimestamp(now + interval)
+    if at.hour < start_hour:
+        at = at.replace(hour=start_hour, minute=0, second=0, microsecond=0)
+    elif at.hour >= end_hour:
+        at = (at + datetime.timedelta(days=1)).replace(hour=start_hour, minute=0, second=0, microsecond=0)
+    return int(at.timestamp())
+
+
+def day_fraction(now, start_hour=REMINDER_START_HOUR, end_hour=REMINDER_END_HOUR):
+    # доля "активного" дня, прошедшая к моменту now
+    at = datetime.datetime.fromtimestamp(now)
+    hours = at.hour + at.minute / 60 - start_hour
+    return min(max(hours / (end_hour - start_hour), 0.0), 1.0)
+
+
+def reminder_text(water, water_norm, consumed, calories_norm, fraction, ratio=REMINDER_LAG_RATIO):
+    lines = []
+    if water < water_norm * fraction * ratio:
+        lines.append(f"Вода: выпито {water} из {water_norm} мл")
+    if consumed < calories_norm * fraction * ratio:
+        lines.append(f"Калории: {consumed} из {calories_norm} ккал")
+    if not lines:
+        return None
+    return "Напоминание о дневной норме:\n" + "\n".join(lines)
+
+
+class ReminderQueue:
+    """
+    Куча (время, user_id) ближайших напоминаний. Повторная загрузка
+    тех же записей из БД не создает дубликатов.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.keys = set()
+
+    def add(self, due, user_id):
+        key = (due, user_id)
+        if key not in self.keys:
+            self.keys.add(key)
+            heapq.heappush(self.heap, key)
+
+    def extend(self, rows):
+        for due, user_id in rows:
+            self.add(due, user_id)
+
+    def pop_due(self, now, limit):
+        batch = []
+        while self.heap and self.heap[0][0] <= now and len(batch) < limit:
+            key = heapq.heappop(self.heap)
+            self.keys.discard(key)
+            batch.append(key)
+        return batch
+
+    def next_due(self):
+        return self.heap[0][0] if self.heap else None
+
+    def __len__(self):
+        return len(self.heap)
+
+
+class RateLimiter:
+    """
+    Общий для всех отправок токен-бакет: acquire() ждет, пока
+    появится токен. После RetryAfter от Telegram отправка
+    приостанавливается целиком.
+    """
+
+    def __init__(self, rate=TELEGRAM_RATE, burst=None):
+        self.bucket = TokenBucket(rate, burst or rate)
+        self.paused_until = 0.0
+
+    async def acquire(self):
+        while True:
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            elif self.bucket.take():
+                return
+            else:
+                await asyncio.sleep(self.bucket.retry_after())
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class ReminderScheduler:
+    def __init__(self, bot, limiter=None, window=REMINDER_WINDOW,
+                 reload_interval=REMINDER_RELOAD_INTERVAL, batch_size=REMINDER_BATCH_SIZE):
+        self.bot = bot
+        self.limiter = limiter or RateLimiter()
+        self.window = window
+        self.reload_interval = reload_interval
+        self.batch_size = batch_size
+        self.queue = ReminderQueue()
+        self.loaded_until = 0
+        self.loaded_at = 0.0
+        self.stats = {'sent': 0, 'skipped': 0, 'failed': 0}
+        self._wakeup = asyncio.Event()
+
+    async def schedule(self, user_id, interval):
+        next_at = next_reminder_time(time.time(), interval)
+        await db.run(db.set_reminder, user_id, next_at, interval)
+        if next_at <= self.loaded_until:
+            self.queue.add(next_at, user_id)
+            self._wakeup.set()
+        return next_at
+
+    async def cancel(self, user_id):
+        # запись в куче останется и будет отброшена при проверке
+        await db.run(db.delete_reminder, user_id)
+
+    async def _load(self, now):
+        until = int(now) + self.window
+        self.queue.extend(await db.run(db.get_due_reminders, until))
+        self.loaded_until = until
+        self.loaded_at = time.monotonic()
+
+    async def run(self):
+        while True:
+            now = time.time()
+            if now + self.window / 2 >= self.loaded_until or time.monotonic() - self.loaded_at >= self.reload_interval:
+                await self._load(now)
+
+            batch = self.queue.pop_due(now, self.batch_size)
+            if batch:
+                try:
+                    await self.process(batch, now)
+                except Exception:
+                    logging.exception('Ошибка отправки напоминаний')
+                continue
+
+            next_due = self.queue.next_due() or self.loaded_until
+            timeout = min(max(next_due - now, 0.05), self.reload_interval)
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def process(self, batch, now):
+        progress = await db.run(
+            db.get_reminder_progress, [user_id for _, user_id in batch], datetime.date.fromtimestamp(now)
+        )
+        fraction = day_fraction(now)
+        sends = []
+        reschedule = []
+        for due, user_id in batch:
+            row = progress.get(user_id)
+            # напоминание выключено или перенесено после загрузки в кучу
+            if row is None or row[0] != due:
+                continue
+            next_at, interval, water, water_norm, consumed, calories_norm = row
+            reschedule.append((next_reminder_time(now, interval), user_id))
+            text = reminder_text(water, water_norm, consumed, calories_norm, fraction)
+            if text is None:
+                self.stats['skipped'] += 1
+                continue
+            await self.limiter.acquire()
+            sends.append(asyncio.create_task(self._send(user_id, text)))
+
+        await db.run(db.reschedule_reminders, reschedule)
+        for next_at, user_id in reschedule:
+            if next_at <= self.loaded_until:
+                self.queue.add(next_at, user_id)
+        await asyncio.gather(*sends)
+
+    async def _send(self, user_id, text):
+        for _ in range(3):
+            try:
+                await self.bot.send_message(user_id, text)
+                self.stats['sent'] += 1
+                return
+            except TelegramRetryAfter as e:
+                self.limiter.pause(e.retry_after)
+                await self.limiter.acquire()
+            except TelegramNetworkError:
+                await asyncio.sleep(1)
+                await self.limiter.acquire()
+            except (TelegramForbiddenError, TelegramBadRequest):
+                # пользователь заблокировал бота - напоминания больше не нужны
+                await self.cancel(user_id)
+                break
+        self.stats['failed'] += 1
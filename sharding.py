@@ -0,0 +1,203 @@
+"""
+Многопроцессный режим: фронт-процесс получает апдейты (polling или
+webhook) и раздает их по user_id в N процессов-воркеров. У каждого
+воркера свой event loop, свои соединения с БД и пул графиков;
+апдейты одного пользователя всегда попадают в один воркер и
+обрабатываются в порядке поступления.
+
+Включается переменной BOT_WORKERS > 1 при запуске bot.py.
+Воркер запускается как `python sharding.py worker`, апдейты приходят
+ему в stdin по одному JSON на строку.
+"""
+import os
+import sys
+import json
+import asyncio
+import logging
+
+import aiohttp
+from aiohttp import web
+
+# Пауза long polling после ошибки: от 1 с, вдвое за каждую ошибку подряд
+POLL_BACKOFF_MAX = float(os.getenv('POLL_BACKOFF_MAX', '60'))
+
+# Объекты апдейта, из которых берется отправитель
+_USER_FIELDS = ('message', 'edited_message', 'callback_query', 'inline_query',
+                'chosen_inline_result', 'pre_checkout_query', 'shipping_query',
+                'my_chat_member', 'chat_member', 'chat_join_request', 'poll_answer')
+
+
+def update_user_id(update):
+    for field in _USER_FIELDS:
+        event = update.get(field)
+        if event:
+            user = event.get('from') or event.get('user') or event.get('chat') or {}
+            return user.get('id', 0)
+    return 0
+
+
+class ShardRouter:
+    """
+    Процессы-воркеры и раздача им апдейтов по хэшу user_id.
+    """
+
+    def __init__(self, workers, command=None):
+        self.workers = workers
+        self.command = command or [sys.executable, os.path.abspath(__file__), 'worker']
+        self.processes = [None] * workers
+        self.routed = [0] * workers
+
+    async def _spawn(self, index):
+        env = dict(os.environ, SHARD_INDEX=str(index))
+        self.processes[index] = await asyncio.create_subprocess_exec(
+            *self.command, stdin=asyncio.subprocess.PIPE, env=env,
+        )
+
+    async def start(self):
+        await asyncio.gather(*(self._spawn(index) for index in range(self.workers)))
+
+    async def route(self, update, raw=None):
+        index = update_user_id(update) % self.workers
+        line = (raw if raw is not None else json.dumps(update).encode()).replace(b'\n', b' ') + b'\n'
+        for _ in range(2):
+            process = self.processes[index]
+            try:
+                # запись в канал умершего процесса asyncio не всегда
+                # превращает в ошибку - проверяем процесс заранее
+                if process.returncode is not None or process.stdin.is_closing():
+                    raise BrokenPipeError
+                process.stdin.write(line)
+                await process.stdin.drain()
+                self.routed[index] += 1
+                return
+            except (BrokenPipeError, ConnectionResetError):
+                # воркер упал - поднимаем заново и повторяем
+                await self._spawn(index)
+        logging.error('Апдейт %s не доставлен воркеру %s', update.get('update_id'), index)
+
+    async def stop(self):
+        for process in self.processes:
+            if process is not None and process.returncode is None:
+                process.stdin.close()
+        await asyncio.gather(*(process.wait() for process in self.processes if process is not None))
+
+
+async def poll_updates(router, api_url, token, timeout=30):
+    """
+    Long polling фронта: апдейты не разбираются в модели aiogram,
+    а пересылаются воркерам как есть.
+    """
+    url = f'{api_url}/bot{token}'
+    offset = None
+    delay = 1.0
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout + 10)) as session:
+        async with session.post(url + '/deleteWebhook') as response:
+            await response.read()
+        while True:
+            params = {'timeout': timeout}
+            if offset is not None:
+                params['offset'] = offset
+            try:
+                async with session.post(url + '/getUpdates', data=params) as response:
+                    payload = await response.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                logging.warning('Ошибка getUpdates: %r, повтор через %.0f с', e, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, POLL_BACKOFF_MAX)
+                continue
+            if not payload.get('ok'):
+                # 409 - установлен webhook или работает второй поллер, 401 - неверный токен
+                wait = max(delay, (payload.get('parameters') or {}).get('retry_after') or 0)
+                logging.error('getUpdates: %s %s, повтор через %.0f с',
+                              payload.get('error_code'), payload.get('description'), wait)
+                await asyncio.sleep(wait)
+                delay = min(delay * 2, POLL_BACKOFF_MAX)
+                continue
+            delay = 1.0
+            for update in payload['result']:
+                await router.route(update)
+                offset = update['update_id'] + 1
+
+
+def create_front_app(router, path, secret):
+    async def handle(request):
+        if secret and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != secret:
+            return web.Response(status=401)
+        raw = await request.read()
+        await router.route(json.loads(raw), raw)
+        return web.Response()
+
+    async def health(request):
+        return web.json_response({'status': 'ok', 'routed': router.routed})
+
+    app = web.Application()
+    app.router.add_post(path, handle)
+    app.router.add_get('/health', health)
+    return app
+
+
+async def run_front(workers, mode, api_url, token, webhook=None):
+    router = ShardRouter(workers)
+    await router.start()
+    try:
+        if mode == 'webhook':
+            url, path, secret, host, port = webhook
+            runner = web.AppRunner(create_front_app(router, path, secret))
+            await runner.setup()
+            await web.TCPSite(runner, host, port).start()
+            if url:
+                async with aiohttp.ClientSession() as session:
+                    params = {'url': url + path}
+                    if secret:
+                        params['secret_token'] = secret
+                    async with session.post(f'{api_url}/bot{token}/setWebhook', data=params) as response:
+                        await response.read()
+            await asyncio.Event().wait()
+        else:
+            await poll_updates(router, api_url, token)
+    finally:
+        await router.stop()
+
+
+async def run_worker():
+    import bot as app
+
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader(limit=16 * 1024 * 1024)
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+
+    await app.dp.emit_startup(bot=app.bot)
+    tails = {}
+
+    async def handle(update, previous):
+        # сохраняем порядок апдейтов одного пользователя
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await app.dp.feed_raw_update(app.bot, update)
+        except Exception:
+            logging.exception('Ошибка обработки апдейта %s', update.get('update_id'))
+
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            update = json.loads(line)
+            user_id = update_user_id(update)
+            task = asyncio.create_task(handle(update, tails.get(user_id)))
+            tails[user_id] = task
+            task.add_done_callback(lambda done, user_id=user_id: tails.get(user_id) is done and tails.pop(user_id))
+        if tails:
+            await asyncio.wait(list(tails.values()))
+    finally:
+        await app.dp.emit_shutdown(bot=app.bot)
+        await app.bot.session.close()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:] == ['worker']:
+        logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+        asyncio.run(run_worker())
+    else:
+        sys.exit('usage: python sharding.py worker (фронт запускается из bot.py с BOT_WORKERS > 1)')
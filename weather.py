@@ -0,0 +1,104 @@
+import os
+import time
+import asyncio
+from collections import Counter
+
+import aiohttp
+
+import metrics
+from cache import TTLCache, MISSING
+
+OPENWEATHER_URL = os.getenv('OPENWEATHER_URL', 'http://api.openweathermap.org/data/2.5/weather')
+WEATHER_CACHE_TTL = float(os.getenv('WEATHER_CACHE_TTL', '1800'))
+WEATHER_MAX_CONNECTIONS = int(os.getenv('WEATHER_MAX_CONNECTIONS', '20'))
+WEATHER_REFRESH_TOP = int(os.getenv('WEATHER_REFRESH_TOP', '20'))
+
+
+class WeatherClient:
+    """
+    Клиент OpenWeatherMap с общей сессией, кэшем погоды по городам
+    и объединением одновременных запросов к одному городу.
+    """
+
+    def __init__(self, api_key, base_url=OPENWEATHER_URL, ttl=WEATHER_CACHE_TTL,
+                 max_connections=WEATHER_MAX_CONNECTIONS, refresh_top=WEATHER_REFRESH_TOP):
+        self.api_key = api_key
+        self.base_url = base_url
+        self.max_connections = max_connections
+        self.refresh_top = refresh_top
+        self.cache = TTLCache(maxsize=10000, ttl=ttl)
+        self.upstream_requests = 0
+        self._session = None
+        self._inflight = {}
+        self._popularity = Counter()
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections, ttl_dns_cache=300),
+                timeout=aiohttp.ClientTimeout(total=10),
+            )
+        return self._session
+
+    async def get_current_weather(self, city_name):
+        key = city_name.strip().lower()
+        self._popularity[key] += 1
+
+        data = self.cache.get(key)
+        if data is not MISSING:
+            return data
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(city_name, key))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield: отмена одного ожидающего не отменяет общий запрос
+        return await asyncio.shield(task)
+
+    async def get_current_temperature(self, city_name):
+        data = await self.get_current_weather(city_name)
+        return (data.get('main') or {}).get('temp')
+
+    async def _fetch(self, city_name, key):
+        params = {
+            'q': city_name,
+            'appid': self.api_key,
+            'units': 'metric'
+        }
+        self.upstream_requests += 1
+        start = time.perf_counter()
+        try:
+            async with self._get_session().get(self.base_url, params=params) as response:
+                data = await response.json(content_type=None)
+        except Exception as e:
+            metrics.API_ERRORS.inc('openweathermap')
+            return {"error": str(e), "cod": 500}
+        finally:
+            metrics.API_LATENCY.observe(time.perf_counter() - start, 'openweathermap')
+        if str(data.get('cod', '')).startswith('5'):
+            metrics.API_ERRORS.inc('openweathermap')
+
+        if str(data.get('cod')) == '200':
+            self.cache.set(key, data)
+        return data
+
+    def hottest_cities(self):
+        return [city for city, _ in self._popularity.most_common(self.refresh_top)]
+
+    async def refresh_hottest(self, interval=None):
+        """
+        Фоновое обновление погоды для самых запрашиваемых городов,
+        чтобы пользователи этих городов не попадали на промах кэша.
+        """
+        interval = interval or self.cache.ttl * 0.8
+        while True:
+            await asyncio.sleep(interval)
+            cities = self.hottest_cities()
+            await asyncio.gather(*(self._fetch(city, city) for city in cities))
+            # затухание популярности, чтобы топ отражал текущую нагрузку
+            self._popularity = Counter({city: count // 2 for city, count in self._popularity.items() if count > 1})
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()